@@ -28,7 +28,7 @@ def prompt_for_account(available_accounts):
             print("Invalid input. Please enter a number.")
 
 def setup_accounts(args):
-    if args.command == 'get':
+    if args.command in ('get', 'refresh'):
         account_id = get_or_create_account(args.account)
         if account_id is None:
             log(f"Failed to get or create account {args.account}")
@@ -41,3 +41,10 @@ def setup_accounts(args):
             log(f"Failed to get or create accounts")
             return None, None
         return source_account_id, target_account_id
+    elif args.command == 'plan':
+        account_id = get_or_create_account(args.account)
+        target_account_id = get_or_create_account(args.to_account) if args.to_account else None
+        if account_id is None or (args.to_account and target_account_id is None):
+            log(f"Failed to get or create accounts")
+            return None, None
+        return account_id, target_account_id
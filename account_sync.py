@@ -0,0 +1,159 @@
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from auth import build_youtube, get_shared_credentials
+from database import (DatabaseWriter, close_db_connections, get_existing_subscriptions, get_or_create_account,
+                      store_subscriptions_in_db, set_shared_writer)
+from channel_refresh import get_stale_channel_ids
+from quota_management import quota_project, get_quota_usage
+from subscription_listing import iter_subscription_pages
+from subscription_replay import replay_deltas
+from utils import log
+
+# Accounts listed and enriched at the same time by `sync`
+DEFAULT_SYNC_WORKERS = 4
+
+def sync_accounts(account_names, workers=DEFAULT_SYNC_WORKERS, max_ops=None, credentials_loader=get_shared_credentials,
+                  client_builder=build_youtube, replay=False):
+    # Credentials are loaded one account at a time, since a missing token opens an
+    # interactive browser flow. Listing and enrichment then run in parallel with
+    # one client per account, while every database write (subscriptions, snapshots,
+    # HTTP cache, quota ledger, replay results) goes through one writer.
+    # With replay, each account's changes since its previous snapshot are then
+    # applied to every other account.
+    accounts = []
+    for account_name in account_names:
+        account_id = get_or_create_account(account_name)
+        if account_id is None:
+            log(f"Failed to get or create account {account_name}. Skipping it.")
+            continue
+        try:
+            credentials = credentials_loader(account_name)
+        except Exception as e:
+            log(f"Failed to load credentials for {account_name}: {e}. Skipping it.")
+            continue
+        accounts.append((account_name, account_id, credentials))
+
+    log(f"Syncing {len(accounts)} accounts with {workers} workers.")
+    started = time.monotonic()
+    writer = DatabaseWriter()
+    set_shared_writer(writer)
+    results = []
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="sync") as executor:
+            futures = [executor.submit(sync_account, writer, account_name, account_id, credentials, max_ops, client_builder)
+                       for account_name, account_id, credentials in accounts]
+            for future in as_completed(futures):
+                result = future.result()
+                log(f"Finished {result['account']} in {result['total_seconds']:.1f}s ({result['status']}).")
+                results.append(result)
+
+        if replay:
+            replay_started = time.monotonic()
+            with ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="replay") as executor:
+                futures = [executor.submit(replay_onto_account, account, accounts, client_builder) for account in accounts]
+                replays = {future.result()['account']: future.result() for future in as_completed(futures)}
+            for result in results:
+                result['replay'] = replays.get(result['account'])
+                if result['replay'] is not None:
+                    result['total_seconds'] += result['replay']['seconds']
+            log(f"Replayed subscription changes in {time.monotonic() - replay_started:.1f}s.")
+    finally:
+        set_shared_writer(None)
+        writer.close()
+
+    log_sync_summary(results, time.monotonic() - started)
+    return results
+
+def replay_onto_account(target, accounts, client_builder=build_youtube):
+    # Inserts and deletes are charged to the target account's project
+    target_name, target_id, credentials = target
+    result = {'account': target_name, 'added': 0, 'removed': 0, 'unchanged': 0, 'failed': 0, 'deferred': 0,
+              'quota_used': 0, 'seconds': 0.0}
+    started = time.monotonic()
+    youtube = None
+    with quota_project(target_name):
+        quota_before = get_quota_usage()
+        try:
+            youtube = client_builder(credentials, target_name)
+            for source_name, source_id, _ in accounts:
+                if source_id == target_id:
+                    continue
+                counts = replay_deltas(youtube, source_id, target_id)
+                for key, value in counts.items():
+                    result[key] += value
+        except Exception as e:
+            result['failed'] += 1
+            log(f"An error occurred while replaying changes onto {target_name}: {traceback.format_exc()}")
+        finally:
+            result['quota_used'] = get_quota_usage() - quota_before
+            if youtube is not None:
+                youtube.close()
+            close_db_connections()
+    result['seconds'] = time.monotonic() - started
+    return result
+
+def sync_account(writer, account_name, account_id, credentials, max_ops=None, client_builder=build_youtube):
+    result = {'account': account_name, 'status': 'ok', 'fetched': 0, 'new': 0, 'details_fetched': 0, 'quota_used': 0,
+              'connect_seconds': 0.0, 'list_seconds': 0.0, 'store_seconds': 0.0, 'total_seconds': 0.0}
+    started = time.monotonic()
+    youtube = None
+    # API calls made by this worker are charged to the account's own project
+    with quota_project(account_name):
+        quota_before = get_quota_usage()
+        try:
+            youtube = client_builder(credentials, account_name)
+            result['connect_seconds'] = time.monotonic() - started
+
+            existing_subs, _ = get_existing_subscriptions(account_id)
+            fresh_subs = existing_subs - get_stale_channel_ids(account_id)
+            listing_started = time.monotonic()
+            store_seconds = []
+
+            def store(subscriptions, account_id, **kwargs):
+                # Runs on the shared writer, which stores the pages as they are listed
+                store_started = time.monotonic()
+                stored = store_subscriptions_in_db(subscriptions, account_id, **kwargs)
+                store_seconds.append(time.monotonic() - store_started)
+                return stored
+
+            # The next page is prefetched with a second client built from the same credentials
+            for page in iter_subscription_pages(youtube, fresh_subs, account_name, max_ops, account_id, store,
+                                                client_factory=lambda: client_builder(credentials, account_name),
+                                                writer=writer):
+                result['fetched'] += len(page)
+                result['new'] += sum(1 for channel in page if channel['channel_id'] not in existing_subs)
+                result['details_fetched'] += sum(1 for channel in page if 'details_fetched_at' in channel)
+            fetched = result['fetched']
+            # Storing overlaps listing, so store_seconds is part of list_seconds
+            result['store_seconds'] = sum(store_seconds)
+            result['list_seconds'] = time.monotonic() - listing_started
+            if not fetched:
+                result['status'] = 'nothing fetched'
+        except Exception as e:
+            result['status'] = f"failed: {e}"
+            log(f"An error occurred while syncing {account_name}: {traceback.format_exc()}")
+        finally:
+            result['quota_used'] = get_quota_usage() - quota_before
+            if youtube is not None:
+                youtube.close()
+            close_db_connections()
+    result['total_seconds'] = time.monotonic() - started
+    return result
+
+def log_sync_summary(results, elapsed):
+    log("\n--- Sync summary ---")
+    for result in sorted(results, key=lambda result: result['account']):
+        log(f"{result['account']}: {result['status']}, {result['fetched']} fetched, {result['new']} new, "
+            f"{result['details_fetched']} with fetched details, "
+            f"{result['quota_used']} quota units; connect {result['connect_seconds']:.1f}s, "
+            f"list {result['list_seconds']:.1f}s, store {result['store_seconds']:.1f}s, total {result['total_seconds']:.1f}s")
+        if result.get('replay'):
+            replay = result['replay']
+            log(f"  replayed onto {result['account']}: {replay['added']} added, {replay['removed']} removed, "
+                f"{replay['unchanged']} already matching, {replay['failed']} failed, {replay['deferred']} deferred, "
+                f"{replay['quota_used']} quota units")
+    sequential = sum(result['total_seconds'] for result in results)
+    log(f"Synced {len(results)} accounts: {sum(result['fetched'] for result in results)} subscriptions fetched, "
+        f"{sum(result['new'] for result in results)} new, {sum(result['quota_used'] for result in results)} quota units.")
+    log(f"Wall time {elapsed:.1f}s for {sequential:.1f}s of per-account work.")
@@ -0,0 +1,146 @@
+import json
+import os
+import threading
+import time
+from urllib.parse import urlparse
+from quota_management import get_operation_cost
+from utils import log, current_retry_attempt
+
+# Upper bounds, in seconds, of the request duration histogram buckets
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, float('inf'))
+PROMETHEUS_FILE = 'youtube_api_metrics.prom'
+JSON_SUMMARY_FILE = 'youtube_api_metrics.json'
+
+# API method implied by the HTTP verb used on a collection
+VERB_METHODS = {'GET': 'list', 'POST': 'insert', 'PUT': 'update', 'DELETE': 'delete'}
+
+_metrics_lock = threading.Lock()
+_calls = {}  # (account, method, status) -> count
+_latency = {}  # (account, method) -> {'buckets': [...], 'sum': seconds, 'count': n}
+_retries = {}  # (account, method) -> count
+_quota_units = {}  # (account, method) -> units
+_response_bytes = {}  # (account, method) -> bytes
+
+class InstrumentedHttp:
+    # Wraps the transport under the ETag cache and records every request that
+    # reaches the API: method, status, duration, retries and quota cost
+    def __init__(self, http, account):
+        self.http = http
+        self.account = account
+
+    def __getattr__(self, name):
+        return getattr(self.http, name)
+
+    def request(self, uri, method='GET', body=None, headers=None, **kwargs):
+        api_method = get_api_method(uri, method)
+        attempt = current_retry_attempt()
+        started = time.monotonic()
+        status = 'error'
+        try:
+            response, content = self.http.request(uri, method=method, body=body, headers=headers, **kwargs)
+            status = str(response.status)
+            return response, content
+        finally:
+            record_api_call(self.account, api_method, status, time.monotonic() - started,
+                            retry=attempt > 0, size=len(content) if status != 'error' and content else 0)
+
+def get_api_method(uri, http_method):
+    # ".../youtube/v3/subscriptions?part=snippet" with GET -> "subscriptions.list"
+    resource = urlparse(uri).path.rstrip('/').rsplit('/', 1)[-1]
+    return f"{resource}.{VERB_METHODS.get(http_method, http_method.lower())}"
+
+def record_api_call(account, method, status, seconds, retry=False, size=0):
+    key = (account, method)
+    with _metrics_lock:
+        _calls[key + (status,)] = _calls.get(key + (status,), 0) + 1
+        histogram = _latency.setdefault(key, {'buckets': [0] * len(LATENCY_BUCKETS), 'sum': 0.0, 'count': 0})
+        for index, bound in enumerate(LATENCY_BUCKETS):
+            if seconds <= bound:
+                histogram['buckets'][index] += 1
+                break
+        histogram['sum'] += seconds
+        histogram['count'] += 1
+        if retry:
+            _retries[key] = _retries.get(key, 0) + 1
+        # Every request that reaches the API is charged, including failed ones
+        _quota_units[key] = _quota_units.get(key, 0) + get_operation_cost(method)
+        _response_bytes[key] = _response_bytes.get(key, 0) + size
+
+def reset_api_metrics():
+    with _metrics_lock:
+        for metrics in (_calls, _latency, _retries, _quota_units, _response_bytes):
+            metrics.clear()
+
+def get_api_metrics_summary():
+    with _metrics_lock:
+        summary = {}
+        for (account, method), histogram in sorted(_latency.items()):
+            key = (account, method)
+            summary.setdefault(account, {})[method] = {
+                'calls': histogram['count'],
+                'statuses': {status: count for (call_account, call_method, status), count in sorted(_calls.items())
+                             if (call_account, call_method) == key},
+                'retries': _retries.get(key, 0),
+                'quota_units': _quota_units.get(key, 0),
+                'response_bytes': _response_bytes.get(key, 0),
+                'total_seconds': round(histogram['sum'], 6),
+                'average_seconds': round(histogram['sum'] / histogram['count'], 6),
+                'latency_buckets': {format_bound(bound): sum(histogram['buckets'][:index + 1])
+                                    for index, bound in enumerate(LATENCY_BUCKETS)},
+            }
+        return summary
+
+def format_bound(bound):
+    return '+Inf' if bound == float('inf') else f"{bound:g}"
+
+def render_prometheus_metrics():
+    summary = get_api_metrics_summary()
+    lines = [
+        '# HELP youtube_api_requests_total YouTube Data API requests by method and HTTP status.',
+        '# TYPE youtube_api_requests_total counter',
+    ]
+    for account, methods in summary.items():
+        for method, entry in methods.items():
+            for status, count in entry['statuses'].items():
+                lines.append(f'youtube_api_requests_total{{account="{account}",method="{method}",status="{status}"}} {count}')
+    for name, field, help_text in (
+        ('youtube_api_retries_total', 'retries', 'Requests that were retries of a failed call.'),
+        ('youtube_api_quota_units_total', 'quota_units', 'Quota units charged by the API.'),
+        ('youtube_api_response_bytes_total', 'response_bytes', 'Response body bytes received.'),
+    ):
+        lines += [f'# HELP {name} {help_text}', f'# TYPE {name} counter']
+        for account, methods in summary.items():
+            for method, entry in methods.items():
+                lines.append(f'{name}{{account="{account}",method="{method}"}} {entry[field]}')
+    lines += ['# HELP youtube_api_request_duration_seconds Time until the API answered.',
+              '# TYPE youtube_api_request_duration_seconds histogram']
+    for account, methods in summary.items():
+        for method, entry in methods.items():
+            labels = f'account="{account}",method="{method}"'
+            for bound, count in entry['latency_buckets'].items():
+                lines.append(f'youtube_api_request_duration_seconds_bucket{{{labels},le="{bound}"}} {count}')
+            lines.append(f'youtube_api_request_duration_seconds_sum{{{labels}}} {entry["total_seconds"]}')
+            lines.append(f'youtube_api_request_duration_seconds_count{{{labels}}} {entry["calls"]}')
+    return '\n'.join(lines) + '\n'
+
+def write_atomically(path, text):
+    # Textfile collectors may read at any time, so never expose a half-written file
+    temporary_path = f"{path}.tmp"
+    with open(temporary_path, 'w') as f:
+        f.write(text)
+    os.replace(temporary_path, path)
+
+def export_api_metrics(directory='.'):
+    summary = get_api_metrics_summary()
+    if not summary:
+        return
+    os.makedirs(directory, exist_ok=True)
+    write_atomically(os.path.join(directory, PROMETHEUS_FILE), render_prometheus_metrics())
+    write_atomically(os.path.join(directory, JSON_SUMMARY_FILE), json.dumps(summary, indent=2) + '\n')
+
+    for account, methods in summary.items():
+        for method, entry in methods.items():
+            log(f"API {account} {method}: {entry['calls']} calls, {entry['retries']} retries, "
+                f"{entry['quota_units']} quota units, {entry['total_seconds']:.2f}s total, "
+                f"{entry['average_seconds'] * 1000:.0f} ms average, statuses {entry['statuses']}")
+    log(f"API metrics written to {os.path.join(directory, PROMETHEUS_FILE)} and {os.path.join(directory, JSON_SUMMARY_FILE)}.")
@@ -1,14 +1,165 @@
+import json
 import os
-from google.oauth2.credentials import Credentials
-from google_auth_oauthlib.flow import InstalledAppFlow
-from google.auth.transport.requests import Request
-from googleapiclient.discovery import build
+import threading
+from datetime import datetime, timedelta, timezone
+from api_metrics import InstrumentedHttp
+from http_cache import CachingHttp
 from utils import log
 
+# The Google client libraries take a few hundred milliseconds to import, so they
+# are imported inside the functions that talk to the API. Commands that only
+# touch the database or local files never load them.
+
 # Define the scope for YouTube Data API
 SCOPES = ['https://www.googleapis.com/auth/youtube.force-ssl']
 
+# YouTube Data API discovery document, persisted on first use and reused by later runs
+DISCOVERY_DOCUMENT_FILE = 'youtube_v3_discovery.json'
+DISCOVERY_URL = 'https://youtube.googleapis.com/$discovery/rest?version=v3'
+
+# Access tokens are refreshed this long before they expire, so requests never carry a stale one
+TOKEN_REFRESH_MARGIN = timedelta(minutes=5)
+
+_discovery_document = None
+_discovery_lock = threading.Lock()
+# Client registry: credentials are shared by every thread, while each thread gets
+# its own client and keep-alive connections, since httplib2 is not thread-safe
+_clients = threading.local()
+_credentials = {}  # account -> credentials
+_credentials_lock = threading.Lock()
+_refresh_lock = threading.Lock()
+_saved_tokens = {}  # account -> token JSON as last read from or written to disk
+
+# FakeYouTubeAPI that replaces the real service when --fake-api is given
+_fake_api = None
+
+def use_fake_api(api):
+    global _fake_api
+    _fake_api = api
+
+def get_fake_api():
+    return _fake_api
+
 def authenticate_youtube(account_name):
+    # The calling thread's client for the account, built on first use
+    clients = _clients.__dict__.setdefault('by_account', {})
+    if account_name not in clients:
+        clients[account_name] = build_youtube(get_shared_credentials(account_name), account_name)
+    return clients[account_name]
+
+def get_shared_credentials(account_name):
+    # Loaded once per process. The lock also keeps interactive sign-ins from overlapping.
+    with _credentials_lock:
+        if account_name not in _credentials:
+            _credentials[account_name] = get_credentials(account_name)
+        return _credentials[account_name]
+
+def close_youtube_clients():
+    # Close the keep-alive connections of the calling thread's clients
+    clients = _clients.__dict__.get('by_account', {})
+    for client in clients.values():
+        client.close()
+    clients.clear()
+
+def build_youtube(credentials, account_name):
+    # GET requests go through the per-account ETag cache; requests that reach
+    # the API are recorded by the instrumentation layer underneath it
+    from googleapiclient.discovery import build_from_document
+    if _fake_api is not None:
+        http = _fake_api.http(account_name)
+    else:
+        import google_auth_httplib2
+        import httplib2
+        http = FreshCredentialsHttp(google_auth_httplib2.AuthorizedHttp(credentials, http=httplib2.Http()),
+                                    account_name, credentials)
+    return build_from_document(get_discovery_document(), http=CachingHttp(InstrumentedHttp(http, account_name), account_name))
+
+class FreshCredentialsHttp:
+    # Refreshes the shared credentials shortly before they expire, once for all threads
+    def __init__(self, http, account_name, credentials):
+        self.http = http
+        self.account_name = account_name
+        self.credentials = credentials
+
+    def __getattr__(self, name):
+        return getattr(self.http, name)
+
+    def request(self, *args, **kwargs):
+        refresh_credentials_if_expiring(self.account_name, self.credentials)
+        return self.http.request(*args, **kwargs)
+
+def refresh_credentials_if_expiring(account_name, credentials, margin=TOKEN_REFRESH_MARGIN):
+    if not credentials_expiring(credentials, margin):
+        return False
+    with _refresh_lock:
+        # Another thread may have refreshed while this one waited
+        if not credentials_expiring(credentials, margin):
+            return False
+        from google.auth.transport.requests import Request
+        log(f"Refreshing credentials for {account_name} before they expire...")
+        credentials.refresh(Request())
+        save_credentials(account_name, credentials)
+        return True
+
+def credentials_expiring(credentials, margin):
+    # google-auth keeps expiry as naive UTC
+    if credentials is None or credentials.expiry is None or not credentials.refresh_token:
+        return False
+    return credentials.expiry - datetime.now(timezone.utc).replace(tzinfo=None) < margin
+
+def save_credentials(account_name, credentials):
+    # Token files are only rewritten when the credentials actually changed
+    token_file = f'token_{account_name}.json'
+    content = credentials.to_json()
+    if _saved_tokens.get(account_name) == content:
+        return False
+    log(f"Saving new credentials to {token_file}...")
+    temporary_file = f"{token_file}.tmp"
+    with open(temporary_file, 'w') as token:
+        token.write(content)
+    os.replace(temporary_file, token_file)
+    _saved_tokens[account_name] = content
+    return True
+
+def get_discovery_document():
+    # Parsed once per process. The persisted copy keeps later runs from resolving
+    # the document again and pins the API surface across library upgrades.
+    global _discovery_document
+    with _discovery_lock:
+        if _discovery_document is None:
+            _discovery_document = load_discovery_document()
+    return _discovery_document
+
+def load_discovery_document():
+    if os.path.exists(DISCOVERY_DOCUMENT_FILE):
+        try:
+            with open(DISCOVERY_DOCUMENT_FILE, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except ValueError as e:
+            log(f"Ignoring unreadable discovery document {DISCOVERY_DOCUMENT_FILE}: {e}")
+
+    from googleapiclient import discovery_cache
+    content = discovery_cache.get_static_doc('youtube', 'v3')
+    if content is None:
+        import httplib2
+        log("Downloading the YouTube API discovery document...")
+        response, content = httplib2.Http().request(DISCOVERY_URL)
+        if response.status != 200:
+            raise RuntimeError(f"Could not download the discovery document: HTTP {response.status}")
+        content = content.decode('utf-8')
+    document = json.loads(content)
+    temporary_file = f"{DISCOVERY_DOCUMENT_FILE}.tmp"
+    with open(temporary_file, 'w', encoding='utf-8') as f:
+        f.write(content)
+    os.replace(temporary_file, DISCOVERY_DOCUMENT_FILE)
+    return document
+
+def get_credentials(account_name):
+    if _fake_api is not None:
+        return None
+    from google.oauth2.credentials import Credentials
+    from google_auth_oauthlib.flow import InstalledAppFlow
+    from google.auth.transport.requests import Request
     creds = None
     token_file = f'token_{account_name}.json'
     client_secret_file = f'client_secret_{account_name}.json'
@@ -16,6 +167,7 @@ def authenticate_youtube(account_name):
     if os.path.exists(token_file):
         log(f"Token file found. Loading credentials...")
         creds = Credentials.from_authorized_user_file(token_file, SCOPES)
+        _saved_tokens[account_name] = creds.to_json()
     if not creds or not creds.valid:
         if creds and creds.expired and creds.refresh_token:
             log("Refreshing expired credentials...")
@@ -24,8 +176,6 @@ def authenticate_youtube(account_name):
             log(f"Starting new authentication flow for {account_name} account...")
             flow = InstalledAppFlow.from_client_secrets_file(client_secret_file, SCOPES)
             creds = flow.run_local_server(port=0)
-        log(f"Saving new credentials to {token_file}...")
-        with open(token_file, 'w') as token:
-            token.write(creds.to_json())
+        save_credentials(account_name, creds)
     log(f"Authentication for {account_name} account completed.")
-    return build('youtube', 'v3', credentials=creds)
+    return creds
@@ -0,0 +1,241 @@
+import argparse
+import csv
+import json
+import logging
+import os
+import platform
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+from googleapiclient.discovery import build
+import auth
+import quota_management
+from database import (close_db_connections, get_db_connection, get_or_create_account, get_existing_subscriptions,
+                      iter_import_candidates, store_subscriptions_in_db)
+from fake_youtube import FakeYouTubeAPI
+from subscription_import import import_subscriptions
+from subscription_listing import list_subscriptions
+from utils import parse_subscriptions_csv
+from watch_history import process_watch_history
+
+# Reproducible timings of the hot paths on synthetic data. Every benchmark runs
+# in its own scratch directory, so the real subscriptions.db is never touched.
+#
+#   python benchmark.py --output results.json --baseline benchmark_baseline.json
+#   python benchmark.py --output benchmark_baseline.json   # record a new baseline
+#
+# The committed benchmark_baseline.json is one run on one machine and is for
+# reference only. Timings only compare on the same hardware, so record a local
+# baseline before using --baseline to look for regressions.
+
+DEFAULT_SIZES = [1000, 10000, 100000]
+# End-to-end runs make one fake API call per page, channel or insert
+DEFAULT_API_SIZES = [1000, 10000]
+DEFAULT_WATCH_ROWS = 1000000
+# A benchmark regresses when it is this much slower than the baseline
+DEFAULT_THRESHOLD = 0.25
+# Fast benchmarks are repeated and the best time is kept
+DEFAULT_REPEAT = 3
+# Benchmarks faster than this are too noisy to flag as regressions
+MIN_COMPARABLE_SECONDS = 0.005
+
+def synthetic_subscriptions(count, offset=0):
+    return [{'channel_id': f"UC{index:022d}", 'title': f"Channel {index}", 'description': f"Description of channel {index}",
+             'published_at': '2015-01-01T00:00:00Z', 'created_at': '2015-01-01T00:00:00Z', 'total_videos': str(index % 500),
+             'last_upload_date': '2024-01-01T00:00:00Z', 'upload_frequency': '0.10 videos per day'}
+            for index in range(offset, offset + count)]
+
+def write_subscriptions_csv(path, count):
+    with open(path, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f)
+        writer.writerow(['Channel Id', 'Channel Url', 'Channel Title'])
+        for index in range(count):
+            writer.writerow([f"UC{index:022d}", f"http://www.youtube.com/channel/UC{index:022d}", f"Channel {index}"])
+
+def write_watch_history_json(path, rows):
+    # Takeout-style export, newest first, watching 50k distinct videos on 5k channels
+    newest = datetime(2024, 6, 1, tzinfo=timezone.utc)
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('[')
+        for row in range(rows):
+            video_id = f"v{row % 50000:010d}"
+            entry = {'header': 'YouTube', 'title': f"Watched Video {video_id}",
+                     'titleUrl': f"https://www.youtube.com/watch?v={video_id}",
+                     'subtitles': [{'name': f"Channel {row % 5000}",
+                                    'url': f"https://www.youtube.com/channel/UC{row % 5000:022d}"}],
+                     'time': (newest - timedelta(seconds=row * 37)).strftime('%Y-%m-%dT%H:%M:%S.000Z'),
+                     'products': ['YouTube']}
+            f.write((',\n' if row else '\n') + json.dumps(entry))
+        f.write('\n]')
+
+@contextmanager
+def scratch_directory():
+    previous = os.getcwd()
+    with tempfile.TemporaryDirectory(prefix='yt-benchmark-') as directory:
+        os.chdir(directory)
+        try:
+            yield directory
+        finally:
+            close_db_connections()
+            os.chdir(previous)
+
+def measure(results, name, items, function, repeat=1):
+    # Keeps the best of `repeat` runs
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        function()
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    results[name] = {'seconds': round(best, 6), 'items': items, 'items_per_second': round(items / best, 1) if best else None}
+    print(f"{name:<45} {best:10.3f}s {results[name]['items_per_second'] or 0:14,.0f} items/s", flush=True)
+
+def bench_database(results, size, repeat):
+    subscriptions = synthetic_subscriptions(size)
+    with scratch_directory():
+        account_id = get_or_create_account('source')
+        target_id = get_or_create_account('target')
+        measure(results, f"store_subscriptions_in_db/insert/{size}", size,
+                lambda: store_subscriptions_in_db(subscriptions, account_id))
+        measure(results, f"store_subscriptions_in_db/upsert/{size}", size,
+                lambda: store_subscriptions_in_db(subscriptions, account_id), repeat)
+        store_subscriptions_in_db(synthetic_subscriptions(size // 2, size // 4), target_id)
+        measure(results, f"get_existing_subscriptions/{size}", size,
+                lambda: get_existing_subscriptions(account_id), repeat)
+
+        measure(results, f"import_candidates/{size}", size,
+                lambda: sum(1 for _ in iter_import_candidates(account_id, target_id)), repeat)
+
+        write_subscriptions_csv('subscriptions.csv', size)
+        measure(results, f"parse_subscriptions_csv/{size}", size,
+                lambda: parse_subscriptions_csv('subscriptions.csv'), repeat)
+
+def bench_watch_history(results, rows):
+    with scratch_directory():
+        write_watch_history_json('watch-history.json', rows)
+        account_id = get_or_create_account('viewer')
+        measure(results, f"process_watch_history/json/{rows}", rows,
+                lambda: process_watch_history('watch-history.json', account_id, 'json'))
+        # Without its high-water mark, a second pass re-processes every row against the stored history
+        clear_watch_history_high_water_mark(account_id)
+        measure(results, f"process_watch_history/json/reingest/{rows}", rows,
+                lambda: process_watch_history('watch-history.json', account_id, 'json'))
+
+def clear_watch_history_high_water_mark(account_id):
+    conn = get_db_connection()
+    with conn:
+        conn.execute("DELETE FROM watch_history_sync WHERE account_id = ?", (account_id,))
+
+def bench_api_pipelines(results, size):
+    with scratch_directory():
+        api = FakeYouTubeAPI(channels=size * 2, subscriptions=size)
+        source_id = get_or_create_account('source')
+        target_id = get_or_create_account('target')
+
+        youtube = build('youtube', 'v3', http=api.http('source'))
+        listed = []
+        measure(results, f"list_subscriptions/fake_api/{size}", size,
+                lambda: listed.extend(list_subscriptions(
+                    youtube, set(), 'source', client_factory=lambda: build('youtube', 'v3', http=api.http('source')))))
+        store_subscriptions_in_db(listed, source_id)
+
+        with quota_management.quota_project('target'):
+            target = build('youtube', 'v3', http=api.http('target'))
+            measure(results, f"import_subscriptions/fake_api/{size}", size,
+                    lambda: import_subscriptions(youtube, target, source_id, target_id, workers=4, rate=1000000,
+                                                 client_factory=lambda: build('youtube', 'v3', http=api.http('target'))))
+
+def bench_startup(results, repeat):
+    # Wall time of fresh interpreters: importing main, and a database-only command
+    root = os.path.dirname(os.path.abspath(__file__))
+    environment = dict(os.environ, PYTHONPATH=root)
+    with scratch_directory():
+        measure(results, "startup/import_main", 1,
+                lambda: subprocess.run([sys.executable, '-c', 'import main'], env=environment, check=True), repeat)
+        measure(results, "startup/quota_command", 1,
+                lambda: subprocess.run([sys.executable, os.path.join(root, 'main.py'), 'quota', '--days', '1'],
+                                       env=environment, check=True, capture_output=True), repeat)
+        api = FakeYouTubeAPI(channels=10)
+        auth.use_fake_api(api)
+        try:
+            measure(results, "startup/build_youtube", 1, lambda: auth.build_youtube(None, 'source'), repeat)
+        finally:
+            auth.use_fake_api(None)
+
+def environment():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {'timestamp': datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ'), 'commit': commit,
+            'python': platform.python_version(), 'sqlite': sqlite3.sqlite_version,
+            'platform': platform.platform(), 'processor': platform.processor() or platform.machine()}
+
+def compare_with_baseline(results, baseline, threshold):
+    # Returns the names of benchmarks slower than the baseline by more than the threshold
+    regressions = []
+    print(f"\n{'benchmark':<45} {'baseline':>10} {'current':>10} {'change':>8}")
+    for name, result in results.items():
+        previous = baseline.get('results', {}).get(name)
+        if not previous or not previous['seconds']:
+            print(f"{name:<45} {'-':>10} {result['seconds']:10.3f} {'new':>8}")
+            continue
+        change = result['seconds'] / previous['seconds'] - 1
+        regressed = change > threshold and max(previous['seconds'], result['seconds']) >= MIN_COMPARABLE_SECONDS
+        print(f"{name:<45} {previous['seconds']:10.3f} {result['seconds']:10.3f} {change:+8.0%}{' REGRESSION' if regressed else ''}")
+        if regressed:
+            regressions.append(name)
+    return regressions
+
+def run_benchmarks(sizes=DEFAULT_SIZES, api_sizes=DEFAULT_API_SIZES, watch_rows=DEFAULT_WATCH_ROWS, repeat=DEFAULT_REPEAT):
+    results = {}
+    bench_startup(results, repeat)
+    for size in sizes:
+        bench_database(results, size, repeat)
+    if watch_rows:
+        bench_watch_history(results, watch_rows)
+    for size in api_sizes:
+        bench_api_pipelines(results, size)
+    return {'environment': environment(), 'results': results}
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Benchmark the database, parsing and API pipelines on synthetic data")
+    parser.add_argument('--sizes', type=int, nargs='*', default=DEFAULT_SIZES, help='Channel counts for the database and parsing benchmarks')
+    parser.add_argument('--api-sizes', type=int, nargs='*', default=DEFAULT_API_SIZES, help='Subscription counts for the fake API listing/import benchmarks')
+    parser.add_argument('--watch-rows', type=int, default=DEFAULT_WATCH_ROWS, help='Rows in the synthetic watch history export (0 to skip)')
+    parser.add_argument('--repeat', type=int, default=DEFAULT_REPEAT, help='Runs of each fast benchmark; the best is kept')
+    parser.add_argument('--output', default='benchmark_results.json', help='Where to write the results as JSON')
+    parser.add_argument('--baseline', help='Results file to compare against')
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD, help='Allowed slowdown before a benchmark counts as a regression')
+    return parser.parse_args()
+
+def main():
+    args = parse_arguments()
+    # Keep per-item log lines out of the timings
+    logging.basicConfig(level=logging.WARNING)
+    # The fake API has no real quota, so lift the local daily limit for the run
+    quota_management.DEFAULT_DAILY_QUOTA = 10 ** 12
+
+    report = run_benchmarks(args.sizes, args.api_sizes, args.watch_rows, args.repeat)
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"\nResults written to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get('environment', {}).get('platform') != report['environment']['platform']:
+            print(f"\nThe baseline was recorded on {baseline.get('environment', {}).get('platform')}; "
+                  f"timings from another machine are for reference only.")
+        regressions = compare_with_baseline(report['results'], baseline, args.threshold)
+        if regressions:
+            print(f"\n{len(regressions)} benchmark(s) regressed by more than {args.threshold:.0%}: {', '.join(regressions)}")
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
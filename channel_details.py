@@ -1,55 +1,99 @@
-from googleapiclient.errors import HttpError
+from datetime import datetime, timezone
 from utils import log, parse_datetime, exponential_backoff
+from quota_management import use_quota
+
+# channels.list accepts at most 50 comma-separated IDs per call
+MAX_CHANNELS_PER_REQUEST = 50
 
-@exponential_backoff
 def get_channel_details(youtube, channel_id):
+    details = get_channels_details(youtube, [channel_id])
+    return details.get(channel_id) if details else None
+
+def get_channels_details(youtube, channel_ids):
+    # Returns {channel_id: details}; channels missing from the response, or whose last
+    # upload could not be fetched, are omitted. Every API call is charged as it is made.
+    return fetch_channels_details(youtube, channel_ids)[0]
+
+def fetch_channels_details(youtube, channel_ids):
+    # Like get_channels_details, but also returns the IDs channels.list answered without,
+    # i.e. deleted or terminated channels
+    from googleapiclient.errors import HttpError
+    if len(channel_ids) > MAX_CHANNELS_PER_REQUEST:
+        raise ValueError(f"channels.list accepts at most {MAX_CHANNELS_PER_REQUEST} IDs, got {len(channel_ids)}")
+    details, missing = {}, []
     try:
-        response = youtube.channels().list(
+        response = execute_request(youtube.channels().list(
             part="snippet,statistics,contentDetails",
-            id=channel_id
-        ).execute()
-        
-        if 'items' in response and len(response['items']) > 0:
-            channel = response['items'][0]
-            snippet = channel['snippet']
-            statistics = channel['statistics']
-            content_details = channel['contentDetails']
-            
-            created_at = snippet['publishedAt']
-            total_videos = statistics.get('videoCount', 'N/A')
-            
-            last_upload_date = get_last_upload_date(youtube, content_details, channel_id)
-            
-            upload_frequency = calculate_upload_frequency(created_at, last_upload_date, total_videos)
-            
-            return {
-                'created_at': created_at,
-                'total_videos': total_videos,
-                'last_upload_date': last_upload_date,
-                'upload_frequency': upload_frequency
-            }
-        else:
-            return None
+            id=",".join(channel_ids),
+            maxResults=MAX_CHANNELS_PER_REQUEST
+        ), 'channels.list')
+        if response is None:
+            return details, missing
+
+        returned = {channel['id'] for channel in response.get('items', [])}
+        missing = [channel_id for channel_id in channel_ids if channel_id not in returned]
+        for channel in response.get('items', []):
+            channel_details = parse_channel_details(youtube, channel)
+            if channel_details is None:
+                # Retries or quota ran out; the rest of the batch is fetched on a later run
+                log(f"Stopping after details for {len(details)} of {len(channel_ids)} channels.")
+                break
+            details[channel['id']] = channel_details
     except HttpError as e:
-        log(f"An error occurred while fetching channel details for {channel_id}: {e}")
+        log(f"An error occurred while fetching channel details for {len(channel_ids)} channels: {e}")
+    return details, missing
+
+@exponential_backoff
+def execute_request(request, operation):
+    # One API call, charged on every attempt. Retrying here repeats only the call that
+    # failed; None means exponential_backoff gave up on it.
+    try:
+        return request.execute()
+    finally:
+        use_quota(operation)
+
+def parse_channel_details(youtube, channel):
+    snippet = channel['snippet']
+    statistics = channel['statistics']
+    content_details = channel['contentDetails']
+
+    created_at = snippet['publishedAt']
+    total_videos = statistics.get('videoCount', 'N/A')
+
+    last_upload_date = get_last_upload_date(youtube, content_details, channel['id'])
+    if last_upload_date is None:
         return None
 
+    upload_frequency = calculate_upload_frequency(created_at, last_upload_date, total_videos)
+
+    return {
+        'created_at': created_at,
+        'total_videos': total_videos,
+        'last_upload_date': last_upload_date,
+        'upload_frequency': upload_frequency,
+        'details_fetched_at': datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+    }
+
 def get_last_upload_date(youtube, content_details, channel_id):
+    # Returns None if the playlistItems.list call failed
+    from googleapiclient.errors import HttpError
     playlist_id = content_details['relatedPlaylists']['uploads']
     try:
-        last_video = youtube.playlistItems().list(
+        last_video = execute_request(youtube.playlistItems().list(
             part="snippet",
             playlistId=playlist_id,
             maxResults=1
-        ).execute()
-        
-        if 'items' in last_video and len(last_video['items']) > 0:
-            return last_video['items'][0]['snippet']['publishedAt']
+        ), 'playlistItems.list')
     except HttpError as e:
         if e.resp.status == 404:
             log(f"Playlist not found for channel {channel_id}. Skipping last upload date.")
-        else:
-            raise
+            return 'N/A'
+        raise
+    if last_video is None:
+        return None
+
+    if 'items' in last_video and len(last_video['items']) > 0:
+        return last_video['items'][0]['snippet']['publishedAt']
     return 'N/A'
 
 def calculate_upload_frequency(created_at, last_upload_date, total_videos):
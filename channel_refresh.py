@@ -0,0 +1,53 @@
+from datetime import datetime, timezone
+from channel_details import fetch_channels_details, MAX_CHANNELS_PER_REQUEST
+from database import get_stale_channels, update_channel_details, mark_channels_fetched
+from quota_management import get_remaining_quota, QUOTA_COST
+from utils import log
+
+# Default TTL policy: details of channels that uploaded within the last
+# ACTIVE_WINDOW_DAYS go stale after a day, those of dormant channels after a month
+ACTIVE_CHANNEL_TTL_DAYS = 1
+DORMANT_CHANNEL_TTL_DAYS = 30
+ACTIVE_WINDOW_DAYS = 30
+
+def get_stale_channel_ids(account_id, active_ttl_days=ACTIVE_CHANNEL_TTL_DAYS, dormant_ttl_days=DORMANT_CHANNEL_TTL_DAYS):
+    stale = get_stale_channels(account_id, active_ttl_days, dormant_ttl_days, ACTIVE_WINDOW_DAYS)
+    return {channel['channel_id'] for channel in stale}
+
+def detail_fetch_cost(channel_count):
+    # One playlistItems.list call per channel plus one channels.list call per batch
+    batches = -(-channel_count // MAX_CHANNELS_PER_REQUEST)
+    return channel_count * QUOTA_COST['playlistItems.list'] + batches * QUOTA_COST['channels.list']
+
+def affordable_refreshes(remaining_quota):
+    per_batch_cost = detail_fetch_cost(MAX_CHANNELS_PER_REQUEST)
+    full_batches, remainder = divmod(max(remaining_quota, 0), per_batch_cost)
+    partial = max(remainder - QUOTA_COST['channels.list'], 0) // QUOTA_COST['playlistItems.list']
+    return full_batches * MAX_CHANNELS_PER_REQUEST + partial
+
+def refresh_stale_channels(youtube, account_id, max_ops=None,
+                           active_ttl_days=ACTIVE_CHANNEL_TTL_DAYS, dormant_ttl_days=DORMANT_CHANNEL_TTL_DAYS):
+    budget = affordable_refreshes(get_remaining_quota())
+    if max_ops is not None:
+        budget = min(budget, max_ops)
+    if budget <= 0:
+        log("Not enough quota to refresh channel details.")
+        return 0
+
+    stale = get_stale_channels(account_id, active_ttl_days, dormant_ttl_days, ACTIVE_WINDOW_DAYS, limit=budget)
+    log(f"Refreshing details for {len(stale)} stale channels (budget: {budget} channels).")
+
+    refreshed = 0
+    for start in range(0, len(stale), MAX_CHANNELS_PER_REQUEST):
+        channel_ids = [channel['channel_id'] for channel in stale[start:start + MAX_CHANNELS_PER_REQUEST]]
+        # Charges its own calls, retries included
+        details, missing = fetch_channels_details(youtube, channel_ids)
+        update_channel_details(details)
+        refreshed += len(details)
+        if missing:
+            # Deleted or terminated channels would otherwise stay first in line on every refresh
+            log(f"{len(missing)} channels no longer exist. Checking them again after their TTL.")
+            mark_channels_fetched(missing, datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ'))
+
+    log(f"Refreshed details for {refreshed} of {len(stale)} stale channels.")
+    return refreshed
@@ -1,7 +1,26 @@
 import argparse
+from subscription_import import DEFAULT_IMPORT_WORKERS, DEFAULT_IMPORT_RATE
+from channel_refresh import ACTIVE_CHANNEL_TTL_DAYS, DORMANT_CHANNEL_TTL_DAYS
+from account_sync import DEFAULT_SYNC_WORKERS
+from database import CHANNEL_REPORT_ORDERS
 
-def parse_arguments():
+def positive_int(value):
+    number = int(value)
+    if number <= 0:
+        raise argparse.ArgumentTypeError(f"must be a positive integer, got {value}")
+    return number
+
+def positive_float(value):
+    number = float(value)
+    if number <= 0:
+        raise argparse.ArgumentTypeError(f"must be a positive number, got {value}")
+    return number
+
+def parse_arguments(argv=None):
     parser = argparse.ArgumentParser(description="YouTube Subscription Manager")
+    parser.add_argument('--fake-api', nargs='?', const='', metavar='OPTIONS',
+                        help='Use a local fake YouTube API instead of the real one, e.g. "channels=10000,latency=0.05,error_500=0.01"')
+    parser.add_argument('--metrics-dir', default='.', help='Directory for the API metrics files written at the end of a run')
     subparsers = parser.add_subparsers(dest='command', required=True)
 
     # Get command
@@ -11,6 +30,9 @@ def parse_arguments():
     get_parser.add_argument('--account', required=True, help='Account ID')
     get_parser.add_argument('--format', choices=['api', 'csv', 'html', 'json'], required=True, help='Output format')
     get_parser.add_argument('--max-ops', type=int, help='Maximum number of operations')
+    get_parser.add_argument('--resolve-channels', action='store_true', help='Look up the channel of watched videos that have none')
+    get_parser.add_argument('--workers', type=positive_int, default=1, help='Number of concurrent videos.list requests when resolving channels')
+    get_parser.add_argument('--dry-run', action='store_true', help='Only estimate the quota cost of fetching subscriptions')
 
     # Import command
     import_parser = subparsers.add_parser('import', help='Import subscriptions')
@@ -18,5 +40,49 @@ def parse_arguments():
     import_parser.add_argument('--from-account', required=True, help='Source account ID')
     import_parser.add_argument('--to-account', required=True, help='Target account ID')
     import_parser.add_argument('--max-ops', type=int, help='Maximum number of operations')
+    import_parser.add_argument('--workers', type=positive_int, default=DEFAULT_IMPORT_WORKERS, help='Number of concurrent import workers')
+    import_parser.add_argument('--rate', type=positive_float, default=DEFAULT_IMPORT_RATE, help='Maximum subscriptions.insert calls per second')
+    import_parser.add_argument('--dry-run', action='store_true', help='Only estimate the quota cost of the import')
+
+    # Refresh command
+    refresh_parser = subparsers.add_parser('refresh', help='Refresh stale channel details')
+    refresh_parser.add_argument('--account', required=True, help='Account ID')
+    refresh_parser.add_argument('--max-ops', type=int, help='Maximum number of channels to refresh')
+    refresh_parser.add_argument('--active-ttl-days', type=float, default=ACTIVE_CHANNEL_TTL_DAYS, help='Days before details of active channels go stale')
+    refresh_parser.add_argument('--dormant-ttl-days', type=float, default=DORMANT_CHANNEL_TTL_DAYS, help='Days before details of dormant channels go stale')
+    refresh_parser.add_argument('--dry-run', action='store_true', help='Only estimate the quota cost of the refresh')
+
+    # Sync command
+    sync_parser = subparsers.add_parser('sync', help='Fetch subscriptions of several accounts in parallel')
+    sync_accounts_group = sync_parser.add_mutually_exclusive_group(required=True)
+    sync_accounts_group.add_argument('--all-accounts', action='store_true', help='Sync every account with a client_secret_*.json file')
+    sync_accounts_group.add_argument('--account', action='append', help='Account to sync (repeatable)')
+    sync_parser.add_argument('--workers', type=positive_int, default=DEFAULT_SYNC_WORKERS, help='Number of accounts synced at the same time')
+    sync_parser.add_argument('--max-ops', type=int, help='Maximum number of subscriptions fetched per account')
+    sync_parser.add_argument('--replay', action='store_true', help="Apply each account's subscription changes since its previous sync to the other accounts")
+
+    # Quota command
+    quota_parser = subparsers.add_parser('quota', help='Show quota usage per day')
+    quota_parser.add_argument('--account', help='Only show usage charged to this account')
+    quota_parser.add_argument('--days', type=int, default=7, help='Number of quota days to show')
+
+    # Plan command
+    plan_parser = subparsers.add_parser('plan', help='Plan pending work over the coming quota days')
+    plan_parser.add_argument('--account', required=True, help='Account to list and refresh')
+    plan_parser.add_argument('--to-account', help='Also plan importing the subscriptions of --account into this account')
+
+    # Search command
+    search_parser = subparsers.add_parser('search', help='Full-text search over stored channels and watch history')
+    search_parser.add_argument('query', nargs='+', help='Words to search for; end a word with * to match it as a prefix')
+    search_parser.add_argument('--in', dest='scope', choices=['subscriptions', 'history', 'all'], default='all', help='What to search')
+    search_parser.add_argument('--account', help='Only show channels followed by, or videos watched on, this account')
+    search_parser.add_argument('--limit', type=int, default=20, help='Results per page')
+    search_parser.add_argument('--page', type=int, default=1, help='Page of results to show, starting at 1')
+
+    # Report command
+    report_parser = subparsers.add_parser('report', help='Show the most watched channels of an account')
+    report_parser.add_argument('--account', required=True, help='Account whose watch history to report on')
+    report_parser.add_argument('--order', choices=list(CHANNEL_REPORT_ORDERS), default='watches', help='Sort by watch count, last watch or upload rate')
+    report_parser.add_argument('--limit', type=int, default=20, help='Number of channels to show')
 
-    return parser.parse_args()
+    return parser.parse_args(argv)
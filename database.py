@@ -1,61 +1,240 @@
 import sqlite3
 import os
+import queue
+import threading
+from concurrent.futures import Future
+from datetime import datetime, timezone
 from utils import log
 
+# Keeps IN (...) lists below SQLite's host parameter limit
+SQL_VARIABLE_BATCH_SIZE = 500
+SECONDS_PER_DAY = 86400
+
+# Connection tuning applied once to every long-lived connection
+CONNECTION_PRAGMAS = (
+    "PRAGMA journal_mode = WAL",
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA cache_size = -65536",  # 64 MB page cache
+    "PRAGMA mmap_size = 268435456",  # 256 MB memory-mapped I/O
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA busy_timeout = 5000",
+)
+# Size of the per-connection prepared statement cache
+STATEMENT_CACHE_SIZE = 256
+
+# Database opened by every function called without an explicit db_name
+DEFAULT_DB_NAME = "subscriptions.db"
+_default_database = DEFAULT_DB_NAME
+
+_local = threading.local()
+_migrated_databases = set()
+_migration_lock = threading.Lock()
+# Every open connection of the process, so connections opened by pool threads can
+# be closed when the run ends
+_open_connections = set()
+_connections_lock = threading.Lock()
+
+def use_default_database(db_name):
+    # Opens db_name wherever the default database would be opened, so --fake-api runs
+    # never touch the real accounts, quota ledger or HTTP cache
+    global _default_database
+    _default_database = db_name
+
 def get_db_connection(db_name="subscriptions.db"):
-    db_path = os.path.abspath(db_name)
-    return sqlite3.connect(db_path)
+    # Connections are opened once per thread and database file and then reused.
+    # Pending schema migrations run the first time a process opens a database.
+    db_path = os.path.abspath(_default_database if db_name == DEFAULT_DB_NAME else db_name)
+    connections = _local.__dict__.setdefault('connections', {})
+    conn = connections.get(db_path)
+    if conn is not None and is_connection_open(conn):
+        return conn
 
-def update_database_schema(db_name="subscriptions.db"):
-    conn = get_db_connection(db_name)
-    cursor = conn.cursor()
+    # Each connection is only used by the thread that opened it, but may be closed by
+    # another one in close_db_connections(all_threads=True)
+    conn = sqlite3.connect(db_path, cached_statements=STATEMENT_CACHE_SIZE, check_same_thread=False)
+    for pragma in CONNECTION_PRAGMAS:
+        conn.execute(pragma)
+
+    with _migration_lock:
+        if db_path not in _migrated_databases:
+            if not apply_migrations(conn):
+                conn.close()
+                # Carrying on with a half-migrated schema would fail in less obvious ways
+                raise sqlite3.DatabaseError(f"The schema of {db_path} could not be migrated.")
+            _migrated_databases.add(db_path)
+    connections[db_path] = conn
+    with _connections_lock:
+        _open_connections.add(conn)
+    return conn
+
+def is_connection_open(conn):
     try:
-        # Create accounts table
-        cursor.execute('''CREATE TABLE IF NOT EXISTS accounts
-                          (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                           name TEXT UNIQUE NOT NULL)''')
-        
-        # Check if the subscriptions table exists and update its schema
-        cursor.execute('''CREATE TABLE IF NOT EXISTS subscriptions 
-                            (channel_id TEXT PRIMARY KEY, 
-                            title TEXT, 
-                            description TEXT, 
-                            published_at TEXT, 
-                            created_at TEXT,
-                            total_videos TEXT,
-                            last_upload_date TEXT,
-                            upload_frequency TEXT,
-                            account_id_1 INTEGER,
-                            account_id_2 INTEGER,
-                            FOREIGN KEY (account_id_1) REFERENCES accounts(id),
-                            FOREIGN KEY (account_id_2) REFERENCES accounts(id))''')
-
-        # Check if the watch_history table exists
-        cursor.execute('''CREATE TABLE IF NOT EXISTS watch_history 
-                            (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                            title TEXT,
-                            url TEXT,
-                            watch_time TEXT,
-                            video_id TEXT,
-                            channel_id TEXT,
-                            account_id INTEGER,
-                            FOREIGN KEY (account_id) REFERENCES accounts(id))''')
-
-        # Create problematic_subscriptions table
-        cursor.execute('''CREATE TABLE IF NOT EXISTS problematic_subscriptions
-                          (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                           channel_id TEXT,
-                           account_id INTEGER,
-                           reason TEXT,
-                           flagged_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                           FOREIGN KEY (account_id) REFERENCES accounts(id),
-                           UNIQUE(channel_id, account_id))''')
+        conn.total_changes
+        return True
+    except sqlite3.ProgrammingError:
+        return False
 
-        conn.commit()
-    except sqlite3.Error as e:
-        log(f"An error occurred while updating the database schema: {e}")
-    finally:
-        conn.close()
+def close_db_connections(all_threads=False):
+    # Close every connection opened by the calling thread, or by any thread. Threads
+    # whose connection was closed open a new one on their next call.
+    connections = _local.__dict__.get('connections', {})
+    with _connections_lock:
+        if all_threads:
+            closing = list(_open_connections)
+        else:
+            closing = list(connections.values())
+        _open_connections.difference_update(closing)
+    for conn in closing:
+        if is_connection_open(conn):
+            conn.close()
+    connections.clear()
+
+class DatabaseWriter:
+    # Runs write jobs one at a time on a dedicated thread so that concurrent
+    # workers never contend for SQLite's write lock. submit() returns a Future.
+    def __init__(self, db_name="subscriptions.db"):
+        self.db_name = db_name
+        self.jobs = queue.Queue()
+        self.thread = threading.Thread(target=self.run, name="db-writer", daemon=True)
+        self.thread.start()
+
+    def submit(self, function, *args, **kwargs):
+        future = Future()
+        self.jobs.put((future, function, args, kwargs))
+        return future
+
+    def run(self):
+        get_db_connection(self.db_name)
+        try:
+            while True:
+                job = self.jobs.get()
+                if job is None:
+                    break
+                future, function, args, kwargs = job
+                if not future.set_running_or_notify_cancel():
+                    continue
+                try:
+                    future.set_result(function(*args, **kwargs))
+                except Exception as e:
+                    future.set_exception(e)
+        finally:
+            close_db_connections()
+
+    def close(self):
+        # Finish the queued jobs, then stop the writer thread
+        self.jobs.put(None)
+        self.thread.join()
+
+_shared_writer = None
+
+def set_shared_writer(writer):
+    # While a writer is shared, run_write() sends writes from every thread to it.
+    # Pass None before closing the writer.
+    global _shared_writer
+    _shared_writer = writer
+
+def run_write(function, *args, wait=True, **kwargs):
+    # Runs a write job on the shared writer if there is one, otherwise on the calling
+    # thread. With wait=False the job is only queued and None is returned.
+    writer = _shared_writer
+    if writer is None or threading.current_thread() is writer.thread:
+        return function(*args, **kwargs)
+    future = writer.submit(function, *args, **kwargs)
+    return future.result() if wait else None
+
+def update_database_schema(db_name="subscriptions.db"):
+    get_db_connection(db_name)
+
+def apply_migrations(conn):
+    # PRAGMA user_version records how many entries of MIGRATIONS have been applied.
+    # Returns False if a migration failed; it is rolled back and later ones are not run.
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    for target_version, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+        cursor = conn.cursor()
+        try:
+            cursor.execute("BEGIN")
+            migration(cursor)
+            cursor.execute(f"PRAGMA user_version = {target_version}")
+            conn.commit()
+            log(f"Database schema migrated to version {target_version}.")
+        except sqlite3.Error as e:
+            conn.rollback()
+            log(f"An error occurred while updating the database schema: {e}")
+            return False
+    return True
+
+def create_initial_schema(cursor):
+    # Create accounts table
+    cursor.execute('''CREATE TABLE IF NOT EXISTS accounts
+                      (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                       name TEXT UNIQUE NOT NULL)''')
+    
+    # Channel metadata, one row per channel regardless of how many accounts follow it
+    cursor.execute('''CREATE TABLE IF NOT EXISTS channels 
+                        (channel_id TEXT PRIMARY KEY, 
+                        title TEXT, 
+                        description TEXT, 
+                        published_at TEXT, 
+                        created_at TEXT,
+                        total_videos TEXT,
+                        last_upload_date TEXT,
+                        upload_frequency TEXT)''')
+
+    # Account membership, one row per (account, channel) pair
+    cursor.execute('''CREATE TABLE IF NOT EXISTS account_subscriptions
+                        (account_id INTEGER NOT NULL,
+                        channel_id TEXT NOT NULL,
+                        PRIMARY KEY (account_id, channel_id),
+                        FOREIGN KEY (account_id) REFERENCES accounts(id),
+                        FOREIGN KEY (channel_id) REFERENCES channels(channel_id)) WITHOUT ROWID''')
+    cursor.execute('''CREATE INDEX IF NOT EXISTS idx_account_subscriptions_channel
+                      ON account_subscriptions (channel_id, account_id)''')
+
+    migrate_legacy_subscriptions(cursor)
+
+    # Check if the watch_history table exists
+    cursor.execute('''CREATE TABLE IF NOT EXISTS watch_history 
+                        (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        title TEXT,
+                        url TEXT,
+                        watch_time TEXT,
+                        video_id TEXT,
+                        channel_id TEXT,
+                        account_id INTEGER,
+                        FOREIGN KEY (account_id) REFERENCES accounts(id))''')
+
+    # Create problematic_subscriptions table
+    cursor.execute('''CREATE TABLE IF NOT EXISTS problematic_subscriptions
+                      (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                       channel_id TEXT,
+                       account_id INTEGER,
+                       reason TEXT,
+                       flagged_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                       FOREIGN KEY (account_id) REFERENCES accounts(id),
+                       UNIQUE(channel_id, account_id))''')
+
+def migrate_legacy_subscriptions(cursor):
+    # Older databases kept membership in the account_id_1/account_id_2 columns of a
+    # single subscriptions table. Move those rows into channels/account_subscriptions.
+    cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'subscriptions'")
+    if cursor.fetchone() is None:
+        return
+
+    log("Migrating legacy subscriptions table to channels/account_subscriptions...")
+    cursor.execute('''INSERT OR IGNORE INTO channels 
+                      (channel_id, title, description, published_at, created_at, 
+                       total_videos, last_upload_date, upload_frequency) 
+                      SELECT channel_id, title, description, published_at, created_at, 
+                             total_videos, last_upload_date, upload_frequency 
+                      FROM subscriptions''')
+    cursor.execute('''INSERT OR IGNORE INTO account_subscriptions (account_id, channel_id) 
+                      SELECT account_id_1, channel_id FROM subscriptions WHERE account_id_1 IS NOT NULL 
+                      UNION ALL 
+                      SELECT account_id_2, channel_id FROM subscriptions WHERE account_id_2 IS NOT NULL''')
+    cursor.execute("SELECT COUNT(*) FROM subscriptions")
+    migrated = cursor.fetchone()[0]
+    cursor.execute("DROP TABLE subscriptions")
+    log(f"Migrated {migrated} legacy subscription rows.")
 
 def get_or_create_account(account_name, db_name="subscriptions.db"):
     conn = get_db_connection(db_name)
@@ -67,29 +246,104 @@ def get_or_create_account(account_name, db_name="subscriptions.db"):
         conn.commit()
         return account_id
     except sqlite3.Error as e:
+        conn.rollback()
         log(f"An error occurred while getting or creating account: {e}")
         return None
-    finally:
-        conn.close()
 
 def get_existing_subscriptions(account_id, db_name="subscriptions.db"):
-    update_database_schema(db_name)
     conn = get_db_connection(db_name)
     cursor = conn.cursor()
     existing_subs = set()
     subs = []
     try:
-        cursor.execute("SELECT channel_id, title FROM subscriptions WHERE account_id_1 = ? OR account_id_2 = ?", (account_id, account_id))
+        cursor.execute('''SELECT channels.channel_id, channels.title 
+                          FROM account_subscriptions 
+                          JOIN channels ON channels.channel_id = account_subscriptions.channel_id 
+                          WHERE account_subscriptions.account_id = ?''', (account_id,))
         for row in cursor.fetchall():
             existing_subs.add(row[0])
             subs.append({'channel_id': row[0], 'title': row[1]})
     except sqlite3.Error as e:
         log(f"An error occurred while fetching existing subscriptions: {e}")
-    finally:
-        conn.close()
     return existing_subs, subs
 
-def store_subscriptions_in_db(subscriptions, account_id, source="api", db_name="subscriptions.db"):
+def count_account_subscriptions(account_id, db_name="subscriptions.db"):
+    conn = get_db_connection(db_name)
+    try:
+        return conn.execute("SELECT COUNT(*) FROM account_subscriptions WHERE account_id = ?", (account_id,)).fetchone()[0]
+    except sqlite3.Error as e:
+        log(f"An error occurred while counting subscriptions: {e}")
+        return 0
+
+# Import failures that retrying cannot fix. Only these keep a channel out of later
+# imports; quota, server and network errors are retried by the next import.
+PERMANENT_IMPORT_FAILURES = ('channel_not_found',)
+# Channels the source account follows, the target account does not, and that have not
+# permanently failed to import from the source account. Both NOT EXISTS probes are
+# primary key or unique index lookups, so the diff never leaves SQLite.
+IMPORT_CANDIDATES_WHERE = f'''source.account_id = :source
+                             AND NOT EXISTS (SELECT 1 FROM account_subscriptions AS target 
+                                             WHERE target.account_id = :target AND target.channel_id = source.channel_id)
+                             AND NOT EXISTS (SELECT 1 FROM problematic_subscriptions AS flagged 
+                                             WHERE flagged.channel_id = source.channel_id AND flagged.account_id = :source 
+                                               AND flagged.reason IN ({", ".join(map(repr, PERMANENT_IMPORT_FAILURES))}))'''
+# Keyset condition for candidates after a given one, in (priority DESC, channel_id) order
+IMPORT_CANDIDATES_AFTER = '''AND source.priority <= :priority 
+                             AND (source.priority < :priority OR source.channel_id > :after)'''
+# Candidates fetched per query while streaming the import diff
+IMPORT_CANDIDATE_PAGE_SIZE = 500
+
+def count_import_candidates(source_account_id, target_account_id, after=None, db_name="subscriptions.db"):
+    conn = get_db_connection(db_name)
+    try:
+        parameters = import_candidate_parameters(conn, source_account_id, target_account_id, after)
+        return conn.execute(f'''SELECT COUNT(*) FROM account_subscriptions AS source 
+                                WHERE {IMPORT_CANDIDATES_WHERE} 
+                                {IMPORT_CANDIDATES_AFTER if after is not None else ''}''', parameters).fetchone()[0]
+    except sqlite3.Error as e:
+        log(f"An error occurred while counting import candidates: {e}")
+        return 0
+
+def iter_import_candidates(source_account_id, target_account_id, after=None, page_size=IMPORT_CANDIDATE_PAGE_SIZE,
+                           db_name="subscriptions.db"):
+    # Yields {'channel_id', 'title'} for every import candidate, most watched by the source
+    # account first (see add_watch_based_import_priority).
+    # Each page is its own keyset query, so no read is held open while the caller
+    # commits import results on the same connection.
+    conn = get_db_connection(db_name)
+    while True:
+        try:
+            parameters = import_candidate_parameters(conn, source_account_id, target_account_id, after)
+            rows = conn.execute(f'''SELECT source.channel_id, channels.title, source.priority 
+                                    FROM account_subscriptions AS source 
+                                    LEFT JOIN channels ON channels.channel_id = source.channel_id 
+                                    WHERE {IMPORT_CANDIDATES_WHERE} 
+                                    {IMPORT_CANDIDATES_AFTER if after is not None else ''}
+                                    ORDER BY source.priority DESC, source.channel_id 
+                                    LIMIT :limit''', dict(parameters, limit=page_size)).fetchall()
+        except sqlite3.Error as e:
+            log(f"An error occurred while fetching import candidates: {e}")
+            return
+        for channel_id, title, _ in rows:
+            yield {'channel_id': channel_id, 'title': title}
+        if len(rows) < page_size:
+            return
+        after = rows[-1][0]
+
+def import_candidate_parameters(conn, source_account_id, target_account_id, after):
+    # Candidates are resumed after a channel ID; its current priority places it in the order
+    parameters = {'source': source_account_id, 'target': target_account_id, 'after': after, 'priority': 0}
+    if after is not None:
+        row = conn.execute("SELECT priority FROM account_subscriptions WHERE account_id = ? AND channel_id = ?",
+                           (source_account_id, after)).fetchone()
+        if row is not None:
+            parameters['priority'] = row[0]
+    return parameters
+
+def store_subscriptions_in_db(subscriptions, account_id, source="api", db_name="subscriptions.db", checkpoint=None,
+                              snapshot_id=None):
+    # checkpoint: keyword arguments for write_checkpoint, committed with the subscriptions
+    # snapshot_id: open subscription snapshot the listed channels are added to
     log(f"Storing {len(subscriptions)} subscriptions for account ID {account_id}")
     conn = get_db_connection(db_name)
     cursor = conn.cursor()
@@ -97,55 +351,69 @@ def store_subscriptions_in_db(subscriptions, account_id, source="api", db_name="
     new_channels = []
     
     try:
-        conn.execute("BEGIN")
-        
-        for sub in subscriptions:
-            try:
-                # Check if the subscription already exists
-                cursor.execute("SELECT account_id_1, account_id_2 FROM subscriptions WHERE channel_id = ?", (sub['channel_id'],))
-                existing = cursor.fetchone()
-                
-                if existing:
-                    account_id_1, account_id_2 = existing
-                    if account_id not in (account_id_1, account_id_2):
-                        # Add the new account_id to the correct column
-                        if account_id_1 is None:
-                            account_id_1 = account_id
-                        elif account_id_2 is None:
-                            account_id_2 = account_id
-                        # If both slots are filled, we don't change anything
-                    
-                    # Ensure account_id is in the correct column
-                    if account_id_1 is not None and account_id_2 is not None and account_id_1 > account_id_2:
-                        account_id_1, account_id_2 = account_id_2, account_id_1
-                    
-                    cursor.execute('''UPDATE subscriptions 
-                                      SET title = ?, description = ?, published_at = ?, 
-                                          created_at = ?, total_videos = ?, last_upload_date = ?, 
-                                          upload_frequency = ?, account_id_1 = ?, account_id_2 = ?
-                                      WHERE channel_id = ?''',
-                                   (sub['title'], sub.get('description', 'N/A'),
-                                    sub.get('published_at', 'N/A'), sub.get('created_at', 'N/A'),
-                                    sub.get('total_videos', 'N/A'), sub.get('last_upload_date', 'N/A'),
-                                    sub.get('upload_frequency', 'N/A'), account_id_1, account_id_2,
-                                    sub['channel_id']))
-                    updated_channels.append(sub['channel_id'])
-                    log(f"Updated existing channel: {sub['title']} ({sub['channel_id']})")
-                else:
-                    # New subscription
-                    cursor.execute('''INSERT INTO subscriptions 
-                                      (channel_id, title, description, published_at, created_at, 
-                                       total_videos, last_upload_date, upload_frequency, account_id_1) 
-                                      VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)''',
-                                   (sub['channel_id'], sub['title'], sub.get('description', 'N/A'),
-                                    sub.get('published_at', 'N/A'), sub.get('created_at', 'N/A'),
-                                    sub.get('total_videos', 'N/A'), sub.get('last_upload_date', 'N/A'),
-                                    sub.get('upload_frequency', 'N/A'), account_id))
-                    new_channels.append(sub['channel_id'])
-                    log(f"Added new channel: {sub['title']} ({sub['channel_id']})")
-                
-            except sqlite3.Error as e:
-                log(f"Error inserting subscription {sub['channel_id']}: {e}")
+        # Take the write lock up front: a deferred transaction that reads before writing
+        # fails with "database is locked" instead of waiting if another connection commits
+        conn.execute("BEGIN IMMEDIATE")
+
+        # Stage the whole batch, then merge it with a single upsert statement.
+        # Fields the caller did not supply stay NULL and keep the stored value.
+        cursor.execute('''CREATE TEMP TABLE IF NOT EXISTS staged_subscriptions
+                            (position INTEGER PRIMARY KEY,
+                            channel_id TEXT,
+                            title TEXT,
+                            description TEXT,
+                            published_at TEXT,
+                            created_at TEXT,
+                            total_videos TEXT,
+                            last_upload_date TEXT,
+                            upload_frequency TEXT,
+                            details_fetched_at TEXT)''')
+        cursor.execute("DELETE FROM staged_subscriptions")
+        cursor.executemany('''INSERT INTO staged_subscriptions 
+                              (position, channel_id, title, description, published_at, created_at, 
+                               total_videos, last_upload_date, upload_frequency, details_fetched_at) 
+                              VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+                           [(position, sub['channel_id'], sub.get('title'), sub.get('description'),
+                             sub.get('published_at'), sub.get('created_at'),
+                             sub.get('total_videos'), sub.get('last_upload_date'),
+                             sub.get('upload_frequency'), sub.get('details_fetched_at'))
+                            for position, sub in enumerate(subscriptions)])
+
+        cursor.execute('''SELECT staged.channel_id, channels.channel_id IS NOT NULL
+                          FROM staged_subscriptions AS staged
+                          LEFT JOIN channels ON channels.channel_id = staged.channel_id
+                          ORDER BY staged.position''')
+        seen = set()
+        for channel_id, exists in cursor.fetchall():
+            if exists or channel_id in seen:
+                updated_channels.append(channel_id)
+            else:
+                new_channels.append(channel_id)
+            seen.add(channel_id)
+
+        cursor.execute('''INSERT INTO channels 
+                          (channel_id, title, description, published_at, created_at, 
+                           total_videos, last_upload_date, upload_frequency, details_fetched_at) 
+                          SELECT channel_id, title, description, published_at, created_at, 
+                                 total_videos, last_upload_date, upload_frequency, details_fetched_at 
+                          FROM staged_subscriptions WHERE true ORDER BY position
+                          ON CONFLICT(channel_id) DO UPDATE 
+                          SET title = COALESCE(excluded.title, channels.title), 
+                              description = COALESCE(excluded.description, channels.description), 
+                              published_at = COALESCE(excluded.published_at, channels.published_at), 
+                              created_at = COALESCE(excluded.created_at, channels.created_at), 
+                              total_videos = COALESCE(excluded.total_videos, channels.total_videos), 
+                              last_upload_date = COALESCE(excluded.last_upload_date, channels.last_upload_date), 
+                              upload_frequency = COALESCE(excluded.upload_frequency, channels.upload_frequency), 
+                              details_fetched_at = COALESCE(excluded.details_fetched_at, channels.details_fetched_at)''')
+        cursor.execute('''INSERT OR IGNORE INTO account_subscriptions (account_id, channel_id) 
+                          SELECT ?, channel_id FROM staged_subscriptions''', (account_id,))
+        if snapshot_id is not None:
+            cursor.execute('''INSERT OR IGNORE INTO snapshot_channels (snapshot_id, channel_id) 
+                              SELECT ?, channel_id FROM staged_subscriptions''', (snapshot_id,))
+        cursor.execute("DELETE FROM staged_subscriptions")
+        if checkpoint:
+            write_checkpoint(cursor, **checkpoint)
         
         conn.commit()
         log(f"Database transaction committed. Updated {len(updated_channels)} channels, added {len(new_channels)} new channels.")
@@ -153,34 +421,212 @@ def store_subscriptions_in_db(subscriptions, account_id, source="api", db_name="
         log(f"An error occurred while storing subscriptions: {e}")
         conn.rollback()
         log("Changes rolled back due to error.")
-    finally:
-        conn.close()
+        updated_channels, new_channels = [], []
     
     return updated_channels + new_channels
 
+def get_stale_channels(account_id, active_ttl_days, dormant_ttl_days, active_window_days, limit=None, db_name="subscriptions.db"):
+    # Channels whose details are older than their TTL, most overdue first. A channel
+    # counts as active if it uploaded within the last active_window_days. Both epochs
+    # are read from idx_channels_refresh instead of being recomputed for every row.
+    conn = get_db_connection(db_name)
+    now = datetime.now(timezone.utc).timestamp()
+    active_cutoff = int(now - active_window_days * SECONDS_PER_DAY)
+    active_expiry = int(now - active_ttl_days * SECONDS_PER_DAY)
+    dormant_expiry = int(now - dormant_ttl_days * SECONDS_PER_DAY)
+    try:
+        cursor = conn.execute('''SELECT channel_id, title FROM
+                                 (SELECT channels.channel_id, channels.title, channels.details_fetched_epoch,
+                                         coalesce(channels.last_upload_epoch >= ?, 0) AS active
+                                  FROM account_subscriptions
+                                  JOIN channels INDEXED BY idx_channels_refresh
+                                       ON channels.channel_id = account_subscriptions.channel_id
+                                  WHERE account_subscriptions.account_id = ?)
+                                 WHERE details_fetched_epoch IS NULL
+                                    OR details_fetched_epoch < CASE WHEN active THEN ? ELSE ? END
+                                 ORDER BY details_fetched_epoch IS NOT NULL,
+                                          details_fetched_epoch + CASE WHEN active THEN ? ELSE ? END
+                                 LIMIT ?''',
+                              (active_cutoff, account_id, active_expiry, dormant_expiry,
+                               active_ttl_days * SECONDS_PER_DAY, dormant_ttl_days * SECONDS_PER_DAY,
+                               -1 if limit is None else limit))
+        return [{'channel_id': row[0], 'title': row[1]} for row in cursor.fetchall()]
+    except sqlite3.Error as e:
+        log(f"An error occurred while selecting stale channels: {e}")
+        return []
+
+def update_channel_details(details, db_name="subscriptions.db"):
+    # details maps channel ID to the dict returned by channel_details.get_channels_details
+    conn = get_db_connection(db_name)
+    try:
+        with conn:
+            conn.executemany('''UPDATE channels 
+                                SET created_at = ?, total_videos = ?, last_upload_date = ?, 
+                                    upload_frequency = ?, details_fetched_at = ? 
+                                WHERE channel_id = ?''',
+                             [(d['created_at'], d['total_videos'], d['last_upload_date'],
+                               d['upload_frequency'], d['details_fetched_at'], channel_id)
+                              for channel_id, d in details.items()])
+        log(f"Refreshed details for {len(details)} channels.")
+    except sqlite3.Error as e:
+        log(f"An error occurred while updating channel details: {e}")
+
+def mark_channels_fetched(channel_ids, fetched_at, db_name="subscriptions.db"):
+    # Stamps channels the API returned no details for, keeping what is already stored
+    conn = get_db_connection(db_name)
+    try:
+        with conn:
+            conn.executemany("UPDATE channels SET details_fetched_at = ? WHERE channel_id = ?",
+                             [(fetched_at, channel_id) for channel_id in channel_ids])
+    except sqlite3.Error as e:
+        log(f"An error occurred while stamping channel details: {e}")
+
+def add_account_subscriptions(account_id, channel_ids, db_name="subscriptions.db"):
+    # Link already-known channels to an account without touching their metadata
+    conn = get_db_connection(db_name)
+    try:
+        with conn:
+            conn.executemany("INSERT OR IGNORE INTO account_subscriptions (account_id, channel_id) VALUES (?, ?)",
+                             [(account_id, channel_id) for channel_id in channel_ids])
+    except sqlite3.Error as e:
+        log(f"An error occurred while linking subscriptions to account ID {account_id}: {e}")
+
 def store_watch_history_in_db(watch_history, account_id, db_name="subscriptions.db"):
     log(f"Storing {len(watch_history)} watch history items for account ID {account_id} in {db_name}...")
-    update_database_schema(db_name)  # Ensure the schema is up to date
     conn = get_db_connection(db_name)
     cursor = conn.cursor()
     
     try:
-        cursor.executemany('''INSERT OR REPLACE INTO watch_history 
+        # IMMEDIATE keeps other writers out between reading the last ID and inserting,
+        # so the rows above it are exactly the ones inserted here
+        conn.execute("BEGIN IMMEDIATE")
+        last_id = cursor.execute("SELECT coalesce(MAX(id), 0) FROM watch_history").fetchone()[0]
+        # Rows already stored are skipped by the (account_id, video_id, watch_time) unique index
+        cursor.executemany('''INSERT OR IGNORE INTO watch_history 
                               (title, url, watch_time, video_id, channel_id, account_id) 
                               VALUES (?, ?, ?, ?, ?, ?)''', 
                            [(item['title'], item['url'], item['watch_time'], 
                              item['video_id'], item['channel_id'], account_id) for item in watch_history])
+        inserted = cursor.rowcount
+        if inserted > 0:
+            merge_channel_statistics(cursor, '''SELECT account_id, channel_id, watched_epoch 
+                                                FROM watch_history WHERE id > ?''', (last_id,))
         
         conn.commit()
-        log(f"Watch history for account ID {account_id} stored in database.")
+        log(f"Watch history for account ID {account_id} stored in database. {inserted} new, {len(watch_history) - inserted} already known.")
+        return inserted
     except sqlite3.Error as e:
+        conn.rollback()
         log(f"An error occurred while storing watch history: {e}")
-    finally:
-        conn.close()
+        return 0
+
+def merge_channel_statistics(cursor, watches, parameters=()):
+    # Folds watches (a query yielding account_id, channel_id, watched_epoch) into
+    # channel_statistics. Callers pass only watches that were not counted before:
+    # new rows, or rows that just got their channel.
+    cursor.execute(f'''INSERT INTO channel_statistics (account_id, channel_id, watch_count, first_watched, last_watched) 
+                       SELECT account_id, channel_id, COUNT(*), MIN(watched_epoch), MAX(watched_epoch) 
+                       FROM ({watches}) 
+                       WHERE account_id IS NOT NULL AND channel_id IS NOT NULL 
+                       GROUP BY account_id, channel_id 
+                       ON CONFLICT(account_id, channel_id) DO UPDATE SET 
+                           watch_count = watch_count + excluded.watch_count, 
+                           first_watched = min(coalesce(first_watched, excluded.first_watched), 
+                                               coalesce(excluded.first_watched, first_watched)), 
+                           last_watched = max(coalesce(last_watched, excluded.last_watched), 
+                                              coalesce(excluded.last_watched, last_watched))''', parameters)
+
+def get_cached_videos(video_ids, db_name="subscriptions.db"):
+    # Returns {video_id: row} for the IDs already in the videos cache; unavailable
+    # videos are cached too, with a NULL channel_id
+    conn = get_db_connection(db_name)
+    cached = {}
+    try:
+        for start in range(0, len(video_ids), SQL_VARIABLE_BATCH_SIZE):
+            batch = video_ids[start:start + SQL_VARIABLE_BATCH_SIZE]
+            cursor = conn.execute(f'''SELECT video_id, channel_id, channel_title, title FROM videos
+                                      WHERE video_id IN ({",".join("?" * len(batch))})''', batch)
+            for row in cursor:
+                cached[row[0]] = {'video_id': row[0], 'channel_id': row[1], 'channel_title': row[2], 'video_title': row[3]}
+        return cached
+    except sqlite3.Error as e:
+        log(f"An error occurred while reading the video cache: {e}")
+        return cached
+
+def store_videos(videos, unavailable_ids=(), db_name="subscriptions.db"):
+    conn = get_db_connection(db_name)
+    fetched_at = datetime.now(timezone.utc).isoformat()
+    try:
+        with conn:
+            conn.executemany('''INSERT OR REPLACE INTO videos (video_id, channel_id, channel_title, title, fetched_at)
+                                VALUES (?, ?, ?, ?, ?)''',
+                             [(v['video_id'], v['channel_id'], v['channel_title'], v['video_title'], fetched_at) for v in videos] +
+                             [(video_id, None, None, None, fetched_at) for video_id in unavailable_ids])
+    except sqlite3.Error as e:
+        log(f"An error occurred while storing videos: {e}")
+
+def get_unresolved_video_ids(account_id, db_name="subscriptions.db"):
+    # Distinct watched videos without a channel that have never been looked up
+    conn = get_db_connection(db_name)
+    try:
+        cursor = conn.execute('''SELECT DISTINCT video_id FROM watch_history
+                                 WHERE account_id = ? AND channel_id IS NULL AND video_id IS NOT NULL
+                                   AND video_id NOT IN (SELECT video_id FROM videos)''', (account_id,))
+        return [row[0] for row in cursor]
+    except sqlite3.Error as e:
+        log(f"An error occurred while reading unresolved watch history: {e}")
+        return []
+
+def fill_watch_history_channels(account_id, db_name="subscriptions.db"):
+    # Copy channels from the videos cache onto watch history rows that lack one. The
+    # rows are counted in channel_statistics first, in the same transaction.
+    conn = get_db_connection(db_name)
+    cursor = conn.cursor()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        merge_channel_statistics(cursor, '''SELECT watch_history.account_id, videos.channel_id, watch_history.watched_epoch 
+                                            FROM watch_history JOIN videos ON watch_history.video_id = videos.video_id 
+                                            WHERE watch_history.account_id = ? 
+                                              AND watch_history.channel_id IS NULL 
+                                              AND videos.channel_id IS NOT NULL''', (account_id,))
+        filled = cursor.execute('''UPDATE watch_history SET channel_id = videos.channel_id
+                                   FROM videos
+                                   WHERE watch_history.video_id = videos.video_id
+                                     AND watch_history.account_id = ?
+                                     AND watch_history.channel_id IS NULL
+                                     AND videos.channel_id IS NOT NULL''', (account_id,)).rowcount
+        conn.commit()
+        return filled
+    except sqlite3.Error as e:
+        conn.rollback()
+        log(f"An error occurred while filling watch history channels: {e}")
+        return 0
+
+def get_watch_history_high_water_mark(account_id, db_name="subscriptions.db"):
+    # Newest watch time up to which the account's history is known to be complete
+    conn = get_db_connection(db_name)
+    try:
+        row = conn.execute("SELECT synced_until FROM watch_history_sync WHERE account_id = ?", (account_id,)).fetchone()
+        return row[0] if row else None
+    except sqlite3.Error as e:
+        log(f"An error occurred while reading the watch history high-water mark: {e}")
+        return None
+
+def set_watch_history_high_water_mark(account_id, synced_until, db_name="subscriptions.db"):
+    conn = get_db_connection(db_name)
+    try:
+        with conn:
+            conn.execute('''INSERT INTO watch_history_sync (account_id, synced_until, updated_at) 
+                            VALUES (?, ?, CURRENT_TIMESTAMP) 
+                            ON CONFLICT(account_id) DO UPDATE 
+                            SET synced_until = excluded.synced_until, updated_at = excluded.updated_at''',
+                         (account_id, synced_until))
+        log(f"Watch history for account ID {account_id} is complete up to {synced_until}.")
+    except sqlite3.Error as e:
+        log(f"An error occurred while saving the watch history high-water mark: {e}")
 
 def get_last_watch_history_item(account_id, db_name="subscriptions.db"):
     log(f"Retrieving last watch history item for account ID {account_id}...")
-    update_database_schema(db_name)  # Ensure the schema is up to date
     conn = get_db_connection(db_name)
     cursor = conn.cursor()
     
@@ -209,8 +655,286 @@ def get_last_watch_history_item(account_id, db_name="subscriptions.db"):
     except sqlite3.Error as e:
         log(f"An error occurred while retrieving the last watch history item: {e}")
         return None
-    finally:
-        conn.close()
+
+def record_import_results(target_account_id, source_account_id, linked_channel_ids, failures, checkpoint=None, db_name="subscriptions.db"):
+    # One transaction per batch of import results: links for subscribed channels,
+    # flags for failed ones and the position to resume from
+    conn = get_db_connection(db_name)
+    cursor = conn.cursor()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        cursor.executemany("INSERT OR IGNORE INTO account_subscriptions (account_id, channel_id) VALUES (?, ?)",
+                           [(target_account_id, channel_id) for channel_id in linked_channel_ids])
+        cursor.executemany('''INSERT OR REPLACE INTO problematic_subscriptions (channel_id, account_id, reason) 
+                              VALUES (?, ?, ?)''',
+                           [(channel_id, source_account_id, reason) for channel_id, reason in failures])
+        if checkpoint:
+            write_checkpoint(cursor, **checkpoint)
+        conn.commit()
+        return True
+    except sqlite3.Error as e:
+        conn.rollback()
+        log(f"An error occurred while recording import results: {e}")
+        return False
+
+def get_checkpoint(operation, account_id, db_name="subscriptions.db"):
+    conn = get_db_connection(db_name)
+    try:
+        row = conn.execute('''SELECT page_token, page_offset, processed, last_item FROM checkpoints 
+                              WHERE operation = ? AND account_id = ?''', (operation, account_id)).fetchone()
+    except sqlite3.Error as e:
+        log(f"An error occurred while reading the checkpoint: {e}")
+        return None
+    if row is None:
+        return None
+    return {'page_token': row[0], 'page_offset': row[1], 'processed': row[2], 'last_item': row[3]}
+
+def write_checkpoint(cursor, operation, account_id, page_token=None, page_offset=0, processed=0, last_item=None):
+    # Runs inside the caller's transaction, so progress and data commit together
+    cursor.execute('''INSERT INTO checkpoints (operation, account_id, page_token, page_offset, processed, last_item, updated_at)
+                      VALUES (?, ?, ?, ?, ?, ?, ?)
+                      ON CONFLICT(operation, account_id) DO UPDATE 
+                      SET page_token = excluded.page_token, page_offset = excluded.page_offset, 
+                          processed = excluded.processed, last_item = excluded.last_item, 
+                          updated_at = excluded.updated_at''',
+                   (operation, account_id, page_token, page_offset, processed, last_item,
+                    datetime.now(timezone.utc).isoformat()))
+
+def clear_checkpoint(operation, account_id, db_name="subscriptions.db"):
+    conn = get_db_connection(db_name)
+    try:
+        with conn:
+            conn.execute("DELETE FROM checkpoints WHERE operation = ? AND account_id = ?", (operation, account_id))
+    except sqlite3.Error as e:
+        log(f"An error occurred while clearing the checkpoint: {e}")
+
+def open_snapshot(account_id, resume=False, db_name="subscriptions.db"):
+    # A snapshot collects the channels of one complete listing, which may span several
+    # resumed runs. Resuming continues the open snapshot; a fresh listing discards it.
+    conn = get_db_connection(db_name)
+    try:
+        row = conn.execute('''SELECT id FROM subscription_snapshots 
+                              WHERE account_id = ? AND completed_at IS NULL ORDER BY id DESC LIMIT 1''',
+                           (account_id,)).fetchone()
+        if resume:
+            return row[0] if row is not None else None
+        with conn:
+            if row is not None:
+                conn.execute("DELETE FROM snapshot_channels WHERE snapshot_id = ?", (row[0],))
+                conn.execute("DELETE FROM subscription_snapshots WHERE id = ?", (row[0],))
+            return conn.execute("INSERT INTO subscription_snapshots (account_id, started_at) VALUES (?, ?)",
+                                (account_id, datetime.now(timezone.utc).isoformat())).lastrowid
+    except sqlite3.Error as e:
+        log(f"An error occurred while opening a subscription snapshot: {e}")
+        return None
+
+def complete_snapshot(snapshot_id, db_name="subscriptions.db"):
+    # Diffs the snapshot against the previous complete one of the account, records the
+    # added and removed channels as deltas and unlinks the removed ones. Only the latest
+    # membership is kept; older snapshots survive as their deltas. The first snapshot of
+    # an account is a baseline without deltas.
+    conn = get_db_connection(db_name)
+    cursor = conn.cursor()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        account_id = cursor.execute("SELECT account_id FROM subscription_snapshots WHERE id = ?", (snapshot_id,)).fetchone()[0]
+        previous = cursor.execute('''SELECT MAX(id) FROM subscription_snapshots 
+                                     WHERE account_id = ? AND completed_at IS NOT NULL AND id < ?''',
+                                  (account_id, snapshot_id)).fetchone()[0]
+        if previous is not None:
+            parameters = {'snapshot': snapshot_id, 'previous': previous, 'account': account_id}
+            cursor.execute('''INSERT INTO subscription_deltas (snapshot_id, channel_id, change) 
+                              SELECT :snapshot, current.channel_id, 'added' FROM snapshot_channels AS current 
+                              WHERE current.snapshot_id = :snapshot 
+                                AND NOT EXISTS (SELECT 1 FROM snapshot_channels AS earlier 
+                                                WHERE earlier.snapshot_id = :previous AND earlier.channel_id = current.channel_id)''',
+                           parameters)
+            cursor.execute('''INSERT INTO subscription_deltas (snapshot_id, channel_id, change) 
+                              SELECT :snapshot, earlier.channel_id, 'removed' FROM snapshot_channels AS earlier 
+                              WHERE earlier.snapshot_id = :previous 
+                                AND NOT EXISTS (SELECT 1 FROM snapshot_channels AS current 
+                                                WHERE current.snapshot_id = :snapshot AND current.channel_id = earlier.channel_id)''',
+                           parameters)
+            cursor.execute('''DELETE FROM account_subscriptions 
+                              WHERE account_id = :account 
+                                AND channel_id IN (SELECT channel_id FROM subscription_deltas 
+                                                   WHERE snapshot_id = :snapshot AND change = 'removed')''', parameters)
+            cursor.execute("DELETE FROM snapshot_channels WHERE snapshot_id = ?", (previous,))
+        cursor.execute('''UPDATE subscription_snapshots 
+                          SET completed_at = :completed_at, 
+                              channel_count = (SELECT COUNT(*) FROM snapshot_channels WHERE snapshot_id = :id), 
+                              added = (SELECT COUNT(*) FROM subscription_deltas WHERE snapshot_id = :id AND change = 'added'), 
+                              removed = (SELECT COUNT(*) FROM subscription_deltas WHERE snapshot_id = :id AND change = 'removed') 
+                          WHERE id = :id''',
+                       {'completed_at': datetime.now(timezone.utc).isoformat(), 'id': snapshot_id})
+        conn.commit()
+    except sqlite3.Error as e:
+        conn.rollback()
+        log(f"An error occurred while completing the subscription snapshot: {e}")
+        return None
+    channel_count, added, removed = conn.execute('''SELECT channel_count, added, removed FROM subscription_snapshots 
+                                                    WHERE id = ?''', (snapshot_id,)).fetchone()
+    log(f"Snapshot of account ID {account_id}: {channel_count} channels, {added} added and {removed} removed"
+        f"{' since the previous snapshot' if previous is not None else ' (baseline)'}.")
+    return {'channels': channel_count, 'added': added, 'removed': removed}
+
+def get_pending_deltas(source_account_id, target_account_id, db_name="subscriptions.db"):
+    # Net change per channel of the source account not yet replayed onto the target:
+    # only the latest delta of a channel counts, older ones are superseded by it.
+    # 'subscribed' tells whether the target already has the channel.
+    conn = get_db_connection(db_name)
+    try:
+        rows = conn.execute('''SELECT delta.snapshot_id, delta.channel_id, delta.change, channels.title, 
+                                       EXISTS (SELECT 1 FROM account_subscriptions AS target 
+                                               WHERE target.account_id = :target AND target.channel_id = delta.channel_id) 
+                                FROM subscription_deltas AS delta 
+                                JOIN subscription_snapshots AS snapshot ON snapshot.id = delta.snapshot_id 
+                                LEFT JOIN channels ON channels.channel_id = delta.channel_id 
+                                WHERE snapshot.account_id = :source 
+                                  AND NOT EXISTS (SELECT 1 FROM delta_replays AS replay 
+                                                  WHERE replay.target_account_id = :target 
+                                                    AND replay.snapshot_id = delta.snapshot_id 
+                                                    AND replay.channel_id = delta.channel_id) 
+                                  AND delta.snapshot_id = (SELECT MAX(later.snapshot_id) FROM subscription_deltas AS later 
+                                                           JOIN subscription_snapshots AS later_snapshot 
+                                                             ON later_snapshot.id = later.snapshot_id 
+                                                           WHERE later.channel_id = delta.channel_id 
+                                                             AND later_snapshot.account_id = :source) 
+                                ORDER BY delta.snapshot_id, delta.channel_id''',
+                            {'source': source_account_id, 'target': target_account_id}).fetchall()
+    except sqlite3.Error as e:
+        log(f"An error occurred while fetching pending subscription deltas: {e}")
+        return []
+    return [{'snapshot_id': row[0], 'channel_id': row[1], 'change': row[2], 'title': row[3] or row[1],
+             'subscribed': bool(row[4])} for row in rows]
+
+def record_delta_replay(source_account_id, target_account_id, delta, result, applied, db_name="subscriptions.db"):
+    # Marks the delta and every older delta of the channel as replayed onto the target and,
+    # if it was applied, mirrors the change in the target's links and latest snapshot
+    conn = get_db_connection(db_name)
+    cursor = conn.cursor()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        cursor.execute('''INSERT OR IGNORE INTO delta_replays (target_account_id, snapshot_id, channel_id, result, replayed_at) 
+                          SELECT ?, delta.snapshot_id, delta.channel_id, ?, ? FROM subscription_deltas AS delta 
+                          JOIN subscription_snapshots AS snapshot ON snapshot.id = delta.snapshot_id 
+                          WHERE snapshot.account_id = ? AND delta.channel_id = ? AND delta.snapshot_id <= ?''',
+                       (target_account_id, result, datetime.now(timezone.utc).isoformat(),
+                        source_account_id, delta['channel_id'], delta['snapshot_id']))
+        if applied:
+            latest = cursor.execute('''SELECT MAX(id) FROM subscription_snapshots 
+                                       WHERE account_id = ? AND completed_at IS NOT NULL''', (target_account_id,)).fetchone()[0]
+            if delta['change'] == 'added':
+                cursor.execute("INSERT OR IGNORE INTO account_subscriptions (account_id, channel_id) VALUES (?, ?)",
+                               (target_account_id, delta['channel_id']))
+                if latest is not None:
+                    cursor.execute("INSERT OR IGNORE INTO snapshot_channels (snapshot_id, channel_id) VALUES (?, ?)",
+                                   (latest, delta['channel_id']))
+            else:
+                cursor.execute("DELETE FROM account_subscriptions WHERE account_id = ? AND channel_id = ?",
+                               (target_account_id, delta['channel_id']))
+                if latest is not None:
+                    cursor.execute("DELETE FROM snapshot_channels WHERE snapshot_id = ? AND channel_id = ?",
+                                   (latest, delta['channel_id']))
+        conn.commit()
+        return True
+    except sqlite3.Error as e:
+        conn.rollback()
+        log(f"An error occurred while recording a replayed delta: {e}")
+        return False
+
+# Title matches outweigh description matches when ranking channels
+CHANNEL_SEARCH_WEIGHTS = (10.0, 1.0)
+
+def fts_query(text):
+    # Turns free text into an FTS5 query that matches every word. A word ending in *
+    # matches as a prefix. Each word is quoted, so operators and punctuation in the
+    # input cannot break the query.
+    terms = []
+    for word in text.split():
+        prefix = len(word) > 1 and word.endswith('*')
+        word = word.rstrip('*') if prefix else word
+        terms.append('"' + word.replace('"', '""') + '"' + ('*' if prefix else ''))
+    return ' '.join(terms)
+
+def search_channels(text, account_name=None, limit=20, offset=0, db_name="subscriptions.db"):
+    # Best matches first; each result lists the accounts that follow the channel
+    conn = get_db_connection(db_name)
+    query = fts_query(text)
+    if not query:
+        return []
+    account_filter = '''AND EXISTS (SELECT 1 FROM account_subscriptions 
+                                      JOIN accounts ON accounts.id = account_subscriptions.account_id 
+                                      WHERE account_subscriptions.channel_id = channels.channel_id 
+                                        AND accounts.name = :account)''' if account_name else ''
+    try:
+        rows = conn.execute(f'''SELECT channels.channel_id, channels.title, 
+                                       snippet(channels_fts, -1, '[', ']', '...', 12), 
+                                       (SELECT group_concat(accounts.name, ', ') FROM account_subscriptions 
+                                        JOIN accounts ON accounts.id = account_subscriptions.account_id 
+                                        WHERE account_subscriptions.channel_id = channels.channel_id) 
+                                FROM channels_fts 
+                                JOIN channels ON channels.id = channels_fts.rowid 
+                                WHERE channels_fts MATCH :query {account_filter} 
+                                ORDER BY bm25(channels_fts, {CHANNEL_SEARCH_WEIGHTS[0]}, {CHANNEL_SEARCH_WEIGHTS[1]}) 
+                                LIMIT :limit OFFSET :offset''',
+                            {'query': query, 'account': account_name, 'limit': limit, 'offset': offset}).fetchall()
+    except sqlite3.Error as e:
+        log(f"An error occurred while searching channels: {e}")
+        return []
+    return [{'channel_id': row[0], 'title': row[1], 'snippet': row[2], 'accounts': row[3] or ''} for row in rows]
+
+def search_watch_history(text, account_name=None, limit=20, offset=0, db_name="subscriptions.db"):
+    # Best matches first, most recent first among equally good ones
+    conn = get_db_connection(db_name)
+    query = fts_query(text)
+    if not query:
+        return []
+    try:
+        rows = conn.execute(f'''SELECT watch_history.title, watch_history.watch_time, watch_history.url, 
+                                       watch_history.channel_id, accounts.name 
+                                FROM watch_history_fts 
+                                JOIN watch_history ON watch_history.id = watch_history_fts.rowid 
+                                LEFT JOIN accounts ON accounts.id = watch_history.account_id 
+                                WHERE watch_history_fts MATCH :query 
+                                  {'AND accounts.name = :account' if account_name else ''} 
+                                ORDER BY watch_history_fts.rank, watch_history.watch_time DESC 
+                                LIMIT :limit OFFSET :offset''',
+                            {'query': query, 'account': account_name, 'limit': limit, 'offset': offset}).fetchall()
+    except sqlite3.Error as e:
+        log(f"An error occurred while searching watch history: {e}")
+        return []
+    return [{'title': row[0], 'watch_time': row[1], 'url': row[2], 'channel_id': row[3], 'account': row[4]} for row in rows]
+
+# Sort keys of the channel report; ties are broken by channel ID
+CHANNEL_REPORT_ORDERS = {
+    'watches': 'channel_statistics.watch_count DESC',
+    'recent': 'channel_statistics.last_watched DESC',
+    'upload-rate': 'channels.upload_rate DESC',
+}
+
+def get_channel_report(account_name, order='watches', limit=20, db_name="subscriptions.db"):
+    # Per-channel watch statistics of an account, read from the precomputed
+    # channel_statistics table rather than aggregated from watch_history
+    conn = get_db_connection(db_name)
+    try:
+        rows = conn.execute(f'''SELECT channel_statistics.channel_id, channels.title, channel_statistics.watch_count, 
+                                       channel_statistics.first_watched, channel_statistics.last_watched, 
+                                       channels.upload_rate, channels.video_count, 
+                                       EXISTS (SELECT 1 FROM account_subscriptions 
+                                               WHERE account_subscriptions.account_id = channel_statistics.account_id 
+                                                 AND account_subscriptions.channel_id = channel_statistics.channel_id) 
+                                FROM channel_statistics 
+                                JOIN accounts ON accounts.id = channel_statistics.account_id 
+                                LEFT JOIN channels ON channels.channel_id = channel_statistics.channel_id 
+                                WHERE accounts.name = ? 
+                                ORDER BY {CHANNEL_REPORT_ORDERS[order]}, channel_statistics.channel_id 
+                                LIMIT ?''', (account_name, limit)).fetchall()
+    except sqlite3.Error as e:
+        log(f"An error occurred while reading channel statistics: {e}")
+        return []
+    return [{'channel_id': row[0], 'title': row[1], 'watch_count': row[2], 'first_watched': row[3], 'last_watched': row[4],
+             'upload_rate': row[5], 'video_count': row[6], 'subscribed': bool(row[7])} for row in rows]
 
 def flag_problematic_subscription(account_id, channel_id, reason, db_name="subscriptions.db"):
     log(f"Flagging problematic subscription: Account ID {account_id}, Channel ID {channel_id}, Reason: {reason}")
@@ -226,6 +950,273 @@ def flag_problematic_subscription(account_id, channel_id, reason, db_name="subsc
         conn.commit()
         log(f"Problematic subscription flagged: Channel ID {channel_id}")
     except sqlite3.Error as e:
+        conn.rollback()
         log(f"An error occurred while flagging problematic subscription: {e}")
-    finally:
-        conn.close()
+
+def add_watch_history_dedup(cursor):
+    # Collapse rows duplicated by earlier re-imports, then keep them unique
+    cursor.execute('''DELETE FROM watch_history 
+                      WHERE id NOT IN (SELECT MIN(id) FROM watch_history 
+                                       GROUP BY account_id, video_id, watch_time)''')
+    if cursor.rowcount > 0:
+        log(f"Removed {cursor.rowcount} duplicate watch history rows.")
+    cursor.execute('''CREATE UNIQUE INDEX IF NOT EXISTS idx_watch_history_unique 
+                      ON watch_history (account_id, video_id, watch_time)''')
+    cursor.execute('''CREATE TABLE IF NOT EXISTS watch_history_sync
+                      (account_id INTEGER PRIMARY KEY,
+                       synced_until TEXT,
+                       updated_at TIMESTAMP,
+                       FOREIGN KEY (account_id) REFERENCES accounts(id))''')
+
+def add_http_cache(cursor):
+    # Conditional-request cache for YouTube API GET responses, see http_cache.py
+    cursor.execute('''CREATE TABLE IF NOT EXISTS http_cache
+                      (cache_key TEXT PRIMARY KEY,
+                       etag TEXT NOT NULL,
+                       content BLOB NOT NULL,
+                       size INTEGER NOT NULL,
+                       stored_at REAL,
+                       last_used_at REAL)''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_http_cache_last_used ON http_cache (last_used_at)")
+
+def add_details_fetched_at(cursor):
+    # When each channel's details were last fetched, for TTL-based refreshes
+    cursor.execute("ALTER TABLE channels ADD COLUMN details_fetched_at TEXT")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_channels_details_fetched_at ON channels (details_fetched_at)")
+
+def add_quota_ledger(cursor):
+    # Append-only quota usage per OAuth project/account and Pacific-time quota day
+    cursor.execute('''CREATE TABLE IF NOT EXISTS quota_ledger
+                      (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                       project TEXT NOT NULL,
+                       quota_day TEXT NOT NULL,
+                       operation TEXT NOT NULL,
+                       units INTEGER NOT NULL,
+                       recorded_at REAL)''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_quota_ledger_project_day ON quota_ledger (project, quota_day)")
+
+def add_video_cache(cursor):
+    # Video -> channel lookups made for watch history, see video_info.py
+    cursor.execute('''CREATE TABLE IF NOT EXISTS videos
+                      (video_id TEXT PRIMARY KEY,
+                       channel_id TEXT,
+                       channel_title TEXT,
+                       title TEXT,
+                       fetched_at TEXT) WITHOUT ROWID''')
+    cursor.execute('''CREATE INDEX IF NOT EXISTS idx_watch_history_missing_channel
+                      ON watch_history (account_id, video_id) WHERE channel_id IS NULL''')
+
+def add_checkpoints(cursor):
+    # Resume positions of listing and import runs, replacing progress.json
+    cursor.execute('''CREATE TABLE IF NOT EXISTS checkpoints
+                      (operation TEXT NOT NULL,
+                       account_id INTEGER NOT NULL,
+                       page_token TEXT,
+                       page_offset INTEGER NOT NULL DEFAULT 0,
+                       processed INTEGER NOT NULL DEFAULT 0,
+                       last_item TEXT,
+                       updated_at TEXT,
+                       PRIMARY KEY (operation, account_id),
+                       FOREIGN KEY (account_id) REFERENCES accounts(id))''')
+
+def add_import_priority(cursor):
+    # Subscriptions with a higher priority are imported first; ties run in channel ID order
+    cursor.execute("ALTER TABLE account_subscriptions ADD COLUMN priority INTEGER NOT NULL DEFAULT 0")
+    cursor.execute('''CREATE INDEX IF NOT EXISTS idx_account_subscriptions_priority
+                      ON account_subscriptions (account_id, priority DESC, channel_id)''')
+
+def add_subscription_snapshots(cursor):
+    # Per-account listing snapshots. snapshot_channels holds the membership of the latest
+    # complete and the open snapshot only; history is kept as added/removed deltas.
+    cursor.execute('''CREATE TABLE IF NOT EXISTS subscription_snapshots
+                      (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                       account_id INTEGER NOT NULL,
+                       started_at TEXT NOT NULL,
+                       completed_at TEXT,
+                       channel_count INTEGER,
+                       added INTEGER,
+                       removed INTEGER,
+                       FOREIGN KEY (account_id) REFERENCES accounts(id))''')
+    cursor.execute('''CREATE INDEX IF NOT EXISTS idx_subscription_snapshots_account
+                      ON subscription_snapshots (account_id, completed_at)''')
+    cursor.execute('''CREATE TABLE IF NOT EXISTS snapshot_channels
+                      (snapshot_id INTEGER NOT NULL,
+                       channel_id TEXT NOT NULL,
+                       PRIMARY KEY (snapshot_id, channel_id),
+                       FOREIGN KEY (snapshot_id) REFERENCES subscription_snapshots(id)) WITHOUT ROWID''')
+    cursor.execute('''CREATE TABLE IF NOT EXISTS subscription_deltas
+                      (snapshot_id INTEGER NOT NULL,
+                       channel_id TEXT NOT NULL,
+                       change TEXT NOT NULL CHECK (change IN ('added', 'removed')),
+                       PRIMARY KEY (snapshot_id, channel_id),
+                       FOREIGN KEY (snapshot_id) REFERENCES subscription_snapshots(id)) WITHOUT ROWID''')
+    cursor.execute('''CREATE INDEX IF NOT EXISTS idx_subscription_deltas_channel
+                      ON subscription_deltas (channel_id, snapshot_id)''')
+    # Deltas already applied to (or skipped for) each other account
+    cursor.execute('''CREATE TABLE IF NOT EXISTS delta_replays
+                      (target_account_id INTEGER NOT NULL,
+                       snapshot_id INTEGER NOT NULL,
+                       channel_id TEXT NOT NULL,
+                       result TEXT,
+                       replayed_at TEXT,
+                       PRIMARY KEY (target_account_id, snapshot_id, channel_id),
+                       FOREIGN KEY (target_account_id) REFERENCES accounts(id)) WITHOUT ROWID''')
+
+def add_search_index(cursor):
+    # External-content FTS5 indexes over channel titles/descriptions and watched video
+    # titles. Triggers keep them in step with every insert, update and delete, so the
+    # store functions need no changes.
+    create_channels_search_index(cursor, 'rowid')
+    cursor.execute('''CREATE VIRTUAL TABLE IF NOT EXISTS watch_history_fts USING fts5
+                      (title, content='watch_history', content_rowid='id',
+                       tokenize='unicode61 remove_diacritics 2')''')
+    cursor.execute('''CREATE TRIGGER IF NOT EXISTS watch_history_fts_insert AFTER INSERT ON watch_history BEGIN
+                          INSERT INTO watch_history_fts (rowid, title) VALUES (new.id, new.title);
+                      END''')
+    cursor.execute('''CREATE TRIGGER IF NOT EXISTS watch_history_fts_delete AFTER DELETE ON watch_history BEGIN
+                          INSERT INTO watch_history_fts (watch_history_fts, rowid, title) VALUES ('delete', old.id, old.title);
+                      END''')
+    cursor.execute('''CREATE TRIGGER IF NOT EXISTS watch_history_fts_update AFTER UPDATE OF title ON watch_history 
+                      WHEN old.title IS NOT new.title BEGIN
+                          INSERT INTO watch_history_fts (watch_history_fts, rowid, title) VALUES ('delete', old.id, old.title);
+                          INSERT INTO watch_history_fts (rowid, title) VALUES (new.id, new.title);
+                      END''')
+    # Index what is already stored
+    cursor.execute("INSERT INTO channels_fts (channels_fts) VALUES ('rebuild')")
+    cursor.execute("INSERT INTO watch_history_fts (watch_history_fts) VALUES ('rebuild')")
+
+def create_channels_search_index(cursor, content_rowid):
+    cursor.execute(f'''CREATE VIRTUAL TABLE IF NOT EXISTS channels_fts USING fts5
+                      (title, description, content='channels', content_rowid='{content_rowid}',
+                       tokenize='unicode61 remove_diacritics 2')''')
+    cursor.execute(f'''CREATE TRIGGER IF NOT EXISTS channels_fts_insert AFTER INSERT ON channels BEGIN
+                          INSERT INTO channels_fts (rowid, title, description) 
+                          VALUES (new.{content_rowid}, new.title, new.description);
+                      END''')
+    cursor.execute(f'''CREATE TRIGGER IF NOT EXISTS channels_fts_delete AFTER DELETE ON channels BEGIN
+                          INSERT INTO channels_fts (channels_fts, rowid, title, description) 
+                          VALUES ('delete', old.{content_rowid}, old.title, old.description);
+                      END''')
+    # Upserts rewrite title and description on every listing; only real changes reach the index
+    cursor.execute(f'''CREATE TRIGGER IF NOT EXISTS channels_fts_update AFTER UPDATE OF title, description ON channels 
+                      WHEN old.title IS NOT new.title OR old.description IS NOT new.description BEGIN
+                          INSERT INTO channels_fts (channels_fts, rowid, title, description) 
+                          VALUES ('delete', old.{content_rowid}, old.title, old.description);
+                          INSERT INTO channels_fts (rowid, title, description) 
+                          VALUES (new.{content_rowid}, new.title, new.description);
+                      END''')
+
+# Numbers and dates from the API are stored as text ("0.50 videos per day", "N/A",
+# ISO 8601). Generated columns expose them typed, so queries can compare and
+# aggregate them in SQL; values that do not parse become NULL.
+CHANNEL_TYPED_COLUMNS = [
+    ('video_count INTEGER', "CASE WHEN total_videos GLOB '[0-9]*' THEN CAST(total_videos AS INTEGER) END"),
+    ('upload_rate REAL', "CASE WHEN upload_frequency GLOB '[0-9]*' THEN CAST(upload_frequency AS REAL) END"),
+    ('published_epoch INTEGER', "CAST(strftime('%s', published_at) AS INTEGER)"),
+    ('created_epoch INTEGER', "CAST(strftime('%s', created_at) AS INTEGER)"),
+    ('last_upload_epoch INTEGER', "CAST(strftime('%s', last_upload_date) AS INTEGER)"),
+    ('details_fetched_epoch INTEGER', "CAST(strftime('%s', details_fetched_at) AS INTEGER)"),
+]
+
+def add_typed_columns(cursor):
+    for column, expression in CHANNEL_TYPED_COLUMNS:
+        cursor.execute(f"ALTER TABLE channels ADD COLUMN {column} GENERATED ALWAYS AS ({expression}) VIRTUAL")
+    cursor.execute('''ALTER TABLE watch_history ADD COLUMN watched_epoch INTEGER 
+                      GENERATED ALWAYS AS (CAST(strftime('%s', watch_time) AS INTEGER)) VIRTUAL''')
+
+def add_channel_statistics(cursor):
+    # Watch statistics per account and channel, kept up to date by the watch history
+    # writers (see merge_channel_statistics)
+    cursor.execute('''CREATE TABLE IF NOT EXISTS channel_statistics
+                      (account_id INTEGER NOT NULL,
+                       channel_id TEXT NOT NULL,
+                       watch_count INTEGER NOT NULL,
+                       first_watched INTEGER,
+                       last_watched INTEGER,
+                       PRIMARY KEY (account_id, channel_id),
+                       FOREIGN KEY (account_id) REFERENCES accounts(id)) WITHOUT ROWID''')
+    cursor.execute('''CREATE INDEX IF NOT EXISTS idx_channel_statistics_watches
+                      ON channel_statistics (account_id, watch_count DESC)''')
+    cursor.execute('''CREATE INDEX IF NOT EXISTS idx_channel_statistics_last_watched
+                      ON channel_statistics (account_id, last_watched DESC)''')
+    merge_channel_statistics(cursor, "SELECT account_id, channel_id, watched_epoch FROM watch_history")
+
+def add_channel_row_ids(cursor):
+    # The channel search index is keyed on rowids, which VACUUM may renumber in a table
+    # without an INTEGER PRIMARY KEY. channels is rebuilt with one that keeps the current
+    # rowids, and the index is recreated on it.
+    for trigger in ('channels_fts_insert', 'channels_fts_delete', 'channels_fts_update'):
+        cursor.execute(f"DROP TRIGGER IF EXISTS {trigger}")
+    cursor.execute("DROP TABLE IF EXISTS channels_fts")
+    columns = 'channel_id, title, description, published_at, created_at, total_videos, last_upload_date, upload_frequency, details_fetched_at'
+    typed_columns = ''.join(f", {column} GENERATED ALWAYS AS ({expression}) VIRTUAL" for column, expression in CHANNEL_TYPED_COLUMNS)
+    cursor.execute(f'''CREATE TABLE channels_rebuilt
+                       (id INTEGER PRIMARY KEY,
+                        channel_id TEXT UNIQUE,
+                        title TEXT,
+                        description TEXT,
+                        published_at TEXT,
+                        created_at TEXT,
+                        total_videos TEXT,
+                        last_upload_date TEXT,
+                        upload_frequency TEXT,
+                        details_fetched_at TEXT{typed_columns})''')
+    cursor.execute(f"INSERT INTO channels_rebuilt (id, {columns}) SELECT rowid, {columns} FROM channels")
+    cursor.execute("DROP TABLE channels")
+    cursor.execute("ALTER TABLE channels_rebuilt RENAME TO channels")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_channels_details_fetched_at ON channels (details_fetched_at)")
+    create_channels_search_index(cursor, 'id')
+    cursor.execute("INSERT INTO channels_fts (channels_fts) VALUES ('rebuild')")
+
+def add_watch_based_import_priority(cursor):
+    # An account's import priority for a channel is how often the account watched it,
+    # so the channels it watches most are imported first. Triggers keep priority in
+    # step with channel_statistics and set it for new subscriptions.
+    cursor.execute('''UPDATE account_subscriptions SET priority = 
+                          (SELECT watch_count FROM channel_statistics AS stats 
+                           WHERE stats.account_id = account_subscriptions.account_id 
+                             AND stats.channel_id = account_subscriptions.channel_id) 
+                      WHERE EXISTS (SELECT 1 FROM channel_statistics AS stats 
+                                    WHERE stats.account_id = account_subscriptions.account_id 
+                                      AND stats.channel_id = account_subscriptions.channel_id)''')
+    for event in ('INSERT', 'UPDATE OF watch_count'):
+        name = 'channel_statistics_priority_' + event.split()[0].lower()
+        cursor.execute(f'''CREATE TRIGGER IF NOT EXISTS {name} AFTER {event} ON channel_statistics BEGIN
+                               UPDATE account_subscriptions SET priority = new.watch_count 
+                               WHERE account_id = new.account_id AND channel_id = new.channel_id;
+                           END''')
+    cursor.execute('''CREATE TRIGGER IF NOT EXISTS account_subscriptions_priority AFTER INSERT ON account_subscriptions BEGIN
+                          UPDATE account_subscriptions SET priority = 
+                              (SELECT watch_count FROM channel_statistics 
+                               WHERE account_id = new.account_id AND channel_id = new.channel_id) 
+                          WHERE account_id = new.account_id AND channel_id = new.channel_id 
+                            AND EXISTS (SELECT 1 FROM channel_statistics 
+                                        WHERE account_id = new.account_id AND channel_id = new.channel_id);
+                      END''')
+
+def add_channel_refresh_index(cursor):
+    # The typed columns are VIRTUAL, so get_stale_channels would run strftime() on every
+    # row. This index keeps both epochs it reads, keyed by the channel ID it joins on,
+    # and replaces the index on the text column, which no query uses any more.
+    cursor.execute("DROP INDEX IF EXISTS idx_channels_details_fetched_at")
+    cursor.execute('''CREATE INDEX IF NOT EXISTS idx_channels_refresh
+                      ON channels (channel_id, details_fetched_epoch, last_upload_epoch)''')
+
+# Applied in order; the position in this list is the schema version
+MIGRATIONS = [
+    create_initial_schema,
+    add_watch_history_dedup,
+    add_http_cache,
+    add_details_fetched_at,
+    add_quota_ledger,
+    add_video_cache,
+    add_checkpoints,
+    add_import_priority,
+    add_subscription_snapshots,
+    add_search_index,
+    add_typed_columns,
+    add_channel_statistics,
+    add_channel_row_ids,
+    add_watch_based_import_priority,
+    add_channel_refresh_index,
+]
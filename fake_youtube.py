@@ -0,0 +1,263 @@
+import hashlib
+import json
+import random
+import threading
+import time
+import zlib
+from datetime import datetime, timedelta, timezone
+from urllib.parse import urlparse, parse_qs
+import httplib2
+from quota_management import QUOTA_COST
+from utils import log
+
+# Offline stand-in for the parts of the YouTube Data API v3 this project calls:
+# subscriptions.list/insert/delete, channels.list, playlistItems.list and videos.list.
+# FakeHttp plugs into googleapiclient in place of an authorized httplib2.Http,
+# so the real request building, paging and error handling code paths all run.
+
+DEFAULT_FAKE_CHANNELS = 10000
+DEFAULT_FAKE_VIDEOS_PER_CHANNEL = 20
+MAX_RESULTS_LIMIT = 50
+FAKE_EPOCH = datetime(2010, 1, 1, tzinfo=timezone.utc)
+# --fake-api runs use their own database, see database.use_default_database
+FAKE_DB_NAME = "fake_subscriptions.db"
+
+ERROR_RESPONSES = {
+    403: ('quotaExceeded', 'The request cannot be completed because you have exceeded your quota.'),
+    404: ('notFound', 'The requested resource could not be found.'),
+    500: ('backendError', 'Backend Error'),
+}
+
+class FakeYouTubeAPI:
+    # Shared, thread-safe state behind every FakeHttp: the generated dataset,
+    # subscriptions added by inserts and the quota each account has used
+    def __init__(self, channels=DEFAULT_FAKE_CHANNELS, subscriptions=None, videos_per_channel=DEFAULT_FAKE_VIDEOS_PER_CHANNEL,
+                 latency=0.0, error_rates=None, daily_quota=None, seed=0):
+        self.channel_count = channels
+        self.subscription_count = channels if subscriptions is None else min(subscriptions, channels)
+        self.videos_per_channel = videos_per_channel
+        self.latency = latency
+        self.error_rates = error_rates or {}  # {403: probability, 404: ..., 500: ...}
+        self.daily_quota = daily_quota
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.subscriptions = {}  # account -> (list of channel indexes, set of channel indexes)
+        self.costs = {}  # (account, method) -> [calls, units]
+
+    @classmethod
+    def from_spec(cls, spec):
+        # "channels=10000,subscriptions=2000,latency=0.05,error_500=0.01,daily_quota=10000"
+        options = {}
+        error_rates = {}
+        for part in filter(None, (spec or '').split(',')):
+            key, _, value = part.partition('=')
+            key = key.strip()
+            if key.startswith('error_'):
+                error_rates[int(key[len('error_'):])] = float(value)
+            elif key == 'latency':
+                options['latency'] = float(value)
+            elif key in ('channels', 'subscriptions', 'videos_per_channel', 'daily_quota', 'seed'):
+                options[key] = int(value)
+            else:
+                raise ValueError(f"Unknown fake API option: {key}")
+        return cls(error_rates=error_rates, **options)
+
+    def http(self, account):
+        return FakeHttp(self, account)
+
+    # Dataset
+
+    def channel_id(self, index):
+        return f"UC{index:022d}"
+
+    def channel_index(self, channel_id):
+        if len(channel_id) != 24 or not channel_id.startswith('UC') or not channel_id[2:].isdigit():
+            return None
+        index = int(channel_id[2:])
+        return index if index < self.channel_count else None
+
+    def video_id(self, channel_index, number):
+        return f"v{channel_index * self.videos_per_channel + number:010d}"
+
+    def video_owner(self, video_id):
+        if len(video_id) != 11 or not video_id.startswith('v') or not video_id[1:].isdigit() or self.videos_per_channel == 0:
+            return None
+        channel_index, number = divmod(int(video_id[1:]), self.videos_per_channel)
+        return (channel_index, number) if channel_index < self.channel_count else None
+
+    def channel_published_at(self, index):
+        return FAKE_EPOCH + timedelta(hours=index)
+
+    def video_published_at(self, channel_index, number):
+        return self.channel_published_at(channel_index) + timedelta(days=7 * (number + 1))
+
+    def account_subscriptions(self, account):
+        # Every account starts with a stable window of channels that depends on its name
+        if account not in self.subscriptions:
+            start = zlib.crc32(account.encode()) % max(1, self.channel_count)
+            indexes = [(start + offset) % self.channel_count for offset in range(self.subscription_count)]
+            self.subscriptions[account] = (indexes, set(indexes))
+        return self.subscriptions[account]
+
+    def channel_resource(self, index, parts):
+        channel_id = self.channel_id(index)
+        resource = {'kind': 'youtube#channel', 'id': channel_id}
+        if 'snippet' in parts:
+            resource['snippet'] = {'title': f"Fake channel {index}", 'description': f"Channel number {index}",
+                                   'publishedAt': format_time(self.channel_published_at(index))}
+        if 'statistics' in parts:
+            resource['statistics'] = {'videoCount': str(self.videos_per_channel)}
+        if 'contentDetails' in parts:
+            resource['contentDetails'] = {'relatedPlaylists': {'uploads': 'UU' + channel_id[2:]}}
+        return resource
+
+    # Requests
+
+    def handle(self, account, uri, method, body, headers):
+        parsed = urlparse(uri)
+        resource = parsed.path.rstrip('/').rsplit('/', 1)[-1]
+        params = {key: values[-1] for key, values in parse_qs(parsed.query).items()}
+        verb = {'GET': 'list', 'DELETE': 'delete'}.get(method, 'insert')
+        api_method = f"{resource}.{verb}"
+
+        if self.latency:
+            time.sleep(self.latency)
+        with self.lock:
+            handler = getattr(self, f"{resource}_{verb}", None)
+            if handler is None or api_method not in QUOTA_COST:
+                return error_response(404, 'notFound', f"The fake API does not implement {method} {parsed.path}.")
+            if self.daily_quota is not None and self.units_used(account) + QUOTA_COST[api_method] > self.daily_quota:
+                return error_response(403, *ERROR_RESPONSES[403])
+            self.charge(account, api_method)
+            for status, rate in sorted(self.error_rates.items()):
+                if rate and self.random.random() < rate:
+                    return error_response(status, *ERROR_RESPONSES[status])
+            status, payload = handler(account, params, json.loads(body) if body else None)
+
+        if status >= 300:
+            return error_response(status, *payload)
+        if status == 204:
+            return httplib2.Response({'status': '204'}), b''
+        content = json.dumps(payload).encode('utf-8')
+        etag = '"' + hashlib.md5(content).hexdigest() + '"'
+        if method == 'GET' and (headers or {}).get('If-None-Match') == etag:
+            return httplib2.Response({'status': '304', 'etag': etag}), b''
+        return httplib2.Response({'status': '200', 'etag': etag, 'content-type': 'application/json; charset=UTF-8'}), content
+
+    def subscriptions_list(self, account, params, body):
+        indexes, subscribed = self.account_subscriptions(account)
+        if params.get('forChannelId'):
+            wanted = [self.channel_index(channel_id) for channel_id in params['forChannelId'].split(',')]
+            indexes = [index for index in wanted if index in subscribed]
+        offset = int(params.get('pageToken') or 0)
+        page_size = min(int(params.get('maxResults', 5)), MAX_RESULTS_LIMIT)
+        items = [{'kind': 'youtube#subscription', 'id': f"{account}.{index}",
+                  'snippet': {'title': f"Fake channel {index}", 'description': f"Channel number {index}",
+                              'publishedAt': format_time(self.channel_published_at(index)),
+                              'resourceId': {'kind': 'youtube#channel', 'channelId': self.channel_id(index)}}}
+                 for index in indexes[offset:offset + page_size]]
+        response = {'kind': 'youtube#subscriptionListResponse', 'items': items,
+                    'pageInfo': {'totalResults': len(indexes), 'resultsPerPage': page_size}}
+        if offset + page_size < len(indexes):
+            response['nextPageToken'] = str(offset + page_size)
+        return 200, response
+
+    def subscriptions_insert(self, account, params, body):
+        channel_id = ((body or {}).get('snippet') or {}).get('resourceId', {}).get('channelId', '')
+        index = self.channel_index(channel_id)
+        if index is None:
+            return 404, ('publisherNotFound', f"Channel {channel_id} could not be found.")
+        indexes, subscribed = self.account_subscriptions(account)
+        if index in subscribed:
+            return 400, ('subscriptionDuplicate', 'The subscription that you are trying to create already exists.')
+        indexes.append(index)
+        subscribed.add(index)
+        return 200, {'kind': 'youtube#subscription', 'id': f"{account}.{index}",
+                     'snippet': {'resourceId': {'kind': 'youtube#channel', 'channelId': channel_id}}}
+
+    def subscriptions_delete(self, account, params, body):
+        owner, _, index = params.get('id', '').rpartition('.')
+        indexes, subscribed = self.account_subscriptions(account)
+        if owner != account or not index.isdigit() or int(index) not in subscribed:
+            return 404, ('subscriptionNotFound', f"Subscription {params.get('id')} could not be found.")
+        indexes.remove(int(index))
+        subscribed.discard(int(index))
+        return 204, None
+
+    def channels_list(self, account, params, body):
+        parts = params.get('part', '').split(',')
+        ids = [channel_id for channel_id in params.get('id', '').split(',') if channel_id][:MAX_RESULTS_LIMIT]
+        indexes = [self.channel_index(channel_id) for channel_id in ids]
+        items = [self.channel_resource(index, parts) for index in indexes if index is not None]
+        return 200, {'kind': 'youtube#channelListResponse', 'items': items}
+
+    def playlistItems_list(self, account, params, body):
+        playlist_id = params.get('playlistId', '')
+        index = self.channel_index('UC' + playlist_id[2:]) if playlist_id.startswith('UU') else None
+        if index is None:
+            return 404, ('playlistNotFound', f"Playlist {playlist_id} could not be found.")
+        page_size = min(int(params.get('maxResults', 5)), MAX_RESULTS_LIMIT)
+        # Newest uploads first, like the uploads playlist
+        numbers = list(range(self.videos_per_channel - 1, -1, -1))[:page_size]
+        items = [{'kind': 'youtube#playlistItem',
+                  'snippet': {'publishedAt': format_time(self.video_published_at(index, number)),
+                              'resourceId': {'kind': 'youtube#video', 'videoId': self.video_id(index, number)}}}
+                 for number in numbers]
+        return 200, {'kind': 'youtube#playlistItemListResponse', 'items': items}
+
+    def videos_list(self, account, params, body):
+        items = []
+        for video_id in [video_id for video_id in params.get('id', '').split(',') if video_id][:MAX_RESULTS_LIMIT]:
+            owner = self.video_owner(video_id)
+            if owner is None:
+                continue
+            channel_index, number = owner
+            items.append({'kind': 'youtube#video', 'id': video_id,
+                          'snippet': {'title': f"Fake video {video_id}", 'channelId': self.channel_id(channel_index),
+                                      'channelTitle': f"Fake channel {channel_index}",
+                                      'publishedAt': format_time(self.video_published_at(channel_index, number))}})
+        return 200, {'kind': 'youtube#videoListResponse', 'items': items}
+
+    # Cost accounting
+
+    def charge(self, account, api_method):
+        entry = self.costs.setdefault((account, api_method), [0, 0])
+        entry[0] += 1
+        entry[1] += QUOTA_COST[api_method]
+
+    def units_used(self, account):
+        return sum(units for (charged_account, _), (_, units) in self.costs.items() if charged_account == account)
+
+    def cost_summary(self):
+        with self.lock:
+            return {f"{account} {api_method}": {'calls': calls, 'units': units}
+                    for (account, api_method), (calls, units) in sorted(self.costs.items())}
+
+    def log_cost_summary(self):
+        summary = self.cost_summary()
+        if not summary:
+            return
+        for key, entry in summary.items():
+            log(f"Fake API: {key}: {entry['calls']} calls, {entry['units']} units")
+        log(f"Fake API: {sum(entry['units'] for entry in summary.values())} units charged in total.")
+
+class FakeHttp:
+    # httplib2.Http look-alike bound to one account of a FakeYouTubeAPI
+    def __init__(self, api, account):
+        self.api = api
+        self.account = account
+        self.timeout = None
+
+    def request(self, uri, method='GET', body=None, headers=None, redirections=None, connection_type=None):
+        return self.api.handle(self.account, uri, method, body, headers)
+
+    def close(self):
+        pass
+
+def error_response(status, reason, message):
+    content = json.dumps({'error': {'code': status, 'message': message,
+                                    'errors': [{'message': message, 'domain': 'youtube', 'reason': reason}]}})
+    return httplib2.Response({'status': str(status), 'content-type': 'application/json; charset=UTF-8'}), content.encode('utf-8')
+
+def format_time(moment):
+    return moment.strftime('%Y-%m-%dT%H:%M:%SZ')
@@ -0,0 +1,126 @@
+import sqlite3
+import threading
+import time
+from database import get_db_connection, run_write
+from utils import log
+
+# Cached response bodies are evicted least recently used first beyond this size
+MAX_CACHE_BYTES = 64 * 1024 * 1024
+
+cache_stats = {
+    'hits': 0,
+    'misses': 0,
+    'stored': 0,
+    'evicted': 0,
+    'bytes_saved': 0,
+    'full_fetch_seconds': 0.0,
+    'full_fetches': 0,
+    'revalidation_seconds': 0.0,
+}
+_stats_lock = threading.Lock()
+
+class CachingHttp:
+    # Wraps an authorized httplib2.Http. GET responses that carry an ETag are kept
+    # in SQLite and revalidated with If-None-Match; a 304 is answered from the cache.
+    def __init__(self, http, namespace, db_name="subscriptions.db", max_bytes=MAX_CACHE_BYTES):
+        self.http = http
+        self.namespace = namespace
+        self.db_name = db_name
+        self.max_bytes = max_bytes
+
+    def __getattr__(self, name):
+        return getattr(self.http, name)
+
+    def request(self, uri, method='GET', body=None, headers=None, **kwargs):
+        if method != 'GET':
+            return self.http.request(uri, method=method, body=body, headers=headers, **kwargs)
+
+        # Responses for mine=True depend on the account, so keys are namespaced
+        cache_key = f"{self.namespace} {uri}"
+        cached = get_cached_response(cache_key, self.db_name)
+        headers = dict(headers or {})
+        if cached:
+            headers['If-None-Match'] = cached[0]
+
+        started = time.monotonic()
+        response, content = self.http.request(uri, method=method, body=body, headers=headers, **kwargs)
+        elapsed = time.monotonic() - started
+
+        if response.status == 304 and cached:
+            import httplib2
+            etag, cached_content = cached
+            # Cache writes are queued on the shared writer, if any, so they never hold up the request
+            run_write(touch_cached_response, cache_key, self.db_name, wait=False)
+            record_cache_event(hit=True, seconds=elapsed, bytes_saved=len(cached_content))
+            return httplib2.Response({'status': '200', 'etag': etag,
+                                      'content-type': 'application/json; charset=UTF-8'}), cached_content
+
+        record_cache_event(hit=False, seconds=elapsed)
+        if response.status == 200 and response.get('etag'):
+            run_write(store_cached_response, cache_key, response['etag'], content, self.db_name, self.max_bytes, wait=False)
+        return response, content
+
+def record_cache_event(hit, seconds, bytes_saved=0):
+    with _stats_lock:
+        if hit:
+            cache_stats['hits'] += 1
+            cache_stats['bytes_saved'] += bytes_saved
+            cache_stats['revalidation_seconds'] += seconds
+        else:
+            cache_stats['misses'] += 1
+            cache_stats['full_fetches'] += 1
+            cache_stats['full_fetch_seconds'] += seconds
+
+def get_cached_response(cache_key, db_name="subscriptions.db"):
+    conn = get_db_connection(db_name)
+    try:
+        row = conn.execute("SELECT etag, content FROM http_cache WHERE cache_key = ?", (cache_key,)).fetchone()
+        return (row[0], bytes(row[1])) if row else None
+    except sqlite3.Error as e:
+        log(f"An error occurred while reading the HTTP cache: {e}")
+        return None
+
+def touch_cached_response(cache_key, db_name="subscriptions.db"):
+    conn = get_db_connection(db_name)
+    try:
+        with conn:
+            conn.execute("UPDATE http_cache SET last_used_at = ? WHERE cache_key = ?", (time.time(), cache_key))
+    except sqlite3.Error as e:
+        log(f"An error occurred while updating the HTTP cache: {e}")
+
+def store_cached_response(cache_key, etag, content, db_name="subscriptions.db", max_bytes=MAX_CACHE_BYTES):
+    conn = get_db_connection(db_name)
+    now = time.time()
+    try:
+        with conn:
+            conn.execute('''INSERT INTO http_cache (cache_key, etag, content, size, stored_at, last_used_at)
+                            VALUES (?, ?, ?, ?, ?, ?)
+                            ON CONFLICT(cache_key) DO UPDATE
+                            SET etag = excluded.etag, content = excluded.content, size = excluded.size,
+                                stored_at = excluded.stored_at, last_used_at = excluded.last_used_at''',
+                         (cache_key, etag, content, len(content), now, now))
+            # Drop the least recently used entries that push the total over the limit
+            evicted = conn.execute('''DELETE FROM http_cache WHERE cache_key IN
+                                      (SELECT cache_key FROM
+                                       (SELECT cache_key, SUM(size) OVER (ORDER BY last_used_at DESC, cache_key) AS running_size
+                                        FROM http_cache)
+                                       WHERE running_size > ?)''', (max_bytes,)).rowcount
+        with _stats_lock:
+            cache_stats['stored'] += 1
+            cache_stats['evicted'] += evicted
+    except sqlite3.Error as e:
+        log(f"An error occurred while writing the HTTP cache: {e}")
+
+def log_cache_statistics():
+    with _stats_lock:
+        stats = dict(cache_stats)
+    requests = stats['hits'] + stats['misses']
+    if requests == 0:
+        return
+    log(f"HTTP cache: {stats['hits']} hits, {stats['misses']} misses ({stats['hits'] / requests:.0%} hit rate), "
+        f"{stats['stored']} stored, {stats['evicted']} evicted, {stats['bytes_saved'] / 1024:.1f} KiB not re-downloaded.")
+    if stats['hits'] and stats['full_fetches']:
+        average_full = stats['full_fetch_seconds'] / stats['full_fetches']
+        average_revalidation = stats['revalidation_seconds'] / stats['hits']
+        log(f"HTTP cache: average full fetch {average_full * 1000:.0f} ms, average revalidation {average_revalidation * 1000:.0f} ms, "
+            f"estimated {max(average_full - average_revalidation, 0) * stats['hits']:.2f} seconds saved.")
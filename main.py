@@ -1,14 +1,19 @@
 import logging
-from datetime import datetime, timedelta
+from datetime import datetime
 import traceback
-from auth import authenticate_youtube
-from database import update_database_schema
-from quota_management import get_quota_usage, get_actual_quota, estimate_processable_subscriptions, log_quota_information, load_quota_details, save_quota_details
+from auth import use_fake_api, get_fake_api, close_youtube_clients
+from database import update_database_schema, close_db_connections, use_default_database
+from http_cache import log_cache_statistics
+from api_metrics import export_api_metrics
+from quota_management import get_quota_usage, get_actual_quota, estimate_processable_subscriptions, log_quota_information, flush_quota_ledger, set_quota_project, get_next_quota_reset, log_quota_history
 from utils import log
 from cli import parse_arguments
 from account_management import get_available_accounts, setup_accounts
-from subscription_management import handle_subscriptions, handle_import_subscriptions
-from watch_history import get_watch_history, print_watch_history
+from subscription_management import handle_subscriptions, handle_import_subscriptions, handle_refresh_channel_details, handle_plan
+from watch_history_management import handle_watch_history
+from search_management import handle_search
+from report_management import handle_report
+from account_sync import sync_accounts
 
 def setup_logging():
     logging.basicConfig(
@@ -29,60 +34,105 @@ def main():
 
     try:
         logging.info("Starting YouTube Subscription Manager")
-        # Load quota details at the start of the script
-        load_quota_details()
+
+        if args.fake_api is not None:
+            from fake_youtube import FakeYouTubeAPI, FAKE_DB_NAME
+            use_fake_api(FakeYouTubeAPI.from_spec(args.fake_api))
+            use_default_database(FAKE_DB_NAME)
+            log(f"Using the local fake YouTube API. Results are stored in {FAKE_DB_NAME}, not in the real database.")
 
         update_database_schema()
 
+        if args.command == 'quota':
+            log_quota_history(args.account, args.days)
+            return
+
+        if args.command == 'search':
+            handle_search(args)
+            return
+
+        if args.command == 'report':
+            handle_report(args)
+            return
+
+        if args.command == 'plan':
+            account_id, target_account_id = setup_accounts(args)
+            if account_id is None:
+                return
+            handle_plan(args, account_id, target_account_id)
+            return
+
         available_accounts = get_available_accounts()
-        if not available_accounts:
+        if not available_accounts and get_fake_api() is None:
             logging.error("No client_secret_*.json files found. Please ensure you have at least one client secret file.")
             return
 
         if args.command == 'get':
+            set_quota_project(args.account)
             account_id = setup_accounts(args)
             if account_id is None:
                 return
 
-            if args.subscriptions:
+            if args.subscriptions and args.dry_run and args.format == 'api':
+                handle_plan(args, account_id)
+            elif args.subscriptions:
                 handle_subscriptions(args, account_id)
             elif args.watched:
                 handle_watch_history(args, account_id)
 
         elif args.command == 'import':
+            # Inserts are charged to the target account's project
+            set_quota_project(args.to_account)
             source_account_id, target_account_id = setup_accounts(args)
             if source_account_id is None or target_account_id is None:
                 return
 
-            handle_import_subscriptions(args, source_account_id, target_account_id)
+            if args.dry_run:
+                handle_plan(args, source_account_id, target_account_id)
+            else:
+                handle_import_subscriptions(args, source_account_id, target_account_id)
+
+        elif args.command == 'sync':
+            account_names = available_accounts if args.all_accounts else args.account
+            sync_accounts(account_names, args.workers, args.max_ops, replay=args.replay)
+
+        elif args.command == 'refresh':
+            set_quota_project(args.account)
+            account_id = setup_accounts(args)
+            if account_id is None:
+                return
+
+            if args.dry_run:
+                handle_plan(args, account_id)
+            else:
+                handle_refresh_channel_details(args, account_id)
 
     except Exception as e:
         logging.error(f"An unexpected error occurred: {str(e)}")
         logging.error(f"Error details: {traceback.format_exc()}")
     finally:
-        if args.command != 'get' or not args.watched:
+        if args.command not in ('quota', 'plan', 'sync', 'search', 'report') and not (args.command == 'get' and args.watched):
             log_quota_info()
-        # Save quota details at the end of the script
-        save_quota_details()
+        # Write any buffered quota usage to the ledger
+        flush_quota_ledger()
+        if get_fake_api() is not None:
+            get_fake_api().log_cost_summary()
+        log_cache_statistics()
+        export_api_metrics(args.metrics_dir)
+        close_youtube_clients()
+        # Includes connections opened by worker and prefetch threads
+        close_db_connections(all_threads=True)
         logging.info("YouTube Subscription Manager finished")
 
-def handle_watch_history(args, account_id):
-    credentials_path = f'token_{args.account}.json'
-    watch_history = get_watch_history(credentials_path, args.max_results)
-    if watch_history:
-        print_watch_history(watch_history)
-    else:
-        logging.warning("Failed to retrieve watch history.")
-
 def log_quota_info():
     log_quota_information()
     
     actual_quota = get_actual_quota()
     remaining_quota = actual_quota - get_quota_usage()
     if remaining_quota <= 0:
-        next_reset = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0) + timedelta(days=1)
+        next_reset = get_next_quota_reset()
         logging.warning(f"Quota limit reached. The script will be able to process more subscriptions after the next reset.")
-        logging.info(f"Next quota reset: {next_reset.strftime('%Y-%m-%d %H:%M:%S')} (in {(next_reset - datetime.now()).total_seconds() / 3600:.2f} hours)")
+        logging.info(f"Next quota reset: {next_reset.strftime('%Y-%m-%d %H:%M:%S %Z')} (in {(next_reset - datetime.now(next_reset.tzinfo)).total_seconds() / 3600:.2f} hours)")
     else:
         estimated_remaining = estimate_processable_subscriptions()
         logging.info(f"Estimated number of additional subscriptions that can be processed: {estimated_remaining}")
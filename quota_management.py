@@ -1,79 +1,177 @@
-import json
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from dateutil import tz
+from database import get_db_connection, run_write
 from utils import log
 
 # Default daily quota for YouTube Data API v3
 DEFAULT_DAILY_QUOTA = 10000
 
-# Cost of different operations in quota units
+# Cost of API methods in quota units, see
+# https://developers.google.com/youtube/v3/determine_quota_cost
 QUOTA_COST = {
+    'subscriptions.list': 1,
+    'subscriptions.insert': 50,
+    'subscriptions.delete': 50,
+    'channels.list': 1,
+    'playlistItems.list': 1,
+    'videos.list': 1,
+    'search.list': 100,
+    # Generic operation classes
     'READ': 1,
     'WRITE': 50,
     'VIDEO_UPLOAD': 1600,
     'SEARCH': 100,
-    'LIST_VIDEOS': 1,  # per 5 videos
 }
 
-# Global variable to track quota usage
-quota_used = 0
+# YouTube quotas reset at midnight Pacific time
+QUOTA_TIMEZONE = tz.gettz('America/Los_Angeles')
+# Usage is buffered in memory and appended to the ledger in batches of this size
+LEDGER_FLUSH_SIZE = 50
+# Ledger key used until a run names the OAuth project/account it works for
+DEFAULT_QUOTA_PROJECT = 'default'
 
-def reset_quota():
-    global quota_used
-    quota_used = 0
+_ledger_lock = threading.Lock()
+_pending_entries = []  # (project, quota_day, operation, units, recorded_at)
+_recorded_usage = {}  # (project, quota_day) -> units already in the ledger
+_active_project = DEFAULT_QUOTA_PROJECT
+_local = threading.local()
+
+def set_quota_project(project):
+    # Project charged by this run unless a thread overrides it with quota_project()
+    global _active_project
+    _active_project = project
+
+@contextmanager
+def quota_project(project):
+    previous = getattr(_local, 'project', None)
+    _local.project = project
+    try:
+        yield
+    finally:
+        _local.project = previous
+
+def get_quota_project():
+    return getattr(_local, 'project', None) or _active_project
+
+def get_quota_day(now=None):
+    now = now or datetime.now(QUOTA_TIMEZONE)
+    return now.astimezone(QUOTA_TIMEZONE).strftime('%Y-%m-%d')
+
+def get_next_quota_reset():
+    now = datetime.now(QUOTA_TIMEZONE)
+    return (now + timedelta(days=1)).replace(hour=0, minute=0, second=0, microsecond=0)
+
+def get_operation_cost(operation, count=1):
+    cost = QUOTA_COST.get(operation, QUOTA_COST.get(operation.upper(), 1))
+    return cost * count
 
 def use_quota(operation, count=1):
-    global quota_used
-    cost = QUOTA_COST.get(operation.upper(), 1) * count
-    if check_quota_status(cost):
-        quota_used += cost
-        save_quota_details()
-        return True
-    return False
+    # Records calls that were already made, so it is never refused; callers check
+    # the budget beforehand with can_perform_operation()
+    cost = get_operation_cost(operation, count)
+    project, quota_day = get_quota_project(), get_quota_day()
+    with _ledger_lock:
+        _pending_entries.append((project, quota_day, operation, cost, time.time()))
+        if len(_pending_entries) >= LEDGER_FLUSH_SIZE:
+            _flush_locked()
 
 def get_actual_quota():
     return DEFAULT_DAILY_QUOTA
 
-def get_remaining_quota():
-    return get_actual_quota() - quota_used
+def get_remaining_quota(project=None):
+    return get_actual_quota() - get_quota_usage(project)
 
 def check_quota_status(cost=1):
     return get_remaining_quota() >= int(cost)
 
-def get_quota_usage():
-    return quota_used
+def get_quota_usage(project=None, quota_day=None):
+    with _ledger_lock:
+        return _usage_locked(project or get_quota_project(), quota_day or get_quota_day())
+
+def _usage_locked(project, quota_day):
+    key = (project, quota_day)
+    if key not in _recorded_usage:
+        _recorded_usage[key] = _read_recorded_usage(project, quota_day)
+    pending = sum(entry[3] for entry in _pending_entries if entry[0] == project and entry[1] == quota_day)
+    return _recorded_usage[key] + pending
+
+def _read_recorded_usage(project, quota_day):
+    conn = get_db_connection()
+    try:
+        row = conn.execute("SELECT COALESCE(SUM(units), 0) FROM quota_ledger WHERE project = ? AND quota_day = ?",
+                           (project, quota_day)).fetchone()
+        return row[0]
+    except sqlite3.Error as e:
+        log(f"An error occurred while reading the quota ledger: {e}")
+        return 0
+
+def flush_quota_ledger():
+    with _ledger_lock:
+        _flush_locked()
+
+def _flush_locked():
+    global _pending_entries
+    if not _pending_entries:
+        return
+    if not run_write(append_ledger_entries, _pending_entries):
+        return
+    # Re-read the totals so usage recorded by overlapping runs is picked up
+    for key in {(entry[0], entry[1]) for entry in _pending_entries}:
+        _recorded_usage[key] = _read_recorded_usage(*key)
+    _pending_entries = []
+
+def append_ledger_entries(entries):
+    # Runs on the shared database writer when there is one
+    conn = get_db_connection()
+    try:
+        with conn:
+            conn.executemany('''INSERT INTO quota_ledger (project, quota_day, operation, units, recorded_at)
+                                VALUES (?, ?, ?, ?, ?)''', entries)
+        return True
+    except sqlite3.Error as e:
+        log(f"An error occurred while writing the quota ledger: {e}")
+        return False
+
+def get_quota_history(project=None, days=7):
+    # Units used per (quota day, project, operation) over the last `days` quota days
+    flush_quota_ledger()
+    since = get_quota_day(datetime.now(QUOTA_TIMEZONE) - timedelta(days=days - 1))
+    query = '''SELECT quota_day, project, operation, SUM(units), COUNT(*) FROM quota_ledger
+               WHERE quota_day >= ?'''
+    params = [since]
+    if project:
+        query += " AND project = ?"
+        params.append(project)
+    query += " GROUP BY quota_day, project, operation ORDER BY quota_day, project, operation"
+    conn = get_db_connection()
+    try:
+        return [{'quota_day': row[0], 'project': row[1], 'operation': row[2], 'units': row[3], 'calls': row[4]}
+                for row in conn.execute(query, params)]
+    except sqlite3.Error as e:
+        log(f"An error occurred while reading the quota ledger: {e}")
+        return []
 
 def estimate_processable_subscriptions():
-    remaining_quota = get_remaining_quota()
-    # Assuming each subscription requires a READ and a WRITE operation
-    cost_per_subscription = QUOTA_COST['READ'] + QUOTA_COST['WRITE']
-    return remaining_quota // cost_per_subscription
+    # Imports are dominated by one subscriptions.insert per channel
+    return get_remaining_quota() // QUOTA_COST['subscriptions.insert']
 
 def log_quota_information():
-    remaining_quota = get_remaining_quota()
-    log(f"Quota usage: {quota_used}")
-    log(f"Remaining quota: {remaining_quota}")
+    log(f"Quota project: {get_quota_project()} (quota day {get_quota_day()})")
+    log(f"Quota usage: {get_quota_usage()}")
+    log(f"Remaining quota: {get_remaining_quota()}")
     log(f"Estimated processable subscriptions: {estimate_processable_subscriptions()}")
 
+def log_quota_history(project=None, days=7):
+    history = get_quota_history(project, days)
+    if not history:
+        log("No quota usage recorded in this period.")
+        return
+    for entry in history:
+        log(f"{entry['quota_day']} {entry['project']}: {entry['operation']} {entry['units']} units ({entry['calls']} charges)")
+
 def can_perform_operation(operation, count=1):
-    cost = QUOTA_COST.get(operation.upper(), 1) * count
-    return check_quota_status(cost)
-
-def save_quota_details():
-    quota_details = {
-        'quota_used': quota_used,
-        'remaining_quota': get_remaining_quota(),
-        'estimated_processable_subscriptions': estimate_processable_subscriptions()
-    }
-    with open('quota_details.json', 'w') as f:
-        json.dump(quota_details, f)
-
-def load_quota_details():
-    global quota_used
-    try:
-        with open('quota_details.json', 'r') as f:
-            quota_details = json.load(f)
-        quota_used = quota_details['quota_used']
-        log("Loaded quota details from file.")
-        log_quota_information()
-    except FileNotFoundError:
-        log("No saved quota details found. Starting with fresh quota.")
-        reset_quota()
+    return check_quota_status(get_operation_cost(operation, count))
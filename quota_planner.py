@@ -0,0 +1,122 @@
+from datetime import timedelta
+from channel_details import MAX_CHANNELS_PER_REQUEST
+from channel_refresh import ACTIVE_CHANNEL_TTL_DAYS, DORMANT_CHANNEL_TTL_DAYS, get_stale_channel_ids, detail_fetch_cost
+from database import count_account_subscriptions, count_import_candidates
+from quota_management import QUOTA_COST, get_actual_quota, get_remaining_quota, get_quota_day, get_next_quota_reset
+from utils import log
+
+# Rough wall-clock time of one read call, used for time estimates
+SECONDS_PER_READ_CALL = 0.3
+
+# Tasks with a lower priority value get each day's budget first
+PRIORITY_LISTING = 0
+PRIORITY_IMPORT = 1
+PRIORITY_REFRESH = 2
+
+def plan_listing(account_name, account_id):
+    # Listing pays one subscriptions.list call per page of 50; the stored
+    # subscription count is the best guess for the number of pages
+    pages = max(1, -(-count_account_subscriptions(account_id) // MAX_CHANNELS_PER_REQUEST))
+    return {
+        'name': f"list subscriptions of {account_name}",
+        'project': account_name,
+        'unit': 'pages',
+        'count': pages,
+        'priority': PRIORITY_LISTING,
+        'cost': lambda pages: pages * QUOTA_COST['subscriptions.list'],
+        'seconds': lambda pages: pages * SECONDS_PER_READ_CALL,
+    }
+
+def plan_refresh(account_name, account_id, limit=None,
+                 active_ttl_days=ACTIVE_CHANNEL_TTL_DAYS, dormant_ttl_days=DORMANT_CHANNEL_TTL_DAYS):
+    stale = len(get_stale_channel_ids(account_id, active_ttl_days, dormant_ttl_days))
+    if limit is not None:
+        stale = min(stale, limit)
+    return {
+        'name': f"refresh stale channel details of {account_name}",
+        'project': account_name,
+        'unit': 'channels',
+        'count': stale,
+        'priority': PRIORITY_REFRESH,
+        'cost': detail_fetch_cost,
+        'seconds': lambda channels: (channels + -(-channels // MAX_CHANNELS_PER_REQUEST)) * SECONDS_PER_READ_CALL,
+    }
+
+def plan_import(source_name, source_account_id, target_name, target_account_id, rate, limit=None):
+    candidates = count_import_candidates(source_account_id, target_account_id)
+    if limit is not None:
+        candidates = min(candidates, limit)
+    # Inserts are charged to the target account's project
+    return {
+        'name': f"import subscriptions from {source_name} to {target_name}",
+        'project': target_name,
+        'unit': 'subscriptions',
+        'count': candidates,
+        'priority': PRIORITY_IMPORT,
+        'cost': lambda subscriptions: subscriptions * QUOTA_COST['subscriptions.insert'],
+        'seconds': lambda subscriptions: subscriptions / rate,
+    }
+
+def affordable_count(task, remaining, budget):
+    # Largest number of items whose cost fits the budget (costs only grow with the count)
+    low, high = 0, remaining
+    while low < high:
+        middle = (low + high + 1) // 2
+        if task['cost'](middle) <= budget:
+            low = middle
+        else:
+            high = middle - 1
+    return low
+
+def build_schedule(tasks, remaining_today=None, daily_quota=None):
+    # Greedily fill each quota day in priority order. A cheaper, lower priority
+    # task can use budget that is too small for the next item of a higher one.
+    # Every project (account) has its own daily budget.
+    daily_quota = get_actual_quota() if daily_quota is None else daily_quota
+    tasks = sorted((task for task in tasks if task['count'] > 0), key=lambda task: task['priority'])
+    remaining = {id(task): task['count'] for task in tasks}
+    for task in tasks:
+        if task['cost'](1) > daily_quota:
+            raise ValueError(f"A single item of '{task['name']}' costs more than the daily quota")
+
+    projects = {task['project'] for task in tasks}
+    if remaining_today is None:
+        budgets = {project: get_remaining_quota(project) for project in projects}
+    else:
+        budgets = {project: remaining_today.get(project, daily_quota) for project in projects}
+
+    schedule = []
+    while any(remaining.values()):
+        day = {'entries': [], 'units': 0, 'seconds': 0.0}
+        for task in tasks:
+            count = affordable_count(task, remaining[id(task)], budgets[task['project']])
+            if count == 0:
+                continue
+            units = task['cost'](count)
+            day['entries'].append({'name': task['name'], 'unit': task['unit'], 'count': count, 'units': units})
+            day['units'] += units
+            day['seconds'] += task['seconds'](count)
+            budgets[task['project']] -= units
+            remaining[id(task)] -= count
+        schedule.append(day)
+        budgets = {project: daily_quota for project in projects}
+
+    first_day = get_next_quota_reset() - timedelta(days=1)
+    for offset, day in enumerate(schedule):
+        day['quota_day'] = get_quota_day(first_day + timedelta(days=offset))
+    return schedule
+
+def log_schedule(tasks, schedule):
+    total_units = sum(day['units'] for day in schedule)
+    total_seconds = sum(day['seconds'] for day in schedule)
+    log("--- Quota plan ---")
+    for task in tasks:
+        log(f"Pending: {task['name']}: {task['count']} {task['unit']}, {task['cost'](task['count'])} units")
+    if not schedule:
+        log("Nothing to do.")
+        return
+    for day in schedule:
+        log(f"{day['quota_day']}: {day['units']} units, about {day['seconds'] / 60:.1f} minutes")
+        for entry in day['entries']:
+            log(f"  - {entry['name']}: {entry['count']} {entry['unit']} ({entry['units']} units)")
+    log(f"Total: {total_units} units over {len(schedule)} quota day(s), about {total_seconds / 60:.1f} minutes of API time.")
@@ -0,0 +1,22 @@
+import time
+from datetime import datetime, timezone
+from database import get_channel_report
+from utils import log
+
+def format_epoch(epoch):
+    if epoch is None:
+        return 'unknown'
+    return datetime.fromtimestamp(epoch, timezone.utc).strftime('%Y-%m-%d')
+
+def handle_report(args):
+    # Most watched channels of an account from the precomputed statistics; no API calls
+    started = time.perf_counter()
+    channels = get_channel_report(args.account, args.order, args.limit)
+    log(f"Channels watched on {args.account} by {args.order}: {len(channels)} results "
+        f"in {(time.perf_counter() - started) * 1000:.1f} ms")
+    for channel in channels:
+        upload_rate = 'unknown' if channel['upload_rate'] is None else f"{channel['upload_rate']:.2f}/day"
+        log(f"- {channel['title'] or channel['channel_id']}: {channel['watch_count']} watched, "
+            f"{format_epoch(channel['first_watched'])} to {format_epoch(channel['last_watched'])}, "
+            f"uploads {upload_rate}{'' if channel['subscribed'] else ', not subscribed'}")
+    return True
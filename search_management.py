@@ -0,0 +1,27 @@
+import time
+from database import search_channels, search_watch_history
+from utils import log
+
+def handle_search(args):
+    # Ranked full-text search over the local database; no API calls and no quota
+    query = ' '.join(args.query)
+    offset = (args.page - 1) * args.limit
+    account_note = f" for account {args.account}" if args.account else ""
+
+    if args.scope in ('subscriptions', 'all'):
+        started = time.perf_counter()
+        channels = search_channels(query, args.account, args.limit, offset)
+        log(f"Channels matching '{query}'{account_note}, page {args.page}: {len(channels)} results "
+            f"in {(time.perf_counter() - started) * 1000:.1f} ms")
+        for channel in channels:
+            log(f"- {channel['title']} ({channel['channel_id']}), followed by: {channel['accounts'] or 'no account'}")
+            log(f"    {channel['snippet']}")
+
+    if args.scope in ('history', 'all'):
+        started = time.perf_counter()
+        videos = search_watch_history(query, args.account, args.limit, offset)
+        log(f"Watched videos matching '{query}'{account_note}, page {args.page}: {len(videos)} results "
+            f"in {(time.perf_counter() - started) * 1000:.1f} ms")
+        for video in videos:
+            log(f"- {video['watch_time']} [{video['account']}] {video['title']} {video['url'] or ''}")
+    return True
@@ -1,69 +1,145 @@
+import itertools
 import logging
+import random
+import threading
 import time
-from googleapiclient.errors import HttpError
-from progress_tracking import load_progress, save_progress
-from database import get_existing_subscriptions, store_subscriptions_in_db, update_database_schema, flag_problematic_subscription
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from utils import TokenBucket, retry_attempt
+from quota_management import use_quota, get_remaining_quota, get_quota_project, quota_project, QUOTA_COST
+from database import (update_database_schema, get_checkpoint, clear_checkpoint, record_import_results,
+                      count_import_candidates, iter_import_candidates, PERMANENT_IMPORT_FAILURES)
 
-def import_subscriptions(source_youtube, target_youtube, source_account_id, target_account_id, max_ops=None):
+# Default throughput of the import executor; tunable with --workers and --rate
+DEFAULT_IMPORT_WORKERS = 4
+DEFAULT_IMPORT_RATE = 5  # subscriptions.insert calls per second
+# Import results written to the database, with the resume position, per transaction
+IMPORT_COMMIT_BATCH = 25
+# Inserts queued ahead per worker, so candidates are read from the database as they are needed
+IMPORT_QUEUE_PER_WORKER = 2
+
+def import_operation(source_account_id):
+    # Import checkpoints are kept per source and target account pair
+    return f"import_subscriptions:{source_account_id}"
+
+def import_subscriptions(source_youtube, target_youtube, source_account_id, target_account_id, max_ops=None,
+                         workers=DEFAULT_IMPORT_WORKERS, rate=DEFAULT_IMPORT_RATE, client_factory=None):
     logging.info("Importing subscriptions from source to target account...")
     update_database_schema()  # Ensure the database schema is up to date
-    existing_subs_source, subs_source = get_existing_subscriptions(source_account_id)
-    existing_subs_target, _ = get_existing_subscriptions(target_account_id)
-    last_processed = load_progress()
-    
-    if last_processed:
-        logging.info(f"Resuming import from channel ID: {last_processed}")
+    checkpoint = get_checkpoint(import_operation(source_account_id), target_account_id)
     
-    if not source_youtube:
-        logging.warning("No subscriptions found in the source account.")
-        return
+    if checkpoint:
+        logging.info(f"Resuming import after channel ID: {checkpoint['last_item']}")
     
-    subs_to_import = filter_subscriptions(subs_source, existing_subs_target)
-    logging.info(f"Found {len(subs_to_import)} new subscriptions to import.")
+    # The diff is computed and streamed by SQLite; a checkpoint resumes after its last channel
+    after = checkpoint['last_item'] if checkpoint else None
+    total = count_import_candidates(source_account_id, target_account_id, after=after)
+    logging.info(f"Found {total} new subscriptions to import.")
+    subs_to_import = iter_import_candidates(source_account_id, target_account_id, after=after)
     
-    return process_subscriptions(target_youtube, subs_to_import, source_account_id, target_account_id, max_ops, last_processed)
+    return process_subscriptions(target_youtube, subs_to_import, total, source_account_id, target_account_id, max_ops, checkpoint,
+                                 workers, rate, client_factory)
 
-def filter_subscriptions(subs_source, existing_subs_target):
-    return [sub for sub in subs_source if sub['channel_id'] not in existing_subs_target]
-
-def process_subscriptions(target_youtube, subs_to_import, source_account_id, target_account_id, max_ops, last_processed):
+def process_subscriptions(target_youtube, subs_to_import, total, source_account_id, target_account_id, max_ops, checkpoint=None,
+                          workers=DEFAULT_IMPORT_WORKERS, rate=DEFAULT_IMPORT_RATE, client_factory=None):
+    # subs_to_import is an iterable of the total candidates, in the order they are imported
     imported_count = 0
     already_subscribed_count = 0
     failed_count = 0
     processed_count = 0
-    
-    for sub in subs_to_import:
-        if max_ops is not None and processed_count >= max_ops:
-            logging.info(f"Reached max operations limit ({max_ops}). Stopping import.")
-            break
-
-        if last_processed and sub['channel_id'] == last_processed:
-            logging.info(f"Resuming from channel: {sub['title']}")
-            last_processed = None  # Reset last_processed to continue processing
-            continue
-        
-        logging.info(f"Attempting to import subscription: {sub['title']} (ID: {sub['channel_id']})")
-        result = import_subscription(target_youtube, sub)
-        
-        if result == 'success':
-            imported_count += 1
-        elif result == 'already_subscribed':
-            already_subscribed_count += 1
+    operation = import_operation(source_account_id)
+    previously_processed = checkpoint['processed'] if checkpoint else 0
+
+    limit = total
+    if max_ops is not None and limit > max_ops:
+        logging.info(f"Reached max operations limit ({max_ops}). Importing the first {max_ops} subscriptions.")
+        limit = max_ops
+    affordable = get_remaining_quota() // QUOTA_COST['subscriptions.insert']
+    if limit > affordable:
+        logging.warning(f"Remaining quota covers {affordable} of {limit} subscriptions. Importing the first {affordable}.")
+        limit = affordable
+    pending = itertools.islice(subs_to_import, limit)
+
+    # googleapiclient clients are not thread-safe, so each worker needs its own
+    if client_factory is None and workers > 1:
+        logging.warning("No client factory given. Falling back to a single import worker.")
+        workers = 1
+
+    limiter = TokenBucket(rate)
+    local = threading.local()
+    # Workers charge their inserts to the caller's quota project
+    project = get_quota_project()
+    # Set once the API reports the quota as exhausted, so no further inserts are sent
+    quota_exceeded = threading.Event()
+    linked, failures = [], []
+    last_recorded = None
+
+    def record_results(last_channel_id):
+        nonlocal linked, failures, last_recorded
+        if last_channel_id is None or last_channel_id == last_recorded:
+            return
+        record_import_results(target_account_id, source_account_id, linked, failures, checkpoint=dict(
+            operation=operation, account_id=target_account_id, processed=previously_processed + processed_count,
+            last_item=last_channel_id))
+        linked, failures = [], []
+        last_recorded = last_channel_id
+
+    def import_worker(sub):
+        if quota_exceeded.is_set():
+            return 'quota_exceeded'
+        if client_factory is None:
+            youtube = target_youtube
         else:
-            failed_count += 1
-            flag_problematic_subscription(source_account_id, sub['channel_id'], result)
-        
-        logging.info(f"Storing subscription in database: {sub['title']} (ID: {sub['channel_id']})")
-        store_subscriptions_in_db([sub], source_account_id)
-        logging.info(f"Updated database for {sub['title']} in source account.")
-        
-        save_progress(sub['channel_id'])
-        processed_count += 1
-        
-        if processed_count % 10 == 0:
-            logging.info(f"Progress: Processed {processed_count} out of {len(subs_to_import)} subscriptions")
-        
-        time.sleep(1)  # Add a delay to avoid hitting rate limits
+            if not hasattr(local, 'youtube'):
+                local.youtube = client_factory()
+            youtube = local.youtube
+        logging.info(f"Attempting to import subscription: {sub['title']} (ID: {sub['channel_id']})")
+        with quota_project(project):
+            result = import_subscription(youtube, sub, limiter)
+        if result == 'quota_exceeded':
+            quota_exceeded.set()
+        return result
+
+    logging.info(f"Importing {limit} subscriptions with {workers} workers at up to {rate} requests per second.")
+    executor = ThreadPoolExecutor(max_workers=workers)
+    last_channel_id = None
+    try:
+        # Results come back in submission order, so progress stays resumable.
+        # Database bookkeeping happens on this thread only.
+        for sub, result in map_in_order(executor, import_worker, pending, workers * IMPORT_QUEUE_PER_WORKER):
+            if result == 'quota_exceeded':
+                # The checkpoint stays before this channel, so the next run starts with it
+                logging.error("Quota exceeded. Stopping the import; the rest is imported after the quota resets.")
+                break
+            if result == 'success':
+                imported_count += 1
+            elif result == 'already_subscribed':
+                already_subscribed_count += 1
+            else:
+                failed_count += 1
+                # Transient failures stay import candidates for the next run
+                if result in PERMANENT_IMPORT_FAILURES:
+                    failures.append((sub['channel_id'], result))
+
+            if result in ('success', 'already_subscribed'):
+                linked.append(sub['channel_id'])
+
+            last_channel_id = sub['channel_id']
+            processed_count += 1
+
+            if processed_count % IMPORT_COMMIT_BATCH == 0:
+                record_results(last_channel_id)
+            if processed_count % 10 == 0:
+                logging.info(f"Progress: Processed {processed_count} out of {limit} subscriptions")
+    except KeyboardInterrupt:
+        logging.info("Import interrupted. Cancelling pending subscriptions...")
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+        # Results already paid for are recorded even if the import was interrupted
+        record_results(last_channel_id)
+
+    if processed_count == total:
+        clear_checkpoint(operation, target_account_id)
     
     logging.info("Subscription import completed.")
     logging.info(f"Total processed: {processed_count}")
@@ -78,36 +154,63 @@ def process_subscriptions(target_youtube, subs_to_import, source_account_id, tar
         'failed': failed_count
     }
 
-def import_subscription(target_youtube, sub):
+def map_in_order(executor, function, items, window):
+    # Like executor.map, but submits at most `window` items ahead of the result
+    # being consumed instead of draining the whole iterable up front
+    running = deque()
+    for item in items:
+        running.append((item, executor.submit(function, item)))
+        if len(running) >= window:
+            item, future = running.popleft()
+            yield item, future.result()
+    while running:
+        item, future = running.popleft()
+        yield item, future.result()
+
+def import_subscription(target_youtube, sub, limiter=None):
+    from googleapiclient.errors import HttpError
     max_retries = 3
-    retry_delay = 5  # seconds
+    retry_delay = 1  # seconds, doubled on every retry
 
     for attempt in range(max_retries):
+        if limiter is not None:
+            limiter.acquire()
         try:
             logging.info(f"Attempt {attempt + 1} to subscribe to {sub['title']} (ID: {sub['channel_id']})")
-            target_youtube.subscriptions().insert(
-                part="snippet",
-                body={
-                    "snippet": {
-                        "resourceId": {
-                            "kind": "youtube#channel",
-                            "channelId": sub['channel_id']
+            with retry_attempt(attempt):
+                request = target_youtube.subscriptions().insert(
+                    part="snippet",
+                    body={
+                        "snippet": {
+                            "resourceId": {
+                                "kind": "youtube#channel",
+                                "channelId": sub['channel_id']
+                            }
                         }
                     }
-                }
-            ).execute()
+                )
+                try:
+                    request.execute()
+                finally:
+                    # Every attempt that reaches the API is charged, retries included
+                    use_quota('subscriptions.insert')
             logging.info(f"Successfully subscribed to {sub['title']} in target account.")
             return 'success'
         except HttpError as e:
-            if e.resp.status == 400 and 'subscriptionDuplicate' in str(e):
+            if e.resp.status == 403 and 'quotaExceeded' in str(e):
+                # The quota only resets at midnight Pacific time
+                logging.error(f"Quota exceeded while subscribing to {sub['title']} (ID: {sub['channel_id']}).")
+                return 'quota_exceeded'
+            elif e.resp.status == 400 and 'subscriptionDuplicate' in str(e):
                 logging.info(f"Already subscribed to {sub['title']} in target account.")
                 return 'already_subscribed'
             elif e.resp.status == 404:
                 logging.warning(f"Channel not found for {sub['title']} (ID: {sub['channel_id']}). It may have been deleted or made private.")
                 return 'channel_not_found'
             elif attempt < max_retries - 1:
-                logging.warning(f"Failed to subscribe to {sub['title']} (ID: {sub['channel_id']}). Retrying in {retry_delay} seconds...")
-                time.sleep(retry_delay)
+                wait_time = retry_delay * (2 ** attempt) + random.random()
+                logging.warning(f"Failed to subscribe to {sub['title']} (ID: {sub['channel_id']}). Retrying in {wait_time:.2f} seconds...")
+                time.sleep(wait_time)
             else:
                 logging.error(f"Failed to subscribe to {sub['title']} (ID: {sub['channel_id']}) after {max_retries} attempts: {e}")
                 return 'subscription_failed'
@@ -1,100 +1,211 @@
-from googleapiclient.errors import HttpError
-import time
-from utils import log
-from quota_management import check_quota_status, use_quota, can_perform_operation
-from progress_tracking import save_progress, load_progress
-from channel_details import get_channel_details
-
-def list_subscriptions(youtube, existing_subs, account_name, max_ops=None):
+from utils import log, prefetch
+from quota_management import use_quota, can_perform_operation, get_remaining_quota, get_quota_project, quota_project
+from channel_refresh import affordable_refreshes
+from database import (DatabaseWriter, get_checkpoint, clear_checkpoint, store_subscriptions_in_db, open_snapshot, complete_snapshot,
+                      run_write)
+from channel_details import get_channels_details
+
+# Checkpoint operation of a subscription listing, resumed per account
+LIST_OPERATION = 'list_subscriptions'
+# subscriptions.list pages fetched ahead of the page being enriched
+PREFETCH_PAGES = 1
+
+def list_subscriptions(youtube, existing_subs, account_name, max_ops=None, account_id=None,
+                       store=store_subscriptions_in_db, client_factory=None, writer=None):
+    # Collects every listed channel. Callers that store the pages should iterate
+    # iter_subscription_pages() instead, so memory stays bounded by one page.
+    subscriptions = []
+    for page in iter_subscription_pages(youtube, existing_subs, account_name, max_ops, account_id, store, client_factory, writer):
+        subscriptions.extend(page)
+    log(f"Found {len(subscriptions)} subscriptions.")
+    return subscriptions
+
+def iter_subscription_pages(youtube, existing_subs, account_name, max_ops=None, account_id=None,
+                            store=store_subscriptions_in_db, client_factory=None, writer=None):
+    # Yields enriched pages of subscriptions. With a client_factory the next page is
+    # fetched on a background thread while the current one is enriched. With an
+    # account_id every page is stored on a writer thread together with the position
+    # after it, and only yielded once committed, so an interrupted run keeps every
+    # page it paid for and resumes at the first page that was not stored. The stored
+    # channels also make up the account's snapshot, completed when the listing is.
+    # Pass the caller's DatabaseWriter as writer to store on it instead of a new one.
+    from googleapiclient.errors import HttpError
     log("Listing subscriptions...")
-    if not can_perform_operation('SEARCH'):
+    if not can_perform_operation('subscriptions.list'):
         log("Not enough quota to perform search operation.")
-        return []
-
-    progress = load_progress()
-    last_processed, page_token = progress.get('channel_id'), progress.get('page_token')
+        return
 
-    if last_processed:
-        log(f"Resuming from last processed channel ID: {last_processed}")
+    checkpoint = get_checkpoint(LIST_OPERATION, account_id) if account_id is not None else None
+    if checkpoint:
+        page_token, page_offset, processed = checkpoint['page_token'], checkpoint['page_offset'], checkpoint['processed']
+        log(f"Resuming after {processed} subscriptions, last stored channel ID: {checkpoint['last_item']}")
     else:
+        page_token, page_offset, processed = None, 0, 0
         log("Starting from the beginning of the subscription list")
+    snapshot_id = run_write(open_snapshot, account_id, resume=checkpoint is not None) if account_id is not None else None
+    if account_id is not None and snapshot_id is None:
+        log("No open snapshot to resume. This listing will not produce subscription deltas.")
 
-    request = youtube.subscriptions().list(
-        part="snippet",
-        mine=True,
-        maxResults=50,
-        pageToken=page_token
-    )
-
-    subscriptions = []
+    own_writer = writer is None and account_id is not None
+    if own_writer:
+        writer = DatabaseWriter()
+    pending = None  # (page, future) of the page being stored while the next one is enriched
+    listed = 0
+    finished = False
+    pages = subscription_pages(youtube, page_token, page_offset, max_ops, client_factory)
 
     try:
-        while request:
-            if not can_perform_operation('SEARCH'):
-                log("Quota limit reached. Stopping the process.")
-                break
+        for page_token, page_offset, response in pages:
+            items = response['items'][page_offset:]
+            if max_ops is not None:
+                items = items[:max_ops - listed]
 
-            if max_ops is not None and len(subscriptions) >= max_ops:
-                log(f"Reached max-ops limit of {max_ops}. Stopping the process.")
-                break
+            page = process_channel_items(youtube, items, existing_subs, account_name)
+            # Channels skipped for lack of quota are listed again on the next run
+            kept = {channel_info['channel_id'] for channel_info in page}
+            consumed = next((index for index, item in enumerate(items)
+                             if item['snippet']['resourceId']['channelId'] not in kept), len(items))
+            page_offset += consumed
+            page_done = page_offset >= len(response['items'])
+            if page_done:
+                position = {'page_token': response.get('nextPageToken'), 'page_offset': 0}
+            else:
+                position = {'page_token': page_token, 'page_offset': page_offset}
+            processed += len(page)
+            listed += len(page)
 
-            log("Executing API request...")
-            response = request.execute()
-            use_quota('SEARCH')
-            log(f"API response received. Status: {response.get('kind', 'Unknown')}")
+            if account_id is None:
+                yield page
+            elif page:
+                if pending is not None:
+                    if not pending[1].result():
+                        log("Failed to store the page. Stopping the process.")
+                        pending = None
+                        break
+                    yield pending[0]
+                pending = (page, writer.submit(store, page, account_id, checkpoint=dict(
+                    operation=LIST_OPERATION, account_id=account_id, processed=processed,
+                    last_item=page[-1]['channel_id'], **position), snapshot_id=snapshot_id))
 
-            if 'items' not in response:
-                log(f"Unexpected API response: {response}")
+            # A page that was cut short, even before its first channel, ends this run;
+            # the checkpoint still points at its first channel that was not stored
+            if not page_done:
                 break
-
-            for item in response['items']:
-                if max_ops is not None and len(subscriptions) >= max_ops:
-                    break
-
-                channel_id = item['snippet']['resourceId']['channelId']
-                
-                channel_info = process_channel_item(youtube, item, channel_id, existing_subs, account_name)
-                
-                if channel_info:
-                    subscriptions.append(channel_info)
-                    save_progress({'channel_id': channel_id, 'page_token': response.get('nextPageToken')})
-                    # time.sleep(.1)  # Add a delay to avoid hitting rate limits
-            
-            if max_ops is not None and len(subscriptions) >= max_ops:
+            if position['page_token'] is None:
+                finished = True
                 break
-            request = youtube.subscriptions().list_next(request, response)
     except HttpError as e:
         handle_http_error(e)
     except Exception as e:
         log(f"An unexpected error occurred: {str(e)}")
     except KeyboardInterrupt:
-        log("Script interrupted. Saving progress...")
-    
-    log(f"Found {len(subscriptions)} subscriptions.")
-    return subscriptions
+        log("Script interrupted. Stored pages are kept and the next run resumes after them.")
+    finally:
+        pages.close()
+        if own_writer:
+            # The page already being written is committed before the listing stops
+            writer.close()
+
+    if pending is not None:
+        if pending[1].result():
+            yield pending[0]
+        else:
+            log("Failed to store the page. Stopping the process.")
+            finished = False
+    # A snapshot is only complete once every listed channel has been stored. Channels
+    # missing from an incomplete one would be recorded, unlinked and replayed as removed.
+    if finished and account_id is not None:
+        if snapshot_id is not None:
+            run_write(complete_snapshot, snapshot_id)
+        run_write(clear_checkpoint, LIST_OPERATION, account_id)
+    elif snapshot_id is not None:
+        log("The listing is incomplete. Its snapshot stays open until a later run lists the rest.")
+
+def subscription_pages(youtube, page_token, page_offset, max_ops=None, client_factory=None):
+    if client_factory is None:
+        return fetch_subscription_pages(youtube, page_token, page_offset, max_ops)
+
+    project = get_quota_project()
+
+    def fetch():
+        # httplib2 is not thread-safe, so the prefetch thread lists with its own
+        # client, charged to the caller's quota project
+        with quota_project(project):
+            client = client_factory()
+            try:
+                yield from fetch_subscription_pages(client, page_token, page_offset, max_ops)
+            finally:
+                client.close()
+
+    return prefetch(fetch, PREFETCH_PAGES)
+
+def fetch_subscription_pages(youtube, page_token, page_offset, max_ops=None):
+    # Yields (page_token, page_offset, response) for consecutive subscriptions.list
+    # pages from the given position until the list, the quota or max_ops runs out
+    listed = 0
+    request = youtube.subscriptions().list(
+        part="snippet",
+        mine=True,
+        maxResults=50,
+        pageToken=page_token
+    )
+    while request:
+        if max_ops is not None and listed >= max_ops:
+            log(f"Reached max-ops limit of {max_ops}. Stopping the process.")
+            return
+        if not can_perform_operation('subscriptions.list'):
+            log("Quota limit reached. Stopping the process.")
+            return
+
+        log("Executing API request...")
+        response = request.execute()
+        use_quota('subscriptions.list')
+        log(f"API response received. Status: {response.get('kind', 'Unknown')}")
+
+        if 'items' not in response:
+            log(f"Unexpected API response: {response}")
+            return
+
+        yield page_token, page_offset, response
+        listed += len(response['items']) - page_offset
+        page_token, page_offset = response.get('nextPageToken'), 0
+        if page_token is None:
+            return
+        request = youtube.subscriptions().list_next(request, response)
+
+def process_channel_items(youtube, items, existing_subs, account_name):
+    channels = []
+    for item in items:
+        channel_info = {
+            'channel_id': item['snippet']['resourceId']['channelId'],
+            'title': item['snippet']['title'],
+            'description': item['snippet']['description'],
+            'published_at': item['snippet']['publishedAt']
+        }
+        log(f"Processing channel: {channel_info['title']} ({channel_info['channel_id']})")
+        channels.append(channel_info)
+
+    # Resolve details for all new channels on the page with one batched call
+    new_channel_ids = [c['channel_id'] for c in channels if c['channel_id'] not in existing_subs]
+    if not new_channel_ids:
+        return channels
+
+    affordable = affordable_refreshes(get_remaining_quota())
+    if affordable < len(new_channel_ids):
+        log(f"Not enough quota to fetch channel details for {len(new_channel_ids)} channels. Fetching {affordable}.")
+        skipped = set(new_channel_ids[affordable:])
+        new_channel_ids = new_channel_ids[:affordable]
+        channels = [c for c in channels if c['channel_id'] not in skipped]
+        if not new_channel_ids:
+            return channels
+
+    # Charges its own calls, retries included
+    details = get_channels_details(youtube, new_channel_ids)
+    for channel_info in channels:
+        if channel_info['channel_id'] in details:
+            channel_info.update(details[channel_info['channel_id']])
 
-def process_channel_item(youtube, item, channel_id, existing_subs, account_name):
-    channel_info = {
-        'channel_id': channel_id,
-        'title': item['snippet']['title'],
-        'description': item['snippet']['description'],
-        'published_at': item['snippet']['publishedAt']
-    }
-    
-    log(f"Processing channel: {channel_info['title']} ({channel_id})")
-    
-    # Check if we need to update the channel details
-    if channel_id not in existing_subs:
-        if not can_perform_operation('READ'):
-            log("Not enough quota to fetch channel details.")
-            return None
-        # Get additional channel details
-        details = get_channel_details(youtube, channel_id)
-        if details:
-            channel_info.update(details)
-            use_quota('READ')
-    
-    return channel_info
+    return channels
 
 def handle_http_error(e):
     if e.resp.status == 403 and 'quotaExceeded' in str(e):
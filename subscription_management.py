@@ -1,10 +1,12 @@
 import os
-from datetime import datetime, timedelta
+from datetime import datetime
 from auth import authenticate_youtube
 from database import get_existing_subscriptions, store_subscriptions_in_db
-from youtube_api import list_subscriptions, import_subscriptions
-from quota_management import check_quota_status, get_remaining_quota, estimate_processable_subscriptions, log_quota_information, can_perform_operation
-from progress_tracking import load_progress
+from youtube_api import iter_subscription_pages, import_subscriptions
+from quota_management import check_quota_status, get_remaining_quota, estimate_processable_subscriptions, log_quota_information, can_perform_operation, get_next_quota_reset
+from channel_refresh import get_stale_channel_ids, refresh_stale_channels
+from quota_planner import plan_listing, plan_refresh, plan_import, build_schedule, log_schedule
+from subscription_import import DEFAULT_IMPORT_RATE
 from utils import log, parse_subscriptions_csv
 
 def handle_subscriptions(args, account_id):
@@ -28,7 +30,7 @@ def handle_csv_subscriptions(args, account_id):
     return True
 
 def handle_api_subscriptions(args, account_id):
-    if not can_perform_operation('SEARCH'):
+    if not can_perform_operation('subscriptions.list'):
         log_quota_limit_reached()
         return False
 
@@ -38,38 +40,68 @@ def handle_api_subscriptions(args, account_id):
 
     existing_subs, _ = get_existing_subscriptions(account_id)
     log(f"Existing subscriptions: {len(existing_subs)}")
+    # Channels with stale details are re-fetched while listing
+    fresh_subs = existing_subs - get_stale_channel_ids(account_id)
+    log(f"Channels with fresh details: {len(fresh_subs)}")
     
     youtube_source = authenticate_youtube(args.account)
-    source_subscriptions = list_subscriptions(youtube_source, existing_subs, args.account, args.max_ops)
+    # Pages are committed as they are listed, so only a running count is kept here.
+    # The next page is prefetched with the prefetch thread's own client from the registry.
+    fetched = new = details_fetched = 0
+    for page in iter_subscription_pages(youtube_source, fresh_subs, args.account, args.max_ops, account_id,
+                                        client_factory=lambda: authenticate_youtube(args.account)):
+        fetched += len(page)
+        new += sum(1 for channel in page if channel['channel_id'] not in existing_subs)
+        details_fetched += sum(1 for channel in page if 'details_fetched_at' in channel)
+        log(f"Stored {len(page)} channels ({fetched} so far):")
+        for channel in page:
+            log(f"- {channel['channel_id']}")
     
-    if not source_subscriptions:
+    if not fetched:
         log("No subscriptions found or processed in the source account. This could be due to quota limitations.")
         return False
     
-    log(f"Fetched {len(source_subscriptions)} subscriptions from YouTube API")
-    
-    updated_channels = store_subscriptions_in_db(source_subscriptions, account_id)
-    
     log("\n--- Summary ---")
-    log(f"Total subscriptions processed: {len(source_subscriptions)}")
-    log(f"Updated or new channels: {len(updated_channels)}")
-    
-    log("Details of updated channels:")
-    for channel in updated_channels:
-        log(f"- {channel}")
+    log(f"Total subscriptions processed: {fetched}")
+    log(f"New subscriptions: {new}")
+    log(f"Channels with newly fetched details: {details_fetched}")
     
     log_quota_information()
     
     return True
 
+def handle_refresh_channel_details(args, account_id):
+    youtube = authenticate_youtube(args.account)
+    refreshed = refresh_stale_channels(youtube, account_id, args.max_ops,
+                                       args.active_ttl_days, args.dormant_ttl_days)
+    log(f"Refreshed details for {refreshed} channels.")
+    log_quota_information()
+    return True
+
 def handle_import_subscriptions(args, source_account_id, target_account_id):
     youtube_source = authenticate_youtube(args.from_account)
     youtube_target = authenticate_youtube(args.to_account)
-    import_subscriptions(youtube_source, youtube_target, source_account_id, target_account_id, args.max_ops)
+    # Each import worker gets its own client for the target account from the registry
+    import_subscriptions(youtube_source, youtube_target, source_account_id, target_account_id, args.max_ops,
+                         workers=args.workers, rate=args.rate,
+                         client_factory=lambda: authenticate_youtube(args.to_account))
+
+def handle_plan(args, account_id, target_account_id=None):
+    # Estimate what a command would cost and spread it over quota days, without any API calls
+    if args.command == 'import':
+        tasks = [plan_import(args.from_account, account_id, args.to_account, target_account_id, args.rate, args.max_ops)]
+    elif args.command == 'refresh':
+        tasks = [plan_refresh(args.account, account_id, args.max_ops, args.active_ttl_days, args.dormant_ttl_days)]
+    else:
+        tasks = [plan_listing(args.account, account_id), plan_refresh(args.account, account_id)]
+        if target_account_id is not None:
+            tasks.append(plan_import(args.account, account_id, args.to_account, target_account_id, DEFAULT_IMPORT_RATE))
+    log_schedule(tasks, build_schedule(tasks))
+    return True
 
 def log_quota_limit_reached():
-    next_reset = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0) + timedelta(days=1)
+    next_reset = get_next_quota_reset()
     log("Quota limit reached. Please try again tomorrow when the quota resets.")
-    log(f"Next quota reset: {next_reset.strftime('%Y-%m-%d %H:%M:%S')} (in {(next_reset - datetime.now()).total_seconds() / 3600:.2f} hours)")
+    log(f"Next quota reset: {next_reset.strftime('%Y-%m-%d %H:%M:%S %Z')} (in {(next_reset - datetime.now(next_reset.tzinfo)).total_seconds() / 3600:.2f} hours)")
     log(f"If you need to process more subscriptions, consider increasing your quota limit.")
     log("Visit https://developers.google.com/youtube/v3/getting-started#quota for more information.")
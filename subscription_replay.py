@@ -0,0 +1,79 @@
+import logging
+from utils import TokenBucket, exponential_backoff
+from quota_management import use_quota, get_remaining_quota, QUOTA_COST
+from database import get_pending_deltas, record_delta_replay, run_write, PERMANENT_IMPORT_FAILURES
+from subscription_import import import_subscription, DEFAULT_IMPORT_RATE
+
+# Results of replaying one delta that leave the target in step with the source
+APPLIED_RESULTS = ('success', 'already_subscribed', 'not_subscribed', 'unchanged')
+# Failures that will not go away by retrying; other failed deltas stay pending
+PERMANENT_FAILURES = PERMANENT_IMPORT_FAILURES
+
+def replay_deltas(youtube, source_account_id, target_account_id, max_ops=None, rate=DEFAULT_IMPORT_RATE):
+    # Applies the source account's subscription changes since their last replay onto the
+    # target. Deltas the target already matches are recorded without an API call, so
+    # changes that came from a replay never echo back as paid calls.
+    deltas = get_pending_deltas(source_account_id, target_account_id)
+    counts = {'added': 0, 'removed': 0, 'unchanged': 0, 'failed': 0, 'deferred': 0}
+    if not deltas:
+        return counts
+    logging.info(f"Replaying {len(deltas)} subscription changes of account ID {source_account_id} "
+                 f"onto account ID {target_account_id}.")
+
+    limiter = TokenBucket(rate)
+    calls = 0
+    for delta in deltas:
+        if (delta['change'] == 'added') == delta['subscribed']:
+            run_write(record_delta_replay, source_account_id, target_account_id, delta, 'unchanged', applied=True)
+            counts['unchanged'] += 1
+            continue
+
+        operation = 'subscriptions.insert' if delta['change'] == 'added' else 'subscriptions.delete'
+        if (max_ops is not None and calls >= max_ops) or get_remaining_quota() < QUOTA_COST[operation] + QUOTA_COST['subscriptions.list']:
+            # Left pending for the next run
+            counts['deferred'] += 1
+            continue
+
+        calls += 1
+        if delta['change'] == 'added':
+            # Charges every insert attempt itself
+            result = import_subscription(youtube, delta, limiter)
+        else:
+            limiter.acquire()
+            result = delete_subscription(youtube, delta['channel_id']) or 'subscription_failed'
+            use_quota(operation)
+        if result == 'quota_exceeded':
+            # The remaining deltas stay pending for the next run
+            logging.error("Quota exceeded. Stopping the replay.")
+            break
+
+        if result in APPLIED_RESULTS or result in PERMANENT_FAILURES:
+            run_write(record_delta_replay, source_account_id, target_account_id, delta, result, applied=result in APPLIED_RESULTS)
+        if result in APPLIED_RESULTS:
+            counts[delta['change']] += 1
+        else:
+            counts['failed'] += 1
+            logging.warning(f"Could not replay {delta['change']} channel {delta['title']} ({delta['channel_id']}): {result}")
+
+    if counts['deferred']:
+        logging.info(f"Deferred {counts['deferred']} changes to a later run for lack of quota or --max-ops.")
+    return counts
+
+@exponential_backoff
+def delete_subscription(youtube, channel_id):
+    # subscriptions.delete takes the subscription ID, which one subscriptions.list call resolves
+    from googleapiclient.errors import HttpError
+    response = youtube.subscriptions().list(part="id", mine=True, forChannelId=channel_id, maxResults=1).execute()
+    use_quota('subscriptions.list')
+    items = response.get('items', [])
+    if not items:
+        logging.info(f"Not subscribed to {channel_id} in target account.")
+        return 'not_subscribed'
+    try:
+        youtube.subscriptions().delete(id=items[0]['id']).execute()
+    except HttpError as e:
+        if e.resp.status == 404:
+            return 'not_subscribed'
+        raise
+    logging.info(f"Unsubscribed from {channel_id} in target account.")
+    return 'success'
@@ -0,0 +1,107 @@
+import threading
+import account_sync
+import subscription_listing
+from unittest import mock
+from googleapiclient.discovery import build
+from account_sync import sync_accounts
+from subscription_listing import list_subscriptions
+from database import close_db_connections, get_db_connection, get_existing_subscriptions, get_or_create_account
+from fake_youtube import FakeYouTubeAPI
+
+def fake_client(account_name, channel_count):
+    youtube = mock.MagicMock()
+    items = [{'snippet': {'resourceId': {'channelId': f"{account_name}-{i}"}, 'title': f"Channel {i}",
+                          'description': '', 'publishedAt': '2024-01-01T00:00:00Z'}}
+             for i in range(channel_count)]
+    youtube.subscriptions().list().execute.return_value = {'kind': 'youtube#subscriptionListResponse', 'items': items}
+    youtube.subscriptions().list_next.return_value = None
+    return youtube
+
+def test_sync_accounts_lists_in_parallel_and_writes_through_one_thread(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(subscription_listing, 'get_channels_details', lambda youtube, ids: {})
+    writer_threads = set()
+
+    original_store = account_sync.store_subscriptions_in_db
+    def recording_store(*args, **kwargs):
+        writer_threads.add(threading.current_thread().name)
+        return original_store(*args, **kwargs)
+    monkeypatch.setattr(account_sync, 'store_subscriptions_in_db', recording_store)
+
+    def credentials_loader(name):
+        if name == 'dave':
+            raise FileNotFoundError("client_secret_dave.json")
+        return name
+
+    counts = {'alice': 3, 'bob': 5, 'carol': 0}
+    # An account whose credentials cannot be loaded is skipped, not the whole sync
+    results = sync_accounts(list(counts) + ['dave'], workers=3, credentials_loader=credentials_loader,
+                            client_builder=lambda credentials, name: fake_client(name, counts[name]))
+
+    by_account = {result['account']: result for result in results}
+    assert set(by_account) == set(counts)
+    assert by_account['alice']['fetched'] == 3 and by_account['alice']['new'] == 3
+    assert by_account['bob']['fetched'] == 5
+    assert by_account['carol']['status'] == 'nothing fetched'
+    assert writer_threads == {'db-writer'}
+    for name, count in counts.items():
+        existing, _ = get_existing_subscriptions(get_or_create_account(name))
+        assert existing == {f"{name}-{i}" for i in range(count)}
+    close_db_connections()
+
+def test_sync_replays_only_the_changes_since_the_previous_snapshot(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    api = FakeYouTubeAPI(channels=60, subscriptions=10)
+    client_builder = lambda credentials, name: build('youtube', 'v3', http=api.http(name))
+    a_indexes, a_subscribed = api.account_subscriptions('a')
+    b_indexes, b_subscribed = api.account_subscriptions('b')
+    removed = a_indexes[0]
+    added = next(index for index in range(60) if index not in a_subscribed and index not in b_subscribed)
+    if removed not in b_subscribed:
+        b_indexes.append(removed)
+        b_subscribed.add(removed)
+
+    # The first sync is a baseline and replays nothing
+    sync_accounts(['a', 'b'], workers=2, credentials_loader=lambda name: name, client_builder=client_builder, replay=True)
+    assert 'b subscriptions.insert' not in api.cost_summary()
+
+    a_indexes.remove(removed)
+    a_subscribed.discard(removed)
+    a_indexes.append(added)
+    a_subscribed.add(added)
+    results = sync_accounts(['a', 'b'], workers=2, credentials_loader=lambda name: name, client_builder=client_builder, replay=True)
+
+    replay = {result['account']: result['replay'] for result in results}
+    assert (replay['b']['added'], replay['b']['removed']) == (1, 1)
+    assert api.cost_summary()['b subscriptions.insert'] == {'calls': 1, 'units': 50}
+    assert api.cost_summary()['b subscriptions.delete'] == {'calls': 1, 'units': 50}
+    assert added in b_subscribed and removed not in b_subscribed
+    b_channels, _ = get_existing_subscriptions(get_or_create_account('b'))
+    assert api.channel_id(added) in b_channels and api.channel_id(removed) not in b_channels
+
+    # What was replayed onto b is not reported as b's own change, so nothing echoes back
+    results = sync_accounts(['a', 'b'], workers=2, credentials_loader=lambda name: name, client_builder=client_builder, replay=True)
+    assert all(result['replay']['added'] + result['replay']['removed'] == 0 for result in results)
+    assert api.cost_summary()['b subscriptions.insert']['calls'] == 1
+    assert 'a subscriptions.insert' not in api.cost_summary()
+    close_db_connections()
+
+def test_listing_starved_of_quota_does_not_complete_a_snapshot(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    api = FakeYouTubeAPI(channels=500, subscriptions=120)
+    youtube = build('youtube', 'v3', http=api.http('viewer'))
+    account_id = get_or_create_account('viewer')
+    assert len(list_subscriptions(youtube, set(), 'viewer', account_id=account_id)) == 120
+
+    # The first page is stale and no channel details are affordable
+    monkeypatch.setattr(subscription_listing, 'affordable_refreshes', lambda remaining: 0)
+    existing, _ = get_existing_subscriptions(account_id)
+    first_page = {api.channel_id(index) for index in api.account_subscriptions('viewer')[0][:50]}
+    assert list_subscriptions(youtube, existing - first_page, 'viewer', account_id=account_id) == []
+
+    conn = get_db_connection()
+    assert conn.execute('''SELECT COUNT(*), SUM(removed) FROM subscription_snapshots
+                           WHERE completed_at IS NOT NULL''').fetchone() == (1, 0)
+    assert conn.execute("SELECT COUNT(*) FROM subscription_deltas").fetchone()[0] == 0
+    assert len(get_existing_subscriptions(account_id)[0]) == 120
+    close_db_connections()
@@ -0,0 +1,35 @@
+import json
+from googleapiclient.discovery import build
+from api_metrics import InstrumentedHttp, export_api_metrics, get_api_metrics_summary, reset_api_metrics
+from fake_youtube import FakeYouTubeAPI
+from utils import exponential_backoff
+
+def test_instrumented_http_records_calls_retries_and_cost(tmp_path, monkeypatch):
+    monkeypatch.setattr('time.sleep', lambda seconds: None)
+    reset_api_metrics()
+    api = FakeYouTubeAPI(channels=100, subscriptions=60)
+    youtube = build('youtube', 'v3', http=InstrumentedHttp(api.http('viewer'), 'viewer'))
+
+    youtube.subscriptions().list(part='snippet', mine=True, maxResults=50).execute()
+    failures = iter([True, True, False])
+
+    @exponential_backoff
+    def flaky_lookup():
+        api.error_rates = {500: 1.0} if next(failures) else {}
+        return youtube.videos().list(part='snippet', id='v0000000001').execute()
+
+    assert flaky_lookup()['items'][0]['id'] == 'v0000000001'
+
+    summary = get_api_metrics_summary()['viewer']
+    assert summary['subscriptions.list']['calls'] == 1
+    assert summary['subscriptions.list']['quota_units'] == 1
+    assert summary['videos.list']['statuses'] == {'200': 1, '500': 2}
+    assert summary['videos.list']['retries'] == 2
+    assert summary['videos.list']['latency_buckets']['+Inf'] == 3
+
+    export_api_metrics(str(tmp_path))
+    prometheus = (tmp_path / 'youtube_api_metrics.prom').read_text()
+    assert 'youtube_api_requests_total{account="viewer",method="videos.list",status="500"} 2' in prometheus
+    assert 'youtube_api_request_duration_seconds_count{account="viewer",method="videos.list"} 3' in prometheus
+    assert json.loads((tmp_path / 'youtube_api_metrics.json').read_text())['viewer']['videos.list']['retries'] == 2
+    reset_api_metrics()
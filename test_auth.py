@@ -0,0 +1,53 @@
+import threading
+from datetime import datetime, timedelta, timezone
+from google.oauth2.credentials import Credentials
+import auth
+
+def expiring_credentials(minutes):
+    expiry = datetime.now(timezone.utc).replace(tzinfo=None) + timedelta(minutes=minutes)
+    return Credentials(token='old', refresh_token='refresh', token_uri='https://oauth2.googleapis.com/token',
+                       client_id='id', client_secret='secret', expiry=expiry)
+
+def test_expiring_credentials_are_refreshed_once_and_saved_only_on_change(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(auth, '_saved_tokens', {})
+    credentials = expiring_credentials(minutes=2)
+    refreshes = []
+
+    def refresh(request):
+        refreshes.append(threading.current_thread().name)
+        credentials.token = 'new'
+        credentials.expiry = datetime.now(timezone.utc).replace(tzinfo=None) + timedelta(hours=1)
+    monkeypatch.setattr(credentials, 'refresh', refresh)
+
+    threads = [threading.Thread(target=auth.refresh_credentials_if_expiring, args=('viewer', credentials)) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(refreshes) == 1
+    token_file = tmp_path / 'token_viewer.json'
+    assert '"token": "new"' in token_file.read_text()
+
+    # Unchanged credentials are not written again
+    token_file.unlink()
+    assert auth.save_credentials('viewer', credentials) is False
+    assert not token_file.exists()
+    assert auth.refresh_credentials_if_expiring('viewer', credentials) is False
+
+def test_clients_are_shared_per_thread_and_account(monkeypatch):
+    monkeypatch.setattr(auth, '_credentials', {})
+    monkeypatch.setattr(auth, 'get_credentials', lambda account_name: f"credentials of {account_name}")
+    monkeypatch.setattr(auth, 'build_youtube', lambda credentials, account_name: object())
+
+    first = auth.authenticate_youtube('viewer')
+    assert auth.authenticate_youtube('viewer') is first
+    assert auth.authenticate_youtube('other') is not first
+    other_thread = []
+    thread = threading.Thread(target=lambda: other_thread.append(auth.authenticate_youtube('viewer')))
+    thread.start()
+    thread.join()
+    assert other_thread[0] is not first
+    assert auth.get_shared_credentials('viewer') == "credentials of viewer"
+    auth._clients.__dict__.get('by_account', {}).clear()
@@ -0,0 +1,14 @@
+from benchmark import run_benchmarks, compare_with_baseline
+
+def test_benchmarks_run_on_small_datasets():
+    report = run_benchmarks(sizes=[20], api_sizes=[20], watch_rows=50, repeat=1)
+    results = report['results']
+    assert {'store_subscriptions_in_db/insert/20', 'get_existing_subscriptions/20', 'import_candidates/20',
+            'parse_subscriptions_csv/20', 'process_watch_history/json/50', 'list_subscriptions/fake_api/20',
+            'import_subscriptions/fake_api/20', 'startup/import_main', 'startup/build_youtube'} <= set(results)
+    assert all(result['seconds'] >= 0 for result in results.values())
+
+def test_compare_with_baseline_flags_slowdowns():
+    baseline = {'results': {'slow': {'seconds': 1.0}, 'steady': {'seconds': 1.0}, 'tiny': {'seconds': 0.0001}}}
+    results = {'slow': {'seconds': 1.5}, 'steady': {'seconds': 1.1}, 'tiny': {'seconds': 0.001}, 'new': {'seconds': 1.0}}
+    assert compare_with_baseline(results, baseline, 0.25) == ['slow']
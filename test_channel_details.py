@@ -0,0 +1,55 @@
+from unittest import mock
+from googleapiclient.errors import HttpError
+import channel_details
+import quota_management
+import utils
+from channel_details import get_channels_details
+from fake_youtube import ERROR_RESPONSES, error_response
+
+def http_error(status):
+    return HttpError(*error_response(status, *ERROR_RESPONSES[status]))
+
+def fake_client(channel_count, playlist_results):
+    youtube = mock.MagicMock()
+    youtube.channels().list().execute.return_value = {'items': [
+        {'id': f'UC{i}', 'snippet': {'publishedAt': '2020-01-01T00:00:00Z'}, 'statistics': {'videoCount': '10'},
+         'contentDetails': {'relatedPlaylists': {'uploads': f'UU{i}'}}} for i in range(channel_count)]}
+    youtube.playlistItems().list().execute.side_effect = playlist_results
+    return youtube
+
+def test_failed_calls_are_retried_alone_and_charged_every_attempt(monkeypatch):
+    charged = []
+    monkeypatch.setattr(channel_details, 'use_quota', lambda operation, units=1: charged.append(operation))
+    monkeypatch.setattr(utils.time, 'sleep', lambda seconds: None)
+    upload = {'items': [{'snippet': {'publishedAt': '2024-01-01T00:00:00Z'}}]}
+    youtube = fake_client(3, [upload, http_error(500), upload, upload])
+
+    details = get_channels_details(youtube, ['UC0', 'UC1', 'UC2'])
+    assert set(details) == {'UC0', 'UC1', 'UC2'}
+    assert youtube.channels().list().execute.call_count == 1
+    assert charged.count('channels.list') == 1 and charged.count('playlistItems.list') == 4
+
+def test_quota_exceeded_is_not_retried(monkeypatch):
+    charged, sleeps = [], []
+    monkeypatch.setattr(channel_details, 'use_quota', lambda operation, units=1: charged.append(operation))
+    monkeypatch.setattr(utils.time, 'sleep', sleeps.append)
+    upload = {'items': [{'snippet': {'publishedAt': '2024-01-01T00:00:00Z'}}]}
+    youtube = fake_client(3, [upload, http_error(403)])
+
+    # The batch stops at the first call the quota no longer covers
+    assert set(get_channels_details(youtube, ['UC0', 'UC1', 'UC2'])) == {'UC0'}
+    assert charged.count('playlistItems.list') == 2
+    assert sleeps == []
+
+def test_calls_past_the_budget_are_still_recorded(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(quota_management, 'DEFAULT_DAILY_QUOTA', 1)
+    request = mock.MagicMock()
+    request.execute.return_value = {'items': []}
+    with quota_management.quota_project('over-budget'):
+        channel_details.execute_request(request, 'channels.list')
+        channel_details.execute_request(request, 'channels.list')
+        # The second call ran, so the ledger counts it even though the budget was spent
+        assert quota_management.get_quota_usage() == 2
+        assert not quota_management.can_perform_operation('channels.list')
+    quota_management.flush_quota_ledger()
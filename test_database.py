@@ -1,6 +1,12 @@
 import sqlite3
-from database import get_db_connection, store_subscriptions_in_db, get_existing_subscriptions, update_database_schema
-from utils import log
+import threading
+import pytest
+from datetime import datetime, timedelta, timezone
+from database import (get_db_connection, close_db_connections, store_subscriptions_in_db, get_existing_subscriptions, update_database_schema, get_stale_channels,
+                      count_import_candidates, iter_import_candidates, flag_problematic_subscription, get_or_create_account,
+                      store_watch_history_in_db, search_channels, search_watch_history, store_videos,
+                      fill_watch_history_channels, get_channel_report, DatabaseWriter, set_shared_writer, run_write)
+from utils import log, parse_subscriptions_csv
 
 def test_database_operations():
     # Ensure the database schema is up to date
@@ -44,9 +50,226 @@ def test_database_operations():
     log("Cleaning up test data")
     conn = get_db_connection()
     cursor = conn.cursor()
-    cursor.execute("DELETE FROM subscriptions WHERE channel_id = ?", (test_subscription['channel_id'],))
+    cursor.execute("DELETE FROM account_subscriptions WHERE channel_id = ?", (test_subscription['channel_id'],))
+    cursor.execute("DELETE FROM channels WHERE channel_id = ?", (test_subscription['channel_id'],))
     conn.commit()
     conn.close()
 
+def test_store_subscriptions_bulk_upsert(tmp_path):
+    db_name = str(tmp_path / "subscriptions.db")
+    update_database_schema(db_name)
+
+    batch = [{'channel_id': f'channel_{i}', 'title': f'Channel {i}'} for i in range(3)]
+    assert store_subscriptions_in_db(batch, 2, db_name=db_name) == ['channel_0', 'channel_1', 'channel_2']
+
+    # Existing channels come back first, then the new ones
+    batch = [{'channel_id': 'channel_3', 'title': 'Channel 3'}, {'channel_id': 'channel_0', 'title': 'Renamed'}]
+    assert store_subscriptions_in_db(batch, 1, db_name=db_name) == ['channel_0', 'channel_3']
+    store_subscriptions_in_db([{'channel_id': 'channel_0', 'title': 'Renamed'}], 3, db_name=db_name)
+
+    conn = get_db_connection(db_name)
+    channels = conn.execute("SELECT channel_id, title FROM channels ORDER BY channel_id").fetchall()
+    links = conn.execute("SELECT account_id, channel_id FROM account_subscriptions ORDER BY account_id, channel_id").fetchall()
+    conn.close()
+    assert channels == [('channel_0', 'Renamed'), ('channel_1', 'Channel 1'),
+                        ('channel_2', 'Channel 2'), ('channel_3', 'Channel 3')]
+    # A third account is no longer dropped
+    assert links == [(1, 'channel_0'), (1, 'channel_3'),
+                     (2, 'channel_0'), (2, 'channel_1'), (2, 'channel_2'),
+                     (3, 'channel_0')]
+
+def test_csv_subscriptions_are_stored_with_their_titles(tmp_path):
+    db_name = str(tmp_path / "subscriptions.db")
+    csv_file = tmp_path / "subscriptions.csv"
+    csv_file.write_text("Channel Id,Channel Url,Channel Title\n"
+                        "UCcooking,http://www.youtube.com/channel/UCcooking,Weeknight Cooking\n", encoding='utf-8')
+    store_subscriptions_in_db(parse_subscriptions_csv(str(csv_file)), 1, 'csv', db_name=db_name)
+    assert get_db_connection(db_name).execute("SELECT title FROM channels WHERE channel_id = 'UCcooking'").fetchone() == \
+        ('Weeknight Cooking',)
+
+def test_migrate_legacy_subscriptions(tmp_path):
+    db_name = str(tmp_path / "subscriptions.db")
+    # Build an old-style database without going through the migrations
+    conn = sqlite3.connect(db_name)
+    conn.execute('''CREATE TABLE subscriptions 
+                    (channel_id TEXT PRIMARY KEY, title TEXT, description TEXT, published_at TEXT, 
+                     created_at TEXT, total_videos TEXT, last_upload_date TEXT, upload_frequency TEXT, 
+                     account_id_1 INTEGER, account_id_2 INTEGER)''')
+    conn.execute("INSERT INTO subscriptions (channel_id, title, account_id_1, account_id_2) VALUES ('shared', 'Shared', 1, 2)")
+    conn.execute("INSERT INTO subscriptions (channel_id, title, account_id_1) VALUES ('single', 'Single', 2)")
+    conn.commit()
+    conn.close()
+
+    update_database_schema(db_name)
+
+    assert get_existing_subscriptions(1, db_name)[0] == {'shared'}
+    assert get_existing_subscriptions(2, db_name)[0] == {'shared', 'single'}
+    conn = get_db_connection(db_name)
+    assert conn.execute("SELECT name FROM sqlite_master WHERE name = 'subscriptions'").fetchone() is None
+    conn.close()
+
+def test_stale_channels_follow_ttl_policy(tmp_path):
+    db_name = str(tmp_path / "subscriptions.db")
+
+    def days_ago(days):
+        return (datetime.now(timezone.utc) - timedelta(days=days)).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+    store_subscriptions_in_db([
+        {'channel_id': 'never_fetched', 'title': 'Never fetched'},
+        {'channel_id': 'active_stale', 'title': 'Active stale', 'last_upload_date': days_ago(3), 'details_fetched_at': days_ago(2)},
+        {'channel_id': 'active_fresh', 'title': 'Active fresh', 'last_upload_date': days_ago(3), 'details_fetched_at': days_ago(0.5)},
+        {'channel_id': 'dormant_fresh', 'title': 'Dormant fresh', 'last_upload_date': days_ago(400), 'details_fetched_at': days_ago(2)},
+        {'channel_id': 'dormant_stale', 'title': 'Dormant stale', 'last_upload_date': 'N/A', 'details_fetched_at': days_ago(45)},
+    ], 1, db_name=db_name)
+    # Storing a channel again without details keeps the stored ones
+    store_subscriptions_in_db([{'channel_id': 'active_fresh', 'title': 'Active fresh'}], 1, db_name=db_name)
+
+    stale = get_stale_channels(1, 1, 30, 30, db_name=db_name)
+    assert [channel['channel_id'] for channel in stale] == ['never_fetched', 'dormant_stale', 'active_stale']
+    assert len(get_stale_channels(1, 1, 30, 30, limit=1, db_name=db_name)) == 1
+
+def test_import_candidates_are_an_anti_join_in_priority_order(tmp_path):
+    db_name = str(tmp_path / "subscriptions.db")
+    store_subscriptions_in_db([{'channel_id': f'channel_{i}', 'title': f'Channel {i}'} for i in range(6)], 1, db_name=db_name)
+    store_subscriptions_in_db([{'channel_id': 'channel_1', 'title': 'Channel 1'}], 2, db_name=db_name)
+    flag_problematic_subscription(1, 'channel_2', 'channel_not_found', db_name=db_name)
+    # A transient failure does not keep the channel out of later imports
+    flag_problematic_subscription(1, 'channel_5', 'subscription_failed', db_name=db_name)
+    # Channels the source account watched most are imported first
+    store_watch_history_in_db([{'title': f'Watched v{i}', 'url': None, 'watch_time': f'2024-03-0{i + 1}T10:00:00Z',
+                                'video_id': f'v{i}', 'channel_id': 'channel_4'} for i in range(2)], 1, db_name=db_name)
+    store_watch_history_in_db([{'title': 'Watched v9', 'url': None, 'watch_time': '2024-03-09T10:00:00Z',
+                                'video_id': 'v9', 'channel_id': 'channel_4'}], 2, db_name=db_name)
+
+    candidates = [sub['channel_id'] for sub in iter_import_candidates(1, 2, page_size=2, db_name=db_name)]
+    assert candidates == ['channel_4', 'channel_0', 'channel_3', 'channel_5']
+    assert count_import_candidates(1, 2, db_name=db_name) == 4
+    # Resuming after a channel continues from its place in the order
+    assert [sub['channel_id'] for sub in iter_import_candidates(1, 2, after='channel_4', db_name=db_name)] == \
+        ['channel_0', 'channel_3', 'channel_5']
+    assert count_import_candidates(1, 2, after='channel_3', db_name=db_name) == 1
+
+    # A channel watched before it was subscribed to gets its priority on subscribing
+    store_watch_history_in_db([{'title': f'Watched w{i}', 'url': None, 'watch_time': f'2024-04-0{i + 1}T10:00:00Z',
+                                'video_id': f'w{i}', 'channel_id': 'channel_6'} for i in range(3)], 1, db_name=db_name)
+    store_subscriptions_in_db([{'channel_id': 'channel_6', 'title': 'Channel 6'}], 1, db_name=db_name)
+    assert [sub['channel_id'] for sub in iter_import_candidates(1, 2, db_name=db_name)][:2] == ['channel_6', 'channel_4']
+
+def test_search_indexes_follow_stored_rows(tmp_path):
+    db_name = str(tmp_path / "subscriptions.db")
+    alice = get_or_create_account('alice', db_name)
+    bob = get_or_create_account('bob', db_name)
+    store_subscriptions_in_db([{'channel_id': 'cooking', 'title': 'Weeknight Cooking', 'description': 'Quick pasta recipes'},
+                               {'channel_id': 'physics', 'title': 'Physics Explained', 'description': 'Cooking up quantum ideas'}],
+                              alice, db_name=db_name)
+    store_subscriptions_in_db([{'channel_id': 'physics', 'title': 'Physics Explained'}], bob, db_name=db_name)
+    store_watch_history_in_db([{'title': 'Watched Homemade pasta in 10 minutes', 'url': 'https://youtu.be/v1',
+                                'watch_time': '2024-03-01T10:00:00Z', 'video_id': 'v1', 'channel_id': 'cooking'}],
+                              alice, db_name=db_name)
+
+    # Title matches rank ahead of description matches
+    assert [channel['channel_id'] for channel in search_channels('cook*', db_name=db_name)] == ['cooking', 'physics']
+    assert search_channels('quantum', db_name=db_name)[0]['accounts'] == 'alice, bob'
+    assert [channel['channel_id'] for channel in search_channels('cooking', 'bob', db_name=db_name)] == ['physics']
+    assert len(search_channels('cooking', limit=1, offset=1, db_name=db_name)) == 1
+    assert search_watch_history('pasta', 'alice', db_name=db_name)[0]['url'] == 'https://youtu.be/v1'
+    assert search_watch_history('pasta', 'bob', db_name=db_name) == []
+    # Query syntax in the input is searched for literally
+    assert search_channels('"physics AND', db_name=db_name) == []
+
+    # Renames replace the indexed text
+    store_subscriptions_in_db([{'channel_id': 'cooking', 'title': 'Weeknight Baking'}], alice, db_name=db_name)
+    assert [channel['channel_id'] for channel in search_channels('baking', db_name=db_name)] == ['cooking']
+    assert [channel['channel_id'] for channel in search_channels('weeknight cooking', db_name=db_name)] == []
+
+def test_channel_search_is_keyed_on_a_stable_row_id(tmp_path):
+    db_name = str(tmp_path / "subscriptions.db")
+    alice = get_or_create_account('alice', db_name)
+    store_subscriptions_in_db([{'channel_id': f'channel_{i}', 'title': f'Channel {i}'} for i in range(5)], alice, db_name=db_name)
+    conn = get_db_connection(db_name)
+    # VACUUM keeps INTEGER PRIMARY KEY values, which the search index refers to
+    assert "content_rowid='id'" in conn.execute("SELECT sql FROM sqlite_master WHERE name = 'channels_fts'").fetchone()[0]
+    assert ('id', 1) in [(row[1], row[5]) for row in conn.execute("PRAGMA table_info(channels)")]
+    conn.execute("DELETE FROM channels WHERE channel_id = 'channel_0'")
+    conn.commit()
+    conn.execute("VACUUM")
+    assert [channel['channel_id'] for channel in search_channels('"channel 3"', db_name=db_name)] == ['channel_3']
+
+def test_channel_statistics_are_maintained_on_ingest(tmp_path):
+    db_name = str(tmp_path / "subscriptions.db")
+    alice = get_or_create_account('alice', db_name)
+    store_subscriptions_in_db([{'channel_id': 'cooking', 'title': 'Weeknight Cooking', 'total_videos': '120',
+                                'upload_frequency': '0.50 videos per day', 'last_upload_date': '2024-02-01T00:00:00Z'},
+                               {'channel_id': 'physics', 'title': 'Physics Explained', 'total_videos': 'N/A',
+                                'upload_frequency': '1.25 videos per day', 'last_upload_date': 'N/A'}],
+                              alice, db_name=db_name)
+    conn = get_db_connection(db_name)
+    assert conn.execute("SELECT video_count, upload_rate, last_upload_epoch FROM channels WHERE channel_id = 'cooking'").fetchone() \
+        == (120, 0.5, 1706745600)
+    assert conn.execute("SELECT video_count, last_upload_epoch FROM channels WHERE channel_id = 'physics'").fetchone() == (None, None)
+
+    def watch(video_id, watch_time, channel_id):
+        return {'title': f'Watched {video_id}', 'url': None, 'watch_time': watch_time, 'video_id': video_id, 'channel_id': channel_id}
+
+    history = [watch('v1', '2024-03-01T10:00:00Z', 'cooking'), watch('v2', '2024-03-05T10:00:00Z', 'cooking'),
+               watch('v3', '2024-03-03T10:00:00Z', None), watch('v4', 'yesterday-ish', 'gaming')]
+    store_watch_history_in_db(history, alice, db_name=db_name)
+    # Re-ingesting the same export counts nothing twice
+    store_watch_history_in_db(history + [watch('v5', '2024-04-01T10:00:00Z', 'cooking')], alice, db_name=db_name)
+    # Rows that get their channel later are counted then
+    store_videos([{'video_id': 'v3', 'channel_id': 'physics', 'channel_title': 'Physics Explained', 'video_title': 'v3'}],
+                 db_name=db_name)
+    assert fill_watch_history_channels(alice, db_name) == 1
+    assert fill_watch_history_channels(alice, db_name) == 0
+
+    report = get_channel_report('alice', db_name=db_name)
+    assert [(channel['channel_id'], channel['watch_count']) for channel in report] == [('cooking', 3), ('gaming', 1), ('physics', 1)]
+    assert report[0]['first_watched'] == 1709287200 and report[0]['last_watched'] == 1711965600
+    assert report[0]['upload_rate'] == 0.5 and report[0]['video_count'] == 120 and report[0]['subscribed']
+    assert report[1]['title'] is None and report[1]['last_watched'] is None and not report[1]['subscribed']
+    assert [channel['channel_id'] for channel in get_channel_report('alice', 'upload-rate', 2, db_name)] == ['physics', 'cooking']
+
+    # The incrementally maintained table matches a full recount
+    assert conn.execute("SELECT account_id, channel_id, watch_count FROM channel_statistics ORDER BY channel_id").fetchall() == \
+        conn.execute('''SELECT account_id, channel_id, COUNT(*) FROM watch_history WHERE channel_id IS NOT NULL
+                        GROUP BY account_id, channel_id ORDER BY channel_id''').fetchall()
+
+def test_writes_go_through_the_shared_writer():
+    current_thread = lambda: threading.current_thread().name
+    assert run_write(current_thread) == threading.current_thread().name
+    writer = DatabaseWriter()
+    set_shared_writer(writer)
+    try:
+        assert run_write(current_thread) == 'db-writer'
+        assert run_write(current_thread, wait=False) is None
+    finally:
+        set_shared_writer(None)
+        writer.close()
+
+def test_failed_migration_is_not_recorded_as_applied(tmp_path, monkeypatch):
+    import database
+    db_name = str(tmp_path / "subscriptions.db")
+
+    def failing_migration(cursor):
+        raise sqlite3.OperationalError("disk I/O error")
+
+    monkeypatch.setattr(database, 'MIGRATIONS', database.MIGRATIONS + [failing_migration])
+    with pytest.raises(sqlite3.DatabaseError):
+        get_db_connection(db_name)
+    # The next connection retries the migration instead of using the old schema
+    monkeypatch.setattr(database, 'MIGRATIONS', database.MIGRATIONS[:-1] + [lambda cursor: None])
+    assert get_db_connection(db_name).execute("PRAGMA user_version").fetchone()[0] == len(database.MIGRATIONS)
+    close_db_connections()
+
+def test_connections_of_other_threads_are_closed(tmp_path):
+    db_name = str(tmp_path / "subscriptions.db")
+    opened = []
+    worker = threading.Thread(target=lambda: opened.append(get_db_connection(db_name)))
+    worker.start()
+    worker.join()
+    close_db_connections(all_threads=True)
+    with pytest.raises(sqlite3.ProgrammingError):
+        opened[0].execute("SELECT 1")
+
 if __name__ == "__main__":
     test_database_operations()
@@ -0,0 +1,127 @@
+import threading
+import pytest
+import subscription_listing
+from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
+from channel_refresh import refresh_stale_channels, get_stale_channel_ids
+from database import close_db_connections, get_checkpoint, get_existing_subscriptions, store_subscriptions_in_db
+from fake_youtube import FakeYouTubeAPI, FAKE_DB_NAME
+from subscription_import import import_subscription
+from subscription_listing import list_subscriptions, iter_subscription_pages, LIST_OPERATION
+
+def test_list_subscriptions_pages_through_the_fake_api(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    api = FakeYouTubeAPI(channels=500, subscriptions=120)
+    youtube = build('youtube', 'v3', http=api.http('viewer'))
+
+    subscriptions = list_subscriptions(youtube, set(), 'viewer')
+    assert len({sub['channel_id'] for sub in subscriptions}) == 120
+    assert all(sub['total_videos'] == str(api.videos_per_channel) for sub in subscriptions)
+    costs = api.cost_summary()
+    assert costs['viewer subscriptions.list'] == {'calls': 3, 'units': 3}
+    assert costs['viewer channels.list'] == {'calls': 3, 'units': 3}
+    assert costs['viewer playlistItems.list'] == {'calls': 120, 'units': 120}
+    close_db_connections()
+
+def test_import_subscription_against_the_fake_api():
+    api = FakeYouTubeAPI(channels=100, subscriptions=10)
+    youtube = build('youtube', 'v3', http=api.http('target'))
+    subscribed = api.account_subscriptions('target')[0][0]
+    not_subscribed = next(index for index in range(100) if index not in api.account_subscriptions('target')[1])
+
+    assert import_subscription(youtube, {'channel_id': api.channel_id(not_subscribed), 'title': 'new'}) == 'success'
+    assert import_subscription(youtube, {'channel_id': api.channel_id(subscribed), 'title': 'old'}) == 'already_subscribed'
+    assert import_subscription(youtube, {'channel_id': 'UCdoesnotexist000000000x', 'title': 'gone'}) == 'channel_not_found'
+    assert api.cost_summary()['target subscriptions.insert'] == {'calls': 3, 'units': 150}
+
+def test_fake_api_injects_quota_errors():
+    api = FakeYouTubeAPI.from_spec('channels=10,error_403=1')
+    youtube = build('youtube', 'v3', http=api.http('viewer'))
+    with pytest.raises(HttpError) as error:
+        youtube.videos().list(part='snippet', id='v0000000001').execute()
+    assert error.value.resp.status == 403 and 'quotaExceeded' in str(error.value)
+
+def test_list_subscriptions_resumes_from_the_checkpoint(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    api = FakeYouTubeAPI(channels=500, subscriptions=120)
+    youtube = build('youtube', 'v3', http=api.http('viewer'))
+
+    first = list_subscriptions(youtube, set(), 'viewer', max_ops=60, account_id=1)
+    assert len(first) == 60
+    assert get_checkpoint(LIST_OPERATION, 1)['page_offset'] == 10
+    # The second run starts inside the second page instead of re-listing the first
+    rest = list_subscriptions(youtube, set(), 'viewer', account_id=1)
+    assert len(rest) == 60
+    assert get_checkpoint(LIST_OPERATION, 1) is None
+    assert len(get_existing_subscriptions(1)[0]) == 120
+    assert api.cost_summary()['viewer subscriptions.list'] == {'calls': 4, 'units': 4}
+    close_db_connections()
+
+def test_subscription_pages_are_prefetched_and_committed_as_they_go(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    api = FakeYouTubeAPI(channels=500, subscriptions=120)
+    youtube = build('youtube', 'v3', http=api.http('viewer'))
+    prefetch_clients = []
+
+    def client_factory():
+        prefetch_clients.append(threading.current_thread().name)
+        return build('youtube', 'v3', http=api.http('viewer'))
+
+    fetched = 0
+    for page in iter_subscription_pages(youtube, set(), 'viewer', account_id=1, client_factory=client_factory):
+        fetched += len(page)
+        # Every yielded page is already committed
+        assert len(get_existing_subscriptions(1)[0]) >= fetched
+    assert fetched == 120
+    assert prefetch_clients == ['prefetch']
+    assert get_checkpoint(LIST_OPERATION, 1) is None
+    assert api.cost_summary()['viewer subscriptions.list'] == {'calls': 3, 'units': 3}
+    close_db_connections()
+
+def test_pages_skipped_for_quota_are_listed_on_the_next_run(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    api = FakeYouTubeAPI(channels=500, subscriptions=120)
+    youtube = build('youtube', 'v3', http=api.http('viewer'))
+    budgets = iter([0, 50, 0])
+    monkeypatch.setattr(subscription_listing, 'affordable_refreshes', lambda remaining: next(budgets, 500))
+
+    # Nothing on the first page is affordable: no checkpoint, and the listing is not done
+    assert list_subscriptions(youtube, set(), 'viewer', account_id=1) == []
+    assert get_checkpoint(LIST_OPERATION, 1) is None
+    assert get_existing_subscriptions(1)[0] == set()
+    # The first page fits, the second does not: the checkpoint stays at the second page
+    assert len(list_subscriptions(youtube, set(), 'viewer', account_id=1)) == 50
+    assert get_checkpoint(LIST_OPERATION, 1)['processed'] == 50
+    assert get_checkpoint(LIST_OPERATION, 1)['page_offset'] == 0
+    assert len(list_subscriptions(youtube, set(), 'viewer', account_id=1)) == 70
+    assert get_checkpoint(LIST_OPERATION, 1) is None
+    assert len(get_existing_subscriptions(1)[0]) == 120
+    close_db_connections()
+
+def test_fake_api_runs_use_their_own_database(tmp_path, monkeypatch):
+    import auth
+    import database
+    import main
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(auth, '_fake_api', None)
+    monkeypatch.setattr(database, '_default_database', database.DEFAULT_DB_NAME)
+    monkeypatch.setattr('sys.argv', ['yt_subs.py', '--fake-api', 'channels=100,subscriptions=20',
+                                     'get', '--subscriptions', '--account', 'viewer', '--format', 'api'])
+    main.main()
+    close_db_connections()
+    assert (tmp_path / FAKE_DB_NAME).exists()
+    assert not (tmp_path / 'subscriptions.db').exists()
+
+def test_refresh_stamps_channels_that_no_longer_exist(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    api = FakeYouTubeAPI(channels=10, subscriptions=3)
+    youtube = build('youtube', 'v3', http=api.http('viewer'))
+    store_subscriptions_in_db([{'channel_id': api.channel_id(0), 'title': 'Exists'},
+                               {'channel_id': 'UCterminated000000000000', 'title': 'Terminated'}], 1)
+
+    assert refresh_stale_channels(youtube, 1) == 1
+    # Neither is stale any more, so the next refresh makes no calls
+    assert get_stale_channel_ids(1) == set()
+    assert refresh_stale_channels(youtube, 1) == 0
+    assert api.cost_summary()['viewer channels.list'] == {'calls': 1, 'units': 1}
+    close_db_connections()
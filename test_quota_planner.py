@@ -0,0 +1,21 @@
+from quota_planner import build_schedule
+
+def make_task(name, project, count, priority, unit_cost):
+    return {'name': name, 'project': project, 'unit': 'items', 'count': count, 'priority': priority,
+            'cost': lambda items: items * unit_cost, 'seconds': lambda items: items}
+
+def test_build_schedule_packs_days_by_priority():
+    tasks = [make_task('import', 'target', 250, 1, 50),
+             make_task('list', 'source', 30, 0, 1),
+             make_task('refresh', 'target', 40, 2, 1)]
+    schedule = build_schedule(tasks, remaining_today={'source': 10, 'target': 1020}, daily_quota=10000)
+
+    first_day = {entry['name']: entry['count'] for entry in schedule[0]['entries']}
+    # The leftover 20 units of the target project go to the cheaper refresh
+    assert first_day == {'list': 10, 'import': 20, 'refresh': 20}
+    second_day = {entry['name']: entry['count'] for entry in schedule[1]['entries']}
+    assert second_day == {'list': 20, 'import': 200}
+    third_day = {entry['name']: entry['count'] for entry in schedule[2]['entries']}
+    assert third_day == {'import': 30, 'refresh': 20}
+    assert len(schedule) == 3
+    assert schedule[0]['quota_day'] < schedule[1]['quota_day'] < schedule[2]['quota_day']
@@ -0,0 +1,72 @@
+import threading
+import time
+from unittest import mock
+import pytest
+from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
+import subscription_import
+from cli import parse_arguments
+from database import close_db_connections, get_checkpoint, get_existing_subscriptions, store_subscriptions_in_db
+from fake_youtube import ERROR_RESPONSES, FakeYouTubeAPI, error_response
+from subscription_import import import_operation, import_subscription, process_subscriptions
+from utils import TokenBucket
+
+def test_token_bucket_limits_the_rate_across_threads():
+    bucket = TokenBucket(rate=50, capacity=1)
+    started = time.monotonic()
+    threads = [threading.Thread(target=lambda: [bucket.acquire() for _ in range(5)]) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    # 20 acquisitions at 50 per second, the first one free
+    assert time.monotonic() - started >= 19 / 50
+
+def test_import_workers_each_use_their_own_client(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    api = FakeYouTubeAPI(channels=200, subscriptions=0)
+    client_threads = []
+
+    def client_factory():
+        client_threads.append(threading.current_thread().name)
+        return build('youtube', 'v3', http=api.http('target'))
+
+    subs = [{'channel_id': api.channel_id(index), 'title': f'Channel {index}'} for index in range(30)]
+    store_subscriptions_in_db(subs, 1)
+    results = process_subscriptions(None, iter(subs), len(subs), 1, 2, None, workers=3, rate=1000,
+                                    client_factory=client_factory)
+    assert results['imported'] == 30
+    assert len(client_threads) == len(set(client_threads)) <= 3
+    assert get_existing_subscriptions(2)[0] == {sub['channel_id'] for sub in subs}
+    assert api.cost_summary()['target subscriptions.insert']['calls'] == 30
+    close_db_connections()
+
+@pytest.mark.parametrize('arguments', [['--workers', '0'], ['--rate', '0'], ['--rate', '-1']])
+def test_import_rejects_non_positive_workers_and_rate(arguments):
+    with pytest.raises(SystemExit):
+        parse_arguments(['import', '--subscriptions', '--from-account', 'a', '--to-account', 'b'] + arguments)
+
+def test_every_insert_attempt_is_charged(monkeypatch):
+    charged = []
+    monkeypatch.setattr(subscription_import, 'use_quota', charged.append)
+    monkeypatch.setattr(subscription_import.time, 'sleep', lambda seconds: None)
+    youtube = mock.MagicMock()
+    youtube.subscriptions().insert().execute.side_effect = [HttpError(*error_response(500, *ERROR_RESPONSES[500])), {}]
+    assert import_subscription(youtube, {'channel_id': 'UC0', 'title': 'Channel 0'}) == 'success'
+    assert charged == ['subscriptions.insert', 'subscriptions.insert']
+
+def test_import_stops_when_the_quota_is_exceeded(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    sleeps = []
+    monkeypatch.setattr(subscription_import.time, 'sleep', sleeps.append)
+    # Room for five inserts of 50 units on the target account
+    api = FakeYouTubeAPI(channels=200, subscriptions=0, daily_quota=250)
+    subs = [{'channel_id': api.channel_id(index), 'title': f'Channel {index}'} for index in range(30)]
+    store_subscriptions_in_db(subs, 1)
+    results = process_subscriptions(None, iter(subs), len(subs), 1, 2, None, workers=1, rate=1000,
+                                    client_factory=lambda: build('youtube', 'v3', http=api.http('target')))
+    assert results['imported'] == results['processed'] == 5
+    assert sleeps == []
+    # The checkpoint stays before the first channel that was not imported
+    assert get_checkpoint(import_operation(1), 2)['last_item'] == subs[4]['channel_id']
+    close_db_connections()
@@ -0,0 +1,77 @@
+import threading
+from unittest import mock
+from googleapiclient.errors import HttpError
+import channel_details
+import utils
+from database import close_db_connections, get_or_create_account, store_watch_history_in_db, get_db_connection
+from fake_youtube import ERROR_RESPONSES, error_response
+from video_info import fetch_videos, get_video_channels, resolve_watch_history_channels
+
+class FakeVideos:
+    # Stands in for youtube.videos(); every 7th video is unavailable
+    def __init__(self, calls):
+        self.calls = calls
+
+    def list(self, part, id, maxResults):
+        ids = id.split(",")
+        self.calls.append(ids)
+        items = [{'id': video_id, 'snippet': {'channelId': f"UC{int(video_id[1:]) % 10}", 'channelTitle': 'Channel',
+                                              'title': f"Video {video_id}"}}
+                 for video_id in ids if int(video_id[1:]) % 7]
+        return type('Request', (), {'execute': lambda self: {'items': items}})()
+
+class FakeYouTube:
+    def __init__(self, calls):
+        self.calls = calls
+
+    def videos(self):
+        return FakeVideos(self.calls)
+
+def test_get_video_channels_dedups_chunks_and_caches(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    calls = []
+    video_ids = [f"v{i}" for i in range(1, 121)] * 3
+
+    videos = get_video_channels(video_ids, FakeYouTube(calls))
+    assert len(calls) == 3
+    assert all(len(ids) <= 50 for ids in calls)
+    assert sorted(video_id for ids in calls for video_id in ids) == sorted(set(video_ids))
+    assert len(videos) == 120 - 120 // 7
+    assert videos[0] == {'video_id': 'v1', 'channel_id': 'UC1', 'channel_title': 'Channel', 'video_title': 'Video v1'}
+
+    # Found and unavailable videos are both served from the cache next time
+    calls.clear()
+    assert get_video_channels(video_ids, FakeYouTube(calls)) == videos
+    assert calls == []
+    close_db_connections()
+
+def test_resolve_watch_history_channels_in_parallel(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    account_id = get_or_create_account('viewer')
+    history = [{'title': f"Video {i}", 'url': '', 'watch_time': f"2024-01-01T00:00:{i % 60:02d}Z",
+                'video_id': f"v{i % 200 + 1}", 'channel_id': None} for i in range(600)]
+    store_watch_history_in_db(history, account_id)
+    calls = []
+    lock = threading.Lock()
+    def client_factory():
+        with lock:
+            return FakeYouTube(calls)
+
+    filled = resolve_watch_history_channels(None, account_id, workers=4, client_factory=client_factory)
+    assert len(calls) == 4
+    missing = get_db_connection().execute("SELECT COUNT(*) FROM watch_history WHERE channel_id IS NULL").fetchone()[0]
+    assert filled + missing == 600
+    assert missing == 600 * (200 // 7) // 200
+    close_db_connections()
+
+def test_fetch_videos_charges_every_attempt(monkeypatch):
+    charged = []
+    monkeypatch.setattr(channel_details, 'use_quota', lambda operation, units=1: charged.append(operation))
+    monkeypatch.setattr(utils.time, 'sleep', lambda seconds: None)
+    youtube = mock.MagicMock()
+    youtube.videos().list().execute.side_effect = [
+        HttpError(*error_response(500, *ERROR_RESPONSES[500])),
+        {'items': [{'id': 'v1', 'snippet': {'channelTitle': 'Channel', 'channelId': 'UC1', 'title': 'Video v1'}}]},
+    ]
+    assert fetch_videos(youtube, ['v1']) == [{'video_id': 'v1', 'channel_title': 'Channel', 'channel_id': 'UC1', 'video_title': 'Video v1'}]
+    assert charged == ['videos.list', 'videos.list']
@@ -0,0 +1,105 @@
+import json
+from argparse import Namespace
+import watch_history
+import watch_history_management
+from watch_history import iter_watch_history_html, iter_watch_history_json, process_watch_history
+
+ENTRY = ('<div class="outer-cell mdl-cell mdl-cell--12-col mdl-shadow--2dp"><div class="mdl-grid">'
+         '<div class="header-cell mdl-cell mdl-cell--12-col"><p class="mdl-typography--title">YouTube<br></p></div>'
+         '<div class="content-cell mdl-cell mdl-cell--6-col mdl-typography--body-1">{body}</div>'
+         '<div class="content-cell mdl-cell mdl-cell--6-col mdl-typography--body-1 mdl-typography--text-right"></div>'
+         '<div class="content-cell mdl-cell mdl-cell--12-col mdl-typography--caption"><b>Products:</b><br>YouTube<br></div>'
+         '</div></div>')
+
+def test_iter_watch_history_html(tmp_path):
+    history_file = tmp_path / "watch-history.html"
+    history_file.write_text('<html><body><div class="mdl-grid">' + ''.join([
+        ENTRY.format(body='Watched\xa0<a href="https://www.youtube.com/watch?v=abc123">Tom &amp; Jerry</a><br>'
+                          '<a href="https://www.youtube.com/channel/UCchannel1">Cartoons</a><br>'
+                          'Oct 18, 2024, 2:02:03 PM EDT<br>'),
+        ENTRY.format(body='Watched a video that has been removed<br>Oct 17, 2024, 1:00:00 AM EDT<br>'),
+        ENTRY.format(body='Watched\xa0<a href="https://www.youtube.com/watch?v=def456&amp;t=10">Untitled</a><br>'
+                          'Jan 2, 2024, 11:30:00 PM PST<br>'),
+    ]) + '</div></body></html>', encoding='utf-8')
+
+    assert list(iter_watch_history_html(str(history_file))) == [
+        {'title': 'Tom & Jerry', 'url': 'https://www.youtube.com/watch?v=abc123', 'video_id': 'abc123',
+         'channel_id': 'UCchannel1', 'watch_time': '2024-10-18T18:02:03Z'},
+        {'title': 'Untitled', 'url': 'https://www.youtube.com/watch?v=def456&t=10', 'video_id': 'def456',
+         'channel_id': None, 'watch_time': '2024-01-03T07:30:00Z'},
+    ]
+
+def test_iter_watch_history_json_across_chunks(tmp_path, monkeypatch):
+    # Tiny reads force entries to straddle chunk boundaries
+    monkeypatch.setattr(watch_history, 'READ_CHUNK_SIZE', 7)
+    history_file = tmp_path / "watch-history.json"
+    history_file.write_text(json.dumps([
+        {'header': 'YouTube', 'title': 'Watched Tom & Jerry',
+         'titleUrl': 'https://www.youtube.com/watch?v=abc123',
+         'subtitles': [{'name': 'Cartoons', 'url': 'https://www.youtube.com/channel/UCchannel1'}],
+         'time': '2024-10-18T18:02:03.851Z'},
+        {'header': 'YouTube', 'title': 'Watched a video that has been removed', 'time': '2024-10-17T05:00:00Z'},
+        {'header': 'YouTube', 'title': 'Watched Untitled',
+         'titleUrl': 'https://www.youtube.com/watch?v=def456', 'time': '2024-01-03T07:30:00Z'},
+    ], indent=2), encoding='utf-8')
+
+    assert list(iter_watch_history_json(str(history_file))) == [
+        {'title': 'Tom & Jerry', 'url': 'https://www.youtube.com/watch?v=abc123', 'video_id': 'abc123',
+         'channel_id': 'UCchannel1', 'watch_time': '2024-10-18T18:02:03Z'},
+        {'title': 'Untitled', 'url': 'https://www.youtube.com/watch?v=def456', 'video_id': 'def456',
+         'channel_id': None, 'watch_time': '2024-01-03T07:30:00Z'},
+    ]
+
+def test_process_watch_history_only_ingests_delta(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    history_file = tmp_path / "watch-history.json"
+
+    def write_export(count):
+        # Newest first, like Takeout
+        history_file.write_text(json.dumps([
+            {'title': f'Watched Video {i}', 'titleUrl': f'https://www.youtube.com/watch?v=video{i}',
+             'time': f'2024-10-18T18:{i:02d}:00Z'} for i in reversed(range(count))
+        ]), encoding='utf-8')
+
+    write_export(5)
+    assert process_watch_history(str(history_file), 1, 'json', max_ops=2) == 2
+    # The interrupted run did not advance the high-water mark, so the rest is picked up
+    assert process_watch_history(str(history_file), 1, 'json') == 3
+    assert process_watch_history(str(history_file), 1, 'json') == 0
+
+    write_export(8)
+    assert process_watch_history(str(history_file), 1, 'json') == 3
+
+def test_max_ops_also_limits_channel_lookups(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    history_file = tmp_path / "watch-history/viewer/Takeout/YouTube and YouTube Music/history/watch-history.json"
+    history_file.parent.mkdir(parents=True)
+    history_file.write_text('[]')
+    calls = {}
+    monkeypatch.setattr(watch_history_management, 'process_watch_history', lambda *args: 0)
+    monkeypatch.setattr(watch_history_management, 'authenticate_youtube', lambda account: None)
+    monkeypatch.setattr(watch_history_management, 'resolve_watch_history_channels',
+                        lambda youtube, account_id, **kwargs: calls.update(kwargs))
+
+    args = Namespace(account='viewer', format='json', max_ops=7, resolve_channels=True, workers=2)
+    assert watch_history_management.handle_watch_history(args, 1)
+    assert calls['max_requests'] == 7 and calls['workers'] == 2
+
+def test_unparseable_timestamps_do_not_move_the_high_water_mark(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    history_file = tmp_path / "watch-history.json"
+
+    def write_export(entries):
+        history_file.write_text(json.dumps([
+            {'title': f'Watched Video {i}', 'titleUrl': f'https://www.youtube.com/watch?v=video{i}', 'time': time}
+            for i, time in entries
+        ]), encoding='utf-8')
+
+    # Non-ISO text would sort above every ISO time if it were compared as a string
+    old = [(0, '18 octobre 2024 à 14:02'), (1, '2024-10-18T18:01:00Z'), (2, '2024-10-18T18:00:00Z')]
+    write_export(old)
+    assert process_watch_history(str(history_file), 1, 'json') == 3
+    assert watch_history.get_watch_history_high_water_mark(1) == '2024-10-18T18:01:00Z'
+
+    write_export([(4, '2024-10-18T18:03:00Z'), (3, '2024-10-18T18:02:00Z')] + old[1:])
+    assert process_watch_history(str(history_file), 1, 'json') == 2
@@ -1,9 +1,14 @@
+import contextlib
+import functools
 import logging
 from datetime import datetime
 import time
 import random
 import csv
-from googleapiclient.errors import HttpError
+import queue
+import threading
+import warnings
+from dateutil import parser as date_parser, tz
 
 MAX_RETRIES = 5
 
@@ -16,12 +21,83 @@ def parse_datetime(date_string):
     except ValueError:
         return datetime.strptime(date_string, '%Y-%m-%dT%H:%M:%SZ')
 
+# Time zone abbreviations that show up in Takeout timestamps
+TAKEOUT_TZINFOS = {
+    'UTC': tz.UTC, 'GMT': tz.UTC,
+    'EST': tz.gettz('America/New_York'), 'EDT': tz.gettz('America/New_York'),
+    'CST': tz.gettz('America/Chicago'), 'CDT': tz.gettz('America/Chicago'),
+    'MST': tz.gettz('America/Denver'), 'MDT': tz.gettz('America/Denver'),
+    'PST': tz.gettz('America/Los_Angeles'), 'PDT': tz.gettz('America/Los_Angeles'),
+    'BST': tz.gettz('Europe/London'), 'CET': tz.gettz('Europe/Paris'), 'CEST': tz.gettz('Europe/Paris'),
+}
+
+@functools.lru_cache(maxsize=4096)
+def takeout_utc_offset(zone, year, month, day, hour):
+    # Offsets only change on the hour, so this cache turns the tz lookup into a dict hit
+    return datetime(year, month, day, hour, tzinfo=TAKEOUT_TZINFOS[zone]).utcoffset()
+
+def parse_takeout_time(time_string):
+    # Normalise Takeout timestamps ("Oct 18, 2024, 2:02:03 PM EDT" or ISO 8601) to
+    # UTC "YYYY-MM-DDTHH:MM:SSZ" so they sort and compare as strings.
+    # Unparseable values give None, so they never take part in those comparisons.
+    cleaned = time_string.replace('\u202f', ' ').replace('\xa0', ' ').strip()
+    parsed = None
+    # Fast paths for ISO 8601 (JSON export) and the English HTML export format;
+    # dateutil handles everything else
+    if cleaned[:4].isdigit() and cleaned.endswith('Z'):
+        try:
+            parsed = datetime.fromisoformat(cleaned[:-1] + '+00:00')
+        except ValueError:
+            parsed = None
+        else:
+            return parsed.astimezone(tz.UTC).strftime('%Y-%m-%dT%H:%M:%SZ')
+    date_part, _, zone = cleaned.rpartition(' ')
+    if zone in TAKEOUT_TZINFOS:
+        try:
+            parsed = datetime.strptime(date_part, '%b %d, %Y, %I:%M:%S %p')
+        except ValueError:
+            parsed = None
+        else:
+            parsed -= takeout_utc_offset(zone, parsed.year, parsed.month, parsed.day, parsed.hour)
+            return parsed.strftime('%Y-%m-%dT%H:%M:%SZ')
+    if parsed is None:
+        try:
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore')
+                parsed = date_parser.parse(cleaned, tzinfos=TAKEOUT_TZINFOS)
+        except (ValueError, OverflowError):
+            return None
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=tz.UTC)
+    return parsed.astimezone(tz.UTC).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+_retry_state = threading.local()
+
+@contextlib.contextmanager
+def retry_attempt(attempt):
+    # Marks API calls made inside the block as attempt number `attempt` (0 = first try)
+    previous = getattr(_retry_state, 'attempt', 0)
+    _retry_state.attempt = attempt
+    try:
+        yield
+    finally:
+        _retry_state.attempt = previous
+
+def current_retry_attempt():
+    return getattr(_retry_state, 'attempt', 0)
+
 def exponential_backoff(func):
     def wrapper(*args, **kwargs):
+        from googleapiclient.errors import HttpError
         for i in range(MAX_RETRIES):
             try:
-                return func(*args, **kwargs)
+                with retry_attempt(i):
+                    return func(*args, **kwargs)
             except HttpError as e:
+                if e.resp.status == 403 and 'quotaExceeded' in str(e):
+                    # The quota only resets at midnight Pacific time
+                    logging.error("Quota exceeded. Not retrying.")
+                    return None
                 if e.resp.status in [403, 500, 503]:
                     wait_time = (2 ** i) + random.random()
                     logging.warning(f"Rate limit hit. Waiting for {wait_time:.2f} seconds.")
@@ -32,6 +108,72 @@ def exponential_backoff(func):
         return None
     return wrapper
 
+class TokenBucket:
+    # Thread-safe token bucket: allows `rate` acquisitions per second with bursts up to `capacity`
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity or max(1, rate))
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait_time = (1 - self.tokens) / self.rate
+            time.sleep(wait_time)
+
+def prefetch(make_iterator, size=1):
+    # Runs make_iterator() on a background thread and yields its items, keeping at
+    # most `size` of them ready ahead of the consumer. Exceptions raised by the
+    # iterator are re-raised here; closing this generator stops the thread.
+    items = queue.Queue(maxsize=size)
+    stop = threading.Event()
+
+    def put(entry):
+        while not stop.is_set():
+            try:
+                items.put(entry, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce():
+        iterator = None
+        try:
+            iterator = make_iterator()
+            for item in iterator:
+                if not put((True, item)):
+                    return
+            put((False, None))
+        except BaseException as e:
+            put((False, e))
+        finally:
+            # Lets a generator release what it holds on the producer thread
+            if hasattr(iterator, 'close'):
+                iterator.close()
+
+    thread = threading.Thread(target=produce, name="prefetch", daemon=True)
+    thread.start()
+    try:
+        while True:
+            has_item, value = items.get()
+            if not has_item:
+                if value is not None:
+                    raise value
+                return
+            yield value
+    finally:
+        stop.set()
+        thread.join()
+
 def parse_subscriptions_csv(csv_file):
     subscriptions = []
     with open(csv_file, 'r', encoding='utf-8') as file:
@@ -39,7 +181,7 @@ def parse_subscriptions_csv(csv_file):
         for row in csv_reader:
             subscription = {
                 'channel_id': row.get('Channel Id', ''),
-                'channel_title': row.get('Channel Title', ''),
+                'title': row.get('Channel Title', ''),
                 'channel_url': row.get('Channel Url', ''),
             }
             subscriptions.append(subscription)
@@ -1,17 +1,89 @@
-def get_video_channels(video_ids, youtube):
-    video_ids_str = ",".join(video_ids)
-    response = youtube.videos().list(part="snippet", id=video_ids_str).execute()
-    
-    channels = []
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from database import get_cached_videos, store_videos, get_unresolved_video_ids, fill_watch_history_channels
+from channel_details import execute_request
+from quota_management import get_remaining_quota, get_quota_project, quota_project, QUOTA_COST
+from utils import log
+
+# videos.list accepts at most 50 comma-separated IDs per call
+MAX_VIDEOS_PER_REQUEST = 50
+
+def get_video_channels(video_ids, youtube, workers=1, client_factory=None, max_requests=None):
+    # Resolves each distinct video once: cached videos come from the database,
+    # the rest are fetched in chunks of 50 and written back to the cache
+    unique_ids = list(dict.fromkeys(video_ids))
+    cached = get_cached_videos(unique_ids)
+    missing = [video_id for video_id in unique_ids if video_id not in cached]
+    log(f"Resolving {len(unique_ids)} videos: {len(cached)} cached, {len(missing)} to fetch.")
+
+    chunks = [missing[start:start + MAX_VIDEOS_PER_REQUEST] for start in range(0, len(missing), MAX_VIDEOS_PER_REQUEST)]
+    affordable = get_remaining_quota() // QUOTA_COST['videos.list']
+    if max_requests is not None:
+        affordable = min(affordable, max_requests)
+    if len(chunks) > affordable:
+        log(f"Fetching {affordable} of {len(chunks)} videos.list chunks within the quota and max-ops limits.")
+        chunks = chunks[:affordable]
+
+    # googleapiclient clients are not thread-safe, so each worker needs its own
+    if client_factory is None and workers > 1:
+        log("No client factory given. Falling back to a single video lookup worker.")
+        workers = 1
+    local = threading.local()
+    # Workers charge their calls to the caller's quota project
+    project = get_quota_project()
+
+    def fetch_worker(chunk):
+        if client_factory is not None and not hasattr(local, 'youtube'):
+            local.youtube = client_factory()
+        with quota_project(project):
+            return fetch_videos(youtube if client_factory is None else local.youtube, chunk)
+
+    resolved = {video_id: video for video_id, video in cached.items() if video['channel_id']}
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        futures = {executor.submit(fetch_worker, chunk): chunk for chunk in chunks}
+        # Results are written back on this thread as chunks complete
+        for future in as_completed(futures):
+            chunk = futures[future]
+            videos = future.result()
+            if videos is None:
+                continue
+            found = {video['video_id'] for video in videos}
+            store_videos(videos, [video_id for video_id in chunk if video_id not in found])
+            resolved.update((video['video_id'], video) for video in videos)
+
+    return [resolved[video_id] for video_id in unique_ids if video_id in resolved]
+
+def fetch_videos(youtube, video_ids):
+    # One videos.list call, retried and charged per attempt by execute_request; deleted and
+    # private videos are missing from the response. Returns None if the call failed, so
+    # the chunk is not cached as unavailable.
+    from googleapiclient.errors import HttpError
+    if len(video_ids) > MAX_VIDEOS_PER_REQUEST:
+        raise ValueError(f"videos.list accepts at most {MAX_VIDEOS_PER_REQUEST} IDs, got {len(video_ids)}")
+    try:
+        response = execute_request(youtube.videos().list(part="snippet", id=",".join(video_ids),
+                                                         maxResults=MAX_VIDEOS_PER_REQUEST), 'videos.list')
+    except HttpError as e:
+        log(f"An error occurred while fetching {len(video_ids)} videos: {e}")
+        return None
+    if response is None:
+        return None
+
+    videos = []
     for item in response.get("items", []):
-        video_id = item["id"]
-        channel_title = item["snippet"]["channelTitle"]
-        channel_id = item["snippet"]["channelId"]
-        video_title = item["snippet"]["title"]
-        channels.append({
-            "video_id": video_id,
-            "channel_title": channel_title,
-            "channel_id": channel_id,
-            "video_title": video_title
+        videos.append({
+            "video_id": item["id"],
+            "channel_title": item["snippet"]["channelTitle"],
+            "channel_id": item["snippet"]["channelId"],
+            "video_title": item["snippet"]["title"]
         })
-    return channels
+    return videos
+
+def resolve_watch_history_channels(youtube, account_id, max_requests=None, workers=1, client_factory=None):
+    # Fills watch_history.channel_id for rows whose video was not linked to a channel
+    video_ids = get_unresolved_video_ids(account_id)
+    if video_ids:
+        get_video_channels(video_ids, youtube, workers, client_factory, max_requests)
+    filled = fill_watch_history_channels(account_id)
+    log(f"Filled in the channel of {filled} watch history items.")
+    return filled
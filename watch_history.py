@@ -1,14 +1,30 @@
-from google.oauth2.credentials import Credentials
-from googleapiclient.discovery import build
-from utils import log
+import html
+import json
+import mmap
+import os
+import re
+import time
+from auth import authenticate_youtube
+from database import store_watch_history_in_db, get_watch_history_high_water_mark, set_watch_history_high_water_mark
+from utils import log, parse_takeout_time
 
-def get_watch_history(credentials_path, max_results=50):
-    try:
-        # Set up credentials
-        credentials = Credentials.from_authorized_user_file(credentials_path)
+# Number of watch history records written per database transaction
+WATCH_HISTORY_BATCH_SIZE = 1000
+# Bytes read per step when streaming the JSON export
+READ_CHUNK_SIZE = 1024 * 1024
+# Prefix of activity titles in the English JSON export
+WATCHED_PREFIX = 'Watched '
+# First body cell of each Takeout entry; the right-aligned and caption cells use other classes
+ENTRY_BODY_PATTERN = re.compile(rb'<div class="content-cell[^"]*mdl-typography--body-1">(.*?)</div>', re.DOTALL)
+LINK_PATTERN = re.compile(r'<a href="([^"]*)"[^>]*>(.*?)</a>', re.DOTALL)
+TAG_PATTERN = re.compile(r'<a\b.*?</a>|<[^>]+>', re.DOTALL)
+VIDEO_ID_PATTERN = re.compile(r'[?&]v=([^&#]+)')
+CHANNEL_ID_PATTERN = re.compile(r'/channel/([^/?#]+)')
 
-        # Build the YouTube API client
-        youtube = build('youtube', 'v3', credentials=credentials)
+def get_watch_history(account_name, max_results=50):
+    # Uses the account's shared client instead of building one from the token file
+    try:
+        youtube = authenticate_youtube(account_name)
 
         # Retrieve the watch history
         request = youtube.playlistItems().list(
@@ -58,3 +74,149 @@ def print_watch_history(watch_history):
             print(f"Watched: {item['title']} ({item['url']})")
     else:
         print("No watch history available or an error occurred.")
+
+def process_watch_history(history_file, account_id, file_format, max_ops=None):
+    if file_format == 'html':
+        records = iter_watch_history_html(history_file)
+    elif file_format == 'json':
+        records = iter_watch_history_json(history_file)
+    else:
+        log(f"Unsupported watch history format: {file_format}")
+        return 0
+
+    # Takeout lists the newest entries first, so parsing can stop as soon as it
+    # reaches the point up to which a previous run stored everything
+    high_water_mark = get_watch_history_high_water_mark(account_id)
+    # A mark saved before timestamps were normalised may not be comparable; it is dropped
+    high_water_mark = parse_takeout_time(high_water_mark) if high_water_mark else None
+    if high_water_mark:
+        log(f"Skipping watch history entries older than {high_water_mark}.")
+
+    total_parsed = 0
+    total_inserted = 0
+    newest_seen = None
+    complete = True
+    batch = []
+    started = time.monotonic()
+
+    def flush(batch):
+        inserted = store_watch_history_in_db(batch, account_id)
+        elapsed = time.monotonic() - started
+        log(f"Processed {total_parsed} watch history records, {total_inserted + inserted} new "
+            f"({total_parsed / elapsed if elapsed > 0 else 0:.0f} records/sec).")
+        return inserted
+
+    for record in records:
+        watch_time = record['watch_time']
+        if high_water_mark and watch_time and watch_time < high_water_mark:
+            log(f"Reached previously imported entries at {watch_time}. Stopping the process.")
+            break
+        if watch_time and (newest_seen is None or watch_time > newest_seen):
+            newest_seen = watch_time
+
+        total_parsed += 1
+        batch.append(record)
+        batch_limit = WATCH_HISTORY_BATCH_SIZE
+        if max_ops is not None:
+            batch_limit = min(batch_limit, max_ops - total_inserted)
+        if len(batch) >= batch_limit:
+            total_inserted += flush(batch)
+            batch = []
+            if max_ops is not None and total_inserted >= max_ops:
+                log(f"Reached max-ops limit of {max_ops}. Stopping the process.")
+                complete = False
+                break
+    if batch:
+        total_inserted += flush(batch)
+
+    # Only advance the mark after a full pass; an interrupted run simply
+    # re-reads the head of the file next time and the duplicates are ignored
+    if complete and newest_seen and (high_water_mark is None or newest_seen > high_water_mark):
+        set_watch_history_high_water_mark(account_id, newest_seen)
+
+    elapsed = time.monotonic() - started
+    log(f"Stored {total_inserted} new watch history records out of {total_parsed} parsed in {elapsed:.2f} seconds.")
+    return total_inserted
+
+def iter_watch_history_json(history_file):
+    for entry in iter_json_array(history_file):
+        video_url = entry.get('titleUrl')
+        video_match = VIDEO_ID_PATTERN.search(video_url) if video_url else None
+        if video_match is None:
+            # Removed videos, ads and non-YouTube activity have no video link
+            continue
+        subtitles = entry.get('subtitles') or [{}]
+        channel_match = CHANNEL_ID_PATTERN.search(subtitles[0].get('url', ''))
+        title = entry.get('title', '')
+        if title.startswith(WATCHED_PREFIX):
+            title = title[len(WATCHED_PREFIX):]
+        yield {
+            'title': title,
+            'url': video_url,
+            'video_id': video_match.group(1),
+            'channel_id': channel_match.group(1) if channel_match else None,
+            'watch_time': parse_takeout_time(entry['time']) if entry.get('time') else None
+        }
+
+def iter_json_array(path):
+    # Decode the elements of a top-level JSON array one at a time from fixed-size
+    # reads, so only the current element and one chunk are held in memory
+    decoder = json.JSONDecoder()
+    with open(path, 'r', encoding='utf-8') as f:
+        buffer = f.read(READ_CHUNK_SIZE).lstrip()
+        if not buffer.startswith('['):
+            raise ValueError(f"{path} does not contain a JSON array")
+        position = 1
+        eof = False
+        while True:
+            while position < len(buffer) and buffer[position] in ' \t\r\n,':
+                position += 1
+            if position < len(buffer) and buffer[position] == ']':
+                return
+            try:
+                if position >= len(buffer):
+                    raise json.JSONDecodeError("Need more data", buffer, position)
+                element, position = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+                chunk = f.read(READ_CHUNK_SIZE)
+                eof = not chunk
+                buffer = buffer[position:] + chunk
+                position = 0
+                continue
+            yield element
+
+def iter_watch_history_html(history_file):
+    # Scan the memory-mapped file for entry bodies instead of building a DOM, so
+    # memory use stays flat however large the export is. Each entry body reads
+    # "Watched <a href=video>title</a><br><a href=channel>name</a><br>date<br>".
+    with open(history_file, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            for match in ENTRY_BODY_PATTERN.finditer(data):
+                record = parse_entry_body(match.group(1).decode('utf-8', errors='replace'))
+                if record:
+                    yield record
+
+def parse_entry_body(body):
+    links = LINK_PATTERN.findall(body)
+    if not links:
+        # Removed or private videos have no link to store
+        return None
+    video_url = html.unescape(links[0][0])
+    video_match = VIDEO_ID_PATTERN.search(video_url)
+    if video_match is None:
+        return None
+
+    channel_match = CHANNEL_ID_PATTERN.search(links[1][0]) if len(links) > 1 else None
+
+    texts = [text.strip() for text in TAG_PATTERN.split(body) if text.strip()]
+    return {
+        'title': html.unescape(links[0][1]).strip(),
+        'url': video_url,
+        'video_id': video_match.group(1),
+        'channel_id': channel_match.group(1) if channel_match else None,
+        'watch_time': parse_takeout_time(html.unescape(texts[-1])) if texts else None
+    }
@@ -1,5 +1,7 @@
 import os
+from auth import authenticate_youtube
 from utils import log
+from video_info import resolve_watch_history_channels
 from watch_history import process_watch_history
 
 def handle_watch_history(args, account_id):
@@ -12,6 +14,10 @@ def handle_watch_history(args, account_id):
         log(f"Watch history file not found: {history_file}")
         return False
 
-    total_processed = process_watch_history(history_file, account_id, args.format, args.max_ops)
-    log(f"Processed {total_processed} watch history items for account {args.account}.")
+    total_stored = process_watch_history(history_file, account_id, args.format, args.max_ops)
+    log(f"Stored {total_stored} new watch history items for account {args.account}.")
+
+    if args.resolve_channels:
+        resolve_watch_history_channels(authenticate_youtube(args.account), account_id, max_requests=args.max_ops,
+                                       workers=args.workers, client_factory=lambda: authenticate_youtube(args.account))
     return True
@@ -1,9 +1,9 @@
-from channel_details import get_channel_details
-from subscription_listing import list_subscriptions
+from channel_details import get_channel_details, get_channels_details
+from subscription_listing import list_subscriptions, iter_subscription_pages
 from subscription_import import import_subscriptions
 from utils import log
 
 # This file now serves as a facade for the YouTube API operations,
 # delegating the actual work to more specialized modules.
 
-__all__ = ['get_channel_details', 'list_subscriptions', 'import_subscriptions', 'log']
+__all__ = ['get_channel_details', 'get_channels_details', 'list_subscriptions', 'iter_subscription_pages', 'import_subscriptions', 'log']